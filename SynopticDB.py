@@ -1,42 +1,447 @@
 # Import Necessary Libraries
+import calendar
+from collections import deque
 import datetime as dt
 from datetime import timedelta
 from dateutil.relativedelta import relativedelta
+import hashlib
+import heapq
+from itertools import islice
+from operator import itemgetter
 import numpy as np
 import os.path as osp
+import json
 import os
 import pandas as pd
+from pathlib import Path
 import sqlite3
-import toml
-from .utils import ensure_list, get_networks, get_stations, get_timeseries
+import threading
+import time
+from .export import EXPORT_FORMATS, write_frames
+from .harvester import Harvester, shard_key, split_shards, split_windows
+from .metrics import NULL_METRICS
+from .scheduler import RequestScheduler
+from .spatial import StationIndex
+from .spool import read_response
+from .textvars import split_column
+from .utils import check_payload, ensure_list, get_networks, get_stations, timeseries_frames
 import logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Logging is configured by the application using SynopticDB
+logger = logging.getLogger(__name__)
 
 class SynopticError(Exception):
     pass
 
+# Storage layouts for the observations: one table per variable or a single long observations table
+LAYOUTS = ['tables', 'long']
+# Tables in the database that do not hold observations
+META_TABLES = ['Metadata', 'Stations', 'Networks', 'Coverage', 'StationKeys', 'Variables', 'Observations', 'Partitions', 'Rollups', 'DataVersions',
+               'TextValues', 'TextVariables']
+# Resolutions of the rollups in seconds, from the finest (computed from the observations) to the coarsest (computed from the previous one)
+ROLLUP_RESOLUTIONS = {'hour': 3600, 'day': 86400}
+# Statistics of each variable in the rollup queries
+ROLLUP_STATS = ['MIN', 'MAX', 'MEAN', 'COUNT', 'UNITS']
+# Periods of time the observations can be partitioned in, one database file per period, and their numpy datetime units
+PARTITION_PERIODS = {'year': 'Y', 'month': 'M', 'day': 'D'}
+# Maximum number of databases sqlite attaches to a single connection (SQLITE_MAX_ATTACHED default)
+MAX_ATTACHED = 10
+# Observations table of the long layout, formatted with the schema prefix where it is created
+OBSERVATIONS_SQL = '''CREATE TABLE IF NOT EXISTS {}Observations
+                (STATION_ID INTEGER, VARIABLE_ID INTEGER, EPOCH INTEGER, VALUE,
+                PRIMARY KEY (STATION_ID, VARIABLE_ID, EPOCH)) WITHOUT ROWID'''
+# Gaps in the coverage shorter than this number of seconds are not requested (Synoptic works in minutes)
+MIN_GAP_SECONDS = 60
+# Number of stations normalized at once by each parse worker
+PARSE_CHUNK_SIZE = 200
+
+# Transform a datetime into epoch seconds, naive datetimes are considered UTC
+#
+def to_epoch(utcTime):
+    if utcTime.tzinfo is not None:
+        return int(utcTime.timestamp())
+    return calendar.timegm(utcTime.timetuple())
+
+# Read the Synoptic API token from the SynopticPy configuration file
+#
+# @ returns the token, raises SynopticError if there is no configuration file or token
+#
+def read_token():
+    # toml is only needed by the databases requesting Synoptic
+    import toml
+    try:
+        # Manually expand the tilde in the file path
+        tokenPath = os.path.expanduser('~/.config/SynopticPy/config.toml')
+        # Open and parse the TOML file and access the 'token' value
+        return toml.load(tokenPath)['default']['token']
+    except Exception:
+        # If the user does not have a token in the right location, give the user the instructions on how to set up their token
+        raise SynopticError("Token not found. Follow instructions here to add a token: https://github.com/blaylockbk/SynopticPy#-setup")
+
+# Transform epoch seconds into a naive UTC datetime
+#
+def from_epoch(epoch):
+    return dt.datetime.fromtimestamp(epoch, dt.timezone.utc).replace(tzinfo=None)
+
+# Melt the dataframe of one station into columnar arrays grouped by variable
+#
+# @ Param siteDf - dataframe with data from Synoptic for a single station
+#
+# @ returns a dictionary with the variable name as key and a tuple (column type, datetimes, values, units) as value
+#
+def melt_station_df(siteDf):
+    units = siteDf.attrs.get('UNITS') or {}
+    # Convert the datetimes once for the whole station
+    datetimes = pd.to_datetime(siteDf.index)
+    if datetimes.tz is not None:
+        datetimes = datetimes.tz_convert('UTC').tz_localize(None)
+    datetimes = datetimes.to_numpy(dtype='datetime64[s]')
+    # Pull all the values out of pandas once, as floats if every column is numeric
+    numeric = [isinstance(dtype, np.dtype) and dtype.kind in 'biuf' for dtype in siteDf.dtypes]
+    block = siteDf.to_numpy(dtype=np.float64) if all(numeric) else siteDf.to_numpy(dtype=object)
+    melted = {}
+    for j, variable in enumerate(siteDf.columns):
+        column = block[:, j]
+        if numeric[j] and column.dtype == object:
+            column = column.astype(np.float64)
+        # Classify each column once and drop its missing values with a vectorized mask
+        for name, thisType, values, mask, unit in split_column(variable, column, units.get(variable)):
+            if mask.any():
+                melted[name] = (thisType, datetimes[mask], values[mask], unit)
+    return melted
+
+# Melt a list of station dataframes into compact columnar arrays per variable, with the station ids and units
+# stored once per station. This is the part of the normalization that runs in the parse workers.
+#
+# @ Param listOfDfs - list of dataframes with data from Synoptic
+#
+# @ returns a dictionary with the variable name as key and a tuple (column type, station ids, number of values per station,
+#   datetimes, values, units per station) as value
+#
+def melt_station_chunk(listOfDfs):
+    chunks = {}
+    for count, siteDf in enumerate(listOfDfs):
+        if count % 1000 == 0:
+            logger.debug(f'melt_station_chunk - Melting: {count} / {len(listOfDfs)}')
+        stationID = siteDf.attrs['STID']
+        for variable, (thisType, datetimes, values, dataUnit) in melt_station_df(siteDf).items():
+            chunks.setdefault(variable, []).append((thisType, stationID, datetimes, values, dataUnit))
+    compact = {}
+    for variable, varChunks in chunks.items():
+        compact[variable] = (chunk_type(varChunks), [chunk[1] for chunk in varChunks], np.array([len(chunk[2]) for chunk in varChunks]),
+                             np.concatenate([chunk[2] for chunk in varChunks]), np.concatenate([chunk[3] for chunk in varChunks]),
+                             [chunk[4] for chunk in varChunks])
+    return compact
+
+# Merge the compact arrays of consecutive chunks of stations into a single set of columnar arrays per variable
+#
+# @ Param compacts - list of dictionaries from melt_station_chunk, in the order of the stations
+#
+# @ returns a dictionary with the variable name as key and a tuple (column type, stids, datetimes, values, units) as value
+#
+def merge_station_chunks(compacts):
+    parts = {}
+    for compact in compacts:
+        for variable, part in compact.items():
+            parts.setdefault(variable, []).append(part)
+    melted = {}
+    for variable, varParts in parts.items():
+        lengths = np.concatenate([part[2] for part in varParts])
+        stids = np.repeat(np.array([stid for part in varParts for stid in part[1]], dtype=object), lengths)
+        datetimes = np.concatenate([part[3] for part in varParts])
+        values = np.concatenate([part[4] for part in varParts])
+        units = np.repeat(np.array([unit for part in varParts for unit in part[5]], dtype=object), lengths)
+        melted[variable] = (chunk_type(varParts), stids, datetimes, values, units)
+    return melted
+
+# Type of a variable melted in several parts: the first type found is the type of its table,
+# unless some stations have text values, which are kept as text
+#
+def chunk_type(parts):
+    return "TEXT" if any(part[0] == "TEXT" for part in parts) else parts[0][0]
+
+# Melt a list of station dataframes into a single set of columnar arrays per variable
+#
+# @ Param listOfDfs - list of dataframes with data from Synoptic
+# @ Param executor - process pool normalizing chunks of stations in parallel, None to do it in this process
+# @ Param chunkSize - number of stations sent to a worker at once
+#
+# @ returns a dictionary with the variable name as key and a tuple (column type, stids, datetimes, values, units) as value
+#
+def melt_station_dfs(listOfDfs, executor=None, chunkSize=PARSE_CHUNK_SIZE):
+    # Small batches cost more to send to the workers than to melt here
+    if executor is None or len(listOfDfs) < 2*chunkSize:
+        return merge_station_chunks([melt_station_chunk(listOfDfs)])
+    chunks = [listOfDfs[i:i+chunkSize] for i in range(0, len(listOfDfs), chunkSize)]
+    return merge_station_chunks(executor.map(melt_station_chunk, chunks))
+
+# Read a spooled response and melt it like melt_station_chunk, in a replay worker
+#
+# @ Param folder - folder of the spool
+# @ Param sha - content hash of the response
+#
+def melt_spooled_response(folder, sha):
+    payload = read_response(folder, sha)
+    return melt_station_chunk(timeseries_frames(payload) if check_payload(payload) else [])
+
+# URI opening a database file read-only
+#
+def read_only_uri(path):
+    return f"{Path(osp.abspath(path)).as_uri()}?mode=ro"
+
+# Melt spooled responses in order, on a pool of processes if given
+#
+# @ Param folder - folder of the spool
+# @ Param shas - content hashes of the responses
+# @ Param executor - ProcessPoolExecutor melting the responses, None to do it in this process
+# @ Param maxInFlight - maximum number of responses melted and not consumed yet, bounds the memory used
+#
+# @ yields the compact arrays of each response (see melt_station_chunk)
+#
+def melt_spooled_responses(folder, shas, executor=None, maxInFlight=8):
+    if executor is None:
+        for sha in shas:
+            yield melt_spooled_response(folder, sha)
+        return
+    pending = iter(shas)
+    futures = deque(executor.submit(melt_spooled_response, folder, sha) for sha in islice(pending, maxInFlight))
+    while futures:
+        compact = futures.popleft().result()
+        sha = next(pending, None)
+        if sha is not None:
+            futures.append(executor.submit(melt_spooled_response, folder, sha))
+        yield compact
+
+# Start a pool of worker processes. The workers are forked from a clean server process, never from a process
+# with harvester threads. multiprocessing is only imported by the databases using the workers
+#
+# @ Param workers - number of processes
+#
+def start_process_pool(workers):
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+    return ProcessPoolExecutor(workers, mp_context=context)
+
+# Pivot the rows of a query into a dataframe with one value and one units column per variable,
+# aligned on station id and datetime and sorted by them
+#
+# @ Param rows - list of (variable code, STID, DATETIME or EPOCH, VALUE[, UNITS]) rows
+# @ Param tableNames - list of the variables in the query
+# @ Param variables - dictionary of variable code -> (index in tableNames, units or None if the units are in the rows)
+# @ Param epochs - the datetimes of the rows are epoch seconds
+#
+# @ returns a dataframe with STID, DATETIME and <VARIABLE>_VALUE, <VARIABLE>_UNITS columns, or None if there are no rows
+#
+def pivot_rows(rows, tableNames, variables, epochs=False):
+    if not len(rows):
+        return None
+    # Split the rows into columns
+    columns = [list(map(itemgetter(i), rows)) for i in range(len(rows[0]))]
+    codes = np.array(columns[0], dtype=np.int64)
+    lookup = np.full(max(variables) + 1, -1, dtype=np.int64)
+    lookup[list(variables)] = [index for index, _ in variables.values()]
+    varIndex = lookup[codes]
+    values = np.array(columns[3], dtype=object)
+    if len(columns) > 4:
+        units = np.array(columns[4], dtype=object)
+    else:
+        unitsLookup = np.full(len(lookup), None, dtype=object)
+        unitsLookup[list(variables)] = [unit for _, unit in variables.values()]
+        units = unitsLookup[codes]
+    # Give each (station, datetime) pair a sorted integer key
+    stidCodes, stidUniques = pd.factorize(np.array(columns[1], dtype=object), sort=True)
+    timeCodes, timeUniques = pd.factorize(np.array(columns[2], dtype=np.int64 if epochs else object), sort=True)
+    keys = stidCodes.astype(np.int64) * len(timeUniques) + timeCodes
+    uniqueKeys, inverse = np.unique(keys, return_inverse=True)
+    times = timeUniques[uniqueKeys % len(timeUniques)]
+    if epochs:
+        times = pd.to_datetime(times, unit='s').strftime('%Y-%m-%d %H:%M:%S')
+    result = {'STID': np.asarray(stidUniques[uniqueKeys // len(timeUniques)], dtype=object), 'DATETIME': np.asarray(times, dtype=object)}
+    # Scatter the values of each variable into its columns
+    for i, table in enumerate(tableNames):
+        mask = varIndex == i
+        valueColumn = np.full(len(uniqueKeys), np.nan, dtype=object)
+        valueColumn[inverse[mask]] = values[mask]
+        unitsColumn = np.full(len(uniqueKeys), None, dtype=object)
+        unitsColumn[inverse[mask]] = units[mask]
+        result[f'{(table).upper()}_VALUE'] = valueColumn
+        result[f'{(table).upper()}_UNITS'] = unitsColumn
+    return pd.DataFrame(result).infer_objects()
+
+# Transform a time step given as a timedelta or a number of seconds into seconds
+#
+def to_seconds(step):
+    return int(step.total_seconds()) if isinstance(step, timedelta) else int(step)
+
+# Snap rows of observations to the cells of a station x time x variable cube, keeping the closest observation
+# of each cell (the earliest one on ties) and dropping the ones further than the tolerance from every grid time
+#
+# @ Param rows - list of rows from query_rows (code, STID, datetime, VALUE, ...), sorted by station id and datetime
+# @ Param values - array of shape (stations, times, variables) receiving the values
+# @ Param mask - boolean array of the same shape, set for the cells that received a value
+# @ Param units - list of the units of each variable, the missing ones are filled from the rows of the tables layout
+# @ Param stationIndex - pandas Index of the station ids of the cube
+# @ Param lookup - array mapping the variable codes of the rows to the variable index in the cube, -1 to skip them
+# @ Param start - epoch of the first grid time
+# @ Param step - seconds between the grid times
+# @ Param tolerance - maximum seconds between an observation and its grid time
+# @ Param epochs - the datetimes of the rows are epoch seconds
+#
+# @ returns the number of cells set
+#
+def snap_rows(rows, values, mask, units, stationIndex, lookup, start, step, tolerance, epochs=False):
+    numStations, numTimes, numVars = values.shape
+    # Split the rows into columns
+    columns = [list(map(itemgetter(i), rows)) for i in range(4)]
+    varIndex = lookup[np.array(columns[0], dtype=np.int64)]
+    stationIdx = stationIndex.get_indexer(np.array(columns[1], dtype=object))
+    times = np.array(columns[2], dtype=np.int64 if epochs else 'datetime64[s]').astype(np.int64)
+    try:
+        obsValues = np.array(columns[3], dtype=np.float64)
+    except (TypeError, ValueError):
+        obsValues = pd.to_numeric(pd.Series(columns[3], dtype=object), errors='coerce').to_numpy(dtype=np.float64)
+    if len(rows[0]) > 4 and None in units:
+        unitsColumn = np.array(list(map(itemgetter(4), rows)), dtype=object)
+        for index in [i for i, unit in enumerate(units) if unit is None]:
+            found = np.flatnonzero((varIndex == index) & pd.notna(unitsColumn))
+            if len(found):
+                units[index] = unitsColumn[found[0]]
+    # Nearest grid time of each observation
+    timeIdx = np.rint((times - start) / step).astype(np.int64)
+    distance = np.abs(times - (start + timeIdx*step))
+    keep = (varIndex >= 0) & (stationIdx >= 0) & (timeIdx >= 0) & (timeIdx < numTimes) & (distance <= tolerance) & ~np.isnan(obsValues)
+    cells = (stationIdx[keep].astype(np.int64)*numTimes + timeIdx[keep])*numVars + varIndex[keep]
+    if not len(cells):
+        return 0
+    # Closest observation of each cell, lexsort is stable so the earliest observation wins the ties
+    order = np.lexsort((distance[keep], cells))
+    sortedCells = cells[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = sortedCells[1:] != sortedCells[:-1]
+    pick = order[first]
+    values.reshape(-1)[cells[pick]] = obsValues[keep][pick]
+    mask.reshape(-1)[cells[pick]] = True
+    return len(pick)
+
+# Columns of the Stations and Networks tables filled from the Synoptic metadata
+STATION_COLUMNS = ['STID', 'NAME', 'STATE', 'LATITUDE', 'LONGITUDE', 'ELEVATION', 'ELEVATION_UNITS', 'LAST_ACTIVE', 'NETWORK_ID']
+NETWORK_COLUMNS = ['NETWORK_ID', 'NETWORK_NAME_SHORT', 'NETWORK_NAME_LONG']
+
+# Transform a metadata value into a float or an integer, Synoptic sends numbers as strings
+#
+def to_number(value, kind=float):
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return None
+
+# Transform the Synoptic station metadata into rows of the Stations table
+#
+# @ Param stationDict - station metadata from get_stations
+#
+# @ returns a dictionary with the station id as key and the row as value
+#
+def station_rows(stationDict):
+    rows = {}
+    for station in stationDict.get("STATION") or []:
+        try:
+            lastActive = (station.get("PERIOD_OF_RECORD") or {}).get('end')
+            if lastActive != None:
+                lastActive = dt.datetime.strptime(lastActive, "%Y-%m-%dT%H:%M:%SZ").strftime("%Y-%m-%d %H:%M:%S")
+            rows[station["STID"]] = (station["STID"], station["NAME"], station["STATE"],
+                to_number(station["LATITUDE"]), to_number(station["LONGITUDE"]), to_number(station.get("ELEVATION")),
+                (station.get("UNITS") or {}).get('elevation'), lastActive, to_number(station.get("MNET_ID"), int))
+        except Exception as e:
+            logger.warning(f"station_rows with exception: {e}")
+    return rows
+
+# Transform the Synoptic network metadata into rows of the Networks table
+#
+# @ Param networkDict - network metadata from get_networks
+#
+# @ returns a dictionary with the network id as key and the row as value
+#
+def network_rows(networkDict):
+    rows = {}
+    for network in networkDict.get('MNET') or []:
+        try:
+            networkID = to_number(network['ID'], int)
+            rows[networkID] = (networkID, network['SHORTNAME'], network['LONGNAME'])
+        except Exception as e:
+            logger.warning(f"network_rows with exception: {e}")
+    return rows
+
 class SynopticDB(object):
     # Constructor for SynopticDB class
     #
     # @ Param folderPath - path where this script is located
+    # @ Param layout - storage layout of a new database, 'tables' (one table per variable) or 'long' (single observations table)
+    # @ Param journalMode - sqlite journal mode, WAL lets readers keep working while data is being inserted
+    # @ Param synchronous - sqlite synchronous setting (off, normal, full)
+    # @ Param cacheSize - sqlite page cache size, negative values are in KiB
+    # @ Param mmapSize - number of bytes of the database file that are memory mapped
+    # @ Param busyTimeout - seconds to wait for a lock held by another connection
+    # @ Param partition - period of the database files the observations of a new database are split in ('year', 'month' or 'day'), None for a single file
+    # @ Param token - Synoptic API token, read from the SynopticPy configuration file the first time a request needs it if not provided
+    # @ Param metrics - Metrics object recording the time and rows of each stage, None to disable the instrumentation
+    # @ Param scheduler - RequestScheduler with the rate limit of the Synoptic plan and the backoff of the failed requests,
+    #   no rate limit if not provided
+    # @ Param cache - QueryCache keeping the results of query_db until an ingest changes their data, no cache if not provided
+    # @ Param parseWorkers - number of processes normalizing the station dataframes of large inserts, None to do it in this process
+    # @ Param spool - Spool saving the raw Synoptic responses so they can be replayed, None to not save them
+    # @ Param readOnly - open an existing database read-only for queries: no token, no schema checks and no Synoptic requests
+    # @ Param fetchMetadata - request the stations and networks when the database is created. False leaves them empty,
+    #   e.g. for a database filled from a spool with replay, which writes the metadata saved in the spool
     #
-    def __init__(self, folderPath=osp.join(osp.abspath(os.getcwd()), "synDB.db")):
+    def __init__(self, folderPath=osp.join(osp.abspath(os.getcwd()), "synDB.db"), layout=None,
+                 journalMode="wal", synchronous="normal", cacheSize=-64000, mmapSize=256*1024**2, busyTimeout=30, partition=None,
+                 token=None, metrics=None, scheduler=None, cache=None, parseWorkers=None, spool=None, readOnly=False,
+                 fetchMetadata=True):
         self.dbPath = osp.join(folderPath)
-        # Get the users token
-        try:
-            # Manually expand the tilde in the file path
-            tokenPath = os.path.expanduser('~/.config/SynopticPy/config.toml')
-            # Open and parse the TOML file
-            config = toml.load(tokenPath)
-            # Access the 'token' value
-            self.token = config['default']['token']
-        except:
-            # If the user does not have a token in the right location, give the user the instructions on how to set up their token
-            raise SynopticError("Token not found. Follow instructions here to add a token: https://github.com/blaylockbk/SynopticPy#-setup")
+        # Settings applied to every connection to the database
+        self.pragmas = {'journal_mode': journalMode, 'synchronous': synchronous, 'cache_size': cacheSize, 'mmap_size': mmapSize}
+        self.busyTimeout = busyTimeout
+        # Long-lived connections owned by this object, one per thread
+        self._local = threading.local()
+        self._connections = []
+        # Cached list of the tables in the database
+        self._tableNames = None
+        # Cached spatial index of the station locations
+        self._spatialIndex = None
+        # Timers and counters of the fetch, parse, insert, commit, query and metadata stages
+        self.metrics = metrics if metrics is not None else NULL_METRICS
+        # Rate limit and backoff shared by all the requests to Synoptic
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler()
+        # Results of query_db keyed by the query parameters and the data version
+        self.cache = cache
+        # Process pool normalizing the station dataframes, started by the first large insert
+        self.parseWorkers = parseWorkers
+        self._parsePool = None
+        # Raw responses of the requests, replayed with replay
+        self.spool = spool
+        if layout is not None and layout not in LAYOUTS:
+            raise SynopticError(f"Unknown layout {layout}. Pick one from {LAYOUTS}")
+        if partition is not None and partition not in PARTITION_PERIODS:
+            raise SynopticError(f"Unknown partition period {partition}. Pick one from {list(PARTITION_PERIODS)}")
+        # The users token, see get_token
+        self.token = token
+        self.readOnly = readOnly
         # Initialize the parameters for querying the database
         self.init_params()
+        if readOnly:
+            # Only the storage settings are read, the schema is the one of the database that wrote the file
+            if not osp.isfile(self.dbPath):
+                raise SynopticError(f"Database {self.dbPath} does not exist")
+            with self.get_connection() as conn:
+                settings = dict(conn.execute("SELECT key, value FROM Metadata WHERE key IN ('layout', 'partition')").fetchall())
+            self.layout = settings.get('layout', "tables")
+            self.partition = settings.get('partition')
+            if layout is not None and layout != self.layout:
+                raise SynopticError(f"The database uses the '{self.layout}' layout")
+            return
         # Open connection to sqlite database. Using "with" prevents database corruption
-        with sqlite3.connect(self.dbPath) as conn:
+        with self.get_connection() as conn:
             # Create a cursor object to execute SQL queries
             c = conn.cursor()
             # Get a list of all of the avaialable tables in the database
@@ -51,9 +456,39 @@ class SynopticDB(object):
                 # Add creation date to Metadata
                 c.execute("INSERT OR IGNORE INTO Metadata (key, value) VALUES (?, ?)", 
                         ("creation_date_utc", dt.datetime.now(dt.timezone.utc).strftime('%Y-%m-%d_%H:%M:%S')))
+                # Add the storage layout to Metadata
+                c.execute("INSERT OR IGNORE INTO Metadata (key, value) VALUES (?, ?)", ("layout", layout or "tables"))
+                # Add the partition period to Metadata
+                if partition is not None:
+                    c.execute("INSERT OR IGNORE INTO Metadata (key, value) VALUES (?, ?)", ("partition", partition))
                 # Commit changes to the database
                 conn.commit()
-                logging.info("Created a Metadata table")
+                logger.info("Created a Metadata table")
+            # Databases created before the layouts were introduced use one table per variable
+            c.execute("SELECT value FROM Metadata WHERE key = 'layout'")
+            row = c.fetchone()
+            self.layout = row[0] if row is not None else "tables"
+            if layout is not None and layout != self.layout:
+                raise SynopticError(f"The database uses the '{self.layout}' layout" + (". Use migrate_to_long_layout to convert it" if layout == "long" else ""))
+            # Databases created before the partitions were introduced keep all the observations in a single file
+            c.execute("SELECT value FROM Metadata WHERE key = 'partition'")
+            row = c.fetchone()
+            self.partition = row[0] if row is not None else None
+            if partition is not None and partition != self.partition:
+                raise SynopticError(f"The database is partitioned by {self.partition}" if self.partition else "The database is not partitioned")
+            # Add the Partitions table if it is not in the database
+            if self.partition is not None and not "Partitions" in dbTableNames:
+                # Database files holding the observations of each period and the tables in each of them
+                c.execute('''CREATE TABLE Partitions
+                        (NAME TEXT, TABLE_NAME TEXT, START_EPOCH INTEGER, END_EPOCH INTEGER,
+                        PRIMARY KEY (NAME, TABLE_NAME))''')
+                conn.commit()
+                logger.info("Created a Partitions table")
+            # Add the long layout tables if they are not in the database
+            if self.layout == "long" and not "Observations" in dbTableNames:
+                self.create_long_tables(c)
+                conn.commit()
+                logger.info("Created the long layout tables")
             # Add the Stations table if it is not in the database
             if not "Stations" in dbTableNames:
                 # Create the Stations table with eight columns: STID, NAME, LATITUDE, LONGITUDE, ELEVATION, ELEVATION_UNITS, STATE, LAST_ACTIVE, & NETWORK_ID
@@ -63,8 +498,9 @@ class SynopticDB(object):
                 # Commit changes to the database
                 conn.commit()
                 # Get all of the Synoptic station data
-                self.build_stations_table()
-                logging.info("Created a Stations table")
+                if fetchMetadata:
+                    self.build_stations_table()
+                logger.info("Created a Stations table")
             # Add the Networks table if it is not in the database
             if not "Networks" in dbTableNames:
                 c.execute('''CREATE TABLE Networks
@@ -73,190 +509,1166 @@ class SynopticDB(object):
                 # Commit changes to the database
                 conn.commit()
                 # Get Synoptic network ids and insert them into the database
-                self.build_networks_table()
-                logging.info("Created a Networks table")
+                if fetchMetadata:
+                    self.build_networks_table()
+                logger.info("Created a Networks table")
+            # Add the Coverage table if it is not in the database
+            if not "Coverage" in dbTableNames:
+                # Ranges of time already requested to Synoptic for each station shard
+                c.execute('''CREATE TABLE Coverage
+                        (SHARD TEXT, START_EPOCH INTEGER, END_EPOCH INTEGER, FETCHED_UTC TEXT,
+                        PRIMARY KEY (SHARD, START_EPOCH))''')
+                conn.commit()
+                logger.info("Created a Coverage table")
+            # Add the Rollups table if it is not in the database
+            if not "Rollups" in dbTableNames:
+                # Statistics of the numeric variables per station and time bucket, updated with every insert
+                c.execute('''CREATE TABLE Rollups
+                        (RESOLUTION TEXT, VARIABLE TEXT, STID TEXT, BUCKET INTEGER, MIN REAL, MAX REAL, SUM REAL, COUNT INTEGER, UNITS TEXT,
+                        PRIMARY KEY (RESOLUTION, VARIABLE, STID, BUCKET)) WITHOUT ROWID''')
+                conn.commit()
+                logger.info("Created a Rollups table")
+                if any(table not in META_TABLES for table in dbTableNames) or "Observations" in dbTableNames:
+                    logger.info("Run rebuild_rollups to compute the rollups of the data already in the database")
+            # Add the DataVersions table if it is not in the database
+            if not "DataVersions" in dbTableNames:
+                # Version of the data of each variable and day, set to the data_version in Metadata by the inserts changing it
+                c.execute('''CREATE TABLE DataVersions
+                        (VARIABLE TEXT, DAY INTEGER, VERSION INTEGER, PRIMARY KEY (VARIABLE, DAY)) WITHOUT ROWID''')
+                conn.commit()
+                logger.info("Created a DataVersions table")
+            # Add the text dictionary tables if they are not in the database
+            if not "TextValues" in dbTableNames:
+                # Each distinct text value is stored once, the text variables store its TEXT_ID
+                c.execute('''CREATE TABLE TextValues
+                        (TEXT_ID INTEGER PRIMARY KEY, VALUE TEXT UNIQUE)''')
+                # Text variables storing TEXT_IDs. Text variables created before the dictionary store their strings
+                c.execute('''CREATE TABLE TextVariables
+                        (VARIABLE TEXT PRIMARY KEY)''')
+                conn.commit()
+                logger.info("Created the TextValues and TextVariables tables")
+            # Tables could have been created above
+            self._tableNames = None
+
+    # Returns the connection to the database of the current thread, opening it the first time it is requested
+    #
+    def get_connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self.open_connection()
+            self._local.conn = conn
+            self._connections.append(conn)
+        return conn
+
+    # Open a new connection to the database with the settings applied, attaching some partitions
+    #
+    # @ Param partitions - list of partition names attached as p_<name>, their files are created if they do not exist
+    #
+    # @ returns a connection that the caller has to close
+    #
+    def open_connection(self, partitions=()):
+        # The connections are closed by the thread calling close, so they can not be bound to their thread
+        if self.readOnly:
+            conn = sqlite3.connect(read_only_uri(self.dbPath), timeout=self.busyTimeout, check_same_thread=False, uri=True)
+        else:
+            conn = sqlite3.connect(self.dbPath, timeout=self.busyTimeout, check_same_thread=False)
+        for schema in ['main'] + [f"p_{name}" for name in partitions]:
+            if schema != 'main':
+                path = self.partition_path(schema[2:])
+                conn.execute(f"ATTACH DATABASE ? AS {schema}", (read_only_uri(path) if self.readOnly else path,))
+            for pragma, value in self.pragmas.items():
+                # The journal mode is set by the writers
+                if value is not None and not (self.readOnly and pragma == 'journal_mode'):
+                    conn.execute(f"PRAGMA {schema}.{pragma} = {value}")
+        return conn
+
+    # Close all the connections to the database opened by this object
+    #
+    def close(self):
+        for conn in self._connections:
+            conn.close()
+        self._connections = []
+        self._local = threading.local()
+        if self._parsePool is not None:
+            self._parsePool.shutdown()
+            self._parsePool = None
+
+    # Returns the process pool normalizing the station dataframes, starting it the first time it is requested
+    #
+    # @ returns None if the database has no parse workers
+    #
+    def parse_pool(self):
+        if self.parseWorkers is None or self.parseWorkers < 2:
+            return None
+        if self._parsePool is None:
+            self._parsePool = start_process_pool(self.parseWorkers)
+        return self._parsePool
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Create the tables of the long layout: station and variable dictionaries and a single observations table
+    #
+    # @ Param c - cursor of the database connection
+    #
+    def create_long_tables(self, c):
+        c.execute('''CREATE TABLE IF NOT EXISTS StationKeys
+                (STATION_ID INTEGER PRIMARY KEY, STID TEXT UNIQUE)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS Variables
+                (VARIABLE_ID INTEGER PRIMARY KEY, VARIABLE TEXT, UNITS TEXT, UNIQUE(VARIABLE, UNITS))''')
+        c.execute(OBSERVATIONS_SQL.format(''))
+
+    # Returns the Synoptic API token, reading it from the SynopticPy configuration file the first time it is requested
+    #
+    def get_token(self):
+        if self.token is None:
+            self.token = read_token()
+        return self.token
 
     # Initializes the parameters for getting data for and querying the database
     #
     def init_params(self):
         self.params = {'endDatetime': dt.datetime.utcnow(), 'startDatetime':(dt.datetime.utcnow() - timedelta(days = 1)),
                        'stationIDs': None, 'networks': None,'minLatitude': None, 'maxLatitude': None, 'minLongitude': None, 
-                        'maxLongitude': None, 'states': None, 'networks': None, 'vars': None, 'makeFile': True}
+                        'maxLongitude': None, 'states': None, 'networks': None, 'vars': None, 'makeFile': True,
+                        'resolution': None}
 
-    # Get the Synoptic station network identifiers and insert them into the database (ex., RAWS, NWS, ...)
+    # Get Synoptic network ids and insert them into the database
     #
     def build_networks_table(self):
-        # Open connection to sqlite database. Using "with" prevents database corruption
-        with sqlite3.connect(self.dbPath) as conn:
-            # Create a cursor object to execute SQL queries
-            c = conn.cursor()
-            networkDict = get_networks(self.token)
-            logging.info(f"Adding {len(networkDict['MNET'])} networks to database")
-            # Iterate through your data and insert it into the table
-            for network in networkDict['MNET']:
-                try:
-                    networkID = network['ID']
-                    networkSN = network['SHORTNAME']
-                    networkLN = network['LONGNAME']
-                    values = [networkID,networkSN,networkLN]
-                    c.execute("INSERT INTO Networks (NETWORK_ID, NETWORK_NAME_SHORT, NETWORK_NAME_LONG) VALUES (?, ?, ?)", values)
-                    # Commit changes to the database
-                    conn.commit()
-                except Exception as e:
-                    logging.warning(f"build_networks_table with exception: {e}")
-                    pass
-    
+        networkDict = get_networks(self.get_token(), self.spool)
+        if networkDict is None:
+            logger.warning("build_networks_table - could not get the networks from Synoptic")
+            return
+        rows = network_rows(networkDict)
+        logger.info(f"Adding {len(rows)} networks to database")
+        with self.metrics.timer('metadata', table='Networks'), self.get_connection() as conn:
+            self.upsert_rows(conn.cursor(), 'Networks', NETWORK_COLUMNS, rows)
+
     # Get all of the stations from Synoptic and save their metadata
     #
     def build_stations_table(self):
-        logging.info(f"Getting station metadata")
-        # Open connection to sqlite database. Using "with" prevents database corruption
-        with sqlite3.connect(self.dbPath) as conn:
-            # Create a cursor object to execute SQL queries
+        logger.info(f"Getting station metadata")
+        stationDict = get_stations(self.get_token(), self.spool)
+        if stationDict is None:
+            logger.warning("build_stations_table - could not get the stations from Synoptic")
+            return
+        rows = station_rows(stationDict)
+        logger.info(f"Adding {len(rows)} stations to database")
+        with self.metrics.timer('metadata', table='Stations'), self.get_connection() as conn:
+            self.upsert_rows(conn.cursor(), 'Stations', STATION_COLUMNS, rows)
+        # The station locations could have changed
+        self._spatialIndex = None
+        logger.info("Done getting station metadata at time")
+
+    # Refresh the Stations and Networks tables from Synoptic. The metadata is requested first and then
+    # only the new or changed rows are written in a single short transaction, so readers are not blocked.
+    #
+    # @ returns a dictionary with the number of added and updated stations and networks
+    #
+    def refresh_metadata(self):
+        stationDict = get_stations(self.get_token(), self.spool)
+        networkDict = get_networks(self.get_token(), self.spool)
+        if stationDict is None or networkDict is None:
+            raise SynopticError("Could not get the station and network metadata from Synoptic")
+        return self.write_metadata(stationDict, networkDict)
+
+    # Write the new or changed rows of the station and network metadata in a single transaction
+    #
+    # @ Param stationDict - stations/metadata payload
+    # @ Param networkDict - networks payload
+    #
+    # @ returns a dictionary with the number of added and updated stations and networks
+    #
+    def write_metadata(self, stationDict, networkDict):
+        stations = station_rows(stationDict)
+        networks = network_rows(networkDict)
+        with self.metrics.timer('metadata', table='refresh'), self.get_connection() as conn:
             c = conn.cursor()
-            stationDict = get_stations(self.token)
-            logging.info(f"Adding {len(stationDict['STATION'])} stations to database")
-            for station in stationDict["STATION"]:
-                try:
-                    stationId = station["STID"]
-                    stationName = station["NAME"]
-                    stationState = station["STATE"]
-                    stationLat = station["LATITUDE"]
-                    stationLon = station["LONGITUDE"]
-                    elevation = station["ELEVATION"]
-                    elevationUnits = station["UNITS"]['elevation']
-                    lastActive = station["PERIOD_OF_RECORD"].get('end')
-                    if lastActive != None:
-                        lastActive = dt.datetime.strptime(
-                            lastActive, "%Y-%m-%dT%H:%M:%SZ"
-                        ).strftime("%Y-%m-%d %H:%M:%S")
-                    mnet = station["MNET_ID"]
-                    values = [
-                        stationId, stationName, stationState, stationLat, stationLon, 
-                        elevation, elevationUnits, lastActive, mnet
-                    ]
-                    c.execute(f"INSERT OR IGNORE INTO Stations (STID, NAME, STATE, LATITUDE, LONGITUDE, ELEVATION, ELEVATION_UNITS, LAST_ACTIVE, NETWORK_ID) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", values)
-                    # Commit changes to the database
-                    conn.commit()
-                except Exception as e:
-                    logging.warning(f"build_stations_table with exception: {e}")
-                    pass
-        logging.info("Done getting station metadata at time")
+            if not conn.in_transaction:
+                c.execute("BEGIN IMMEDIATE")
+            stationsAdded, stationsUpdated = self.upsert_rows(c, 'Stations', STATION_COLUMNS, stations)
+            networksAdded, networksUpdated = self.upsert_rows(c, 'Networks', NETWORK_COLUMNS, networks)
+            c.execute("INSERT OR REPLACE INTO Metadata (key, value) VALUES (?, ?)",
+                ("metadata_refresh_utc", dt.datetime.now(dt.timezone.utc).strftime('%Y-%m-%d_%H:%M:%S')))
+        if stationsAdded or stationsUpdated:
+            self._spatialIndex = None
+        logger.info(f"write_metadata - stations: {stationsAdded} added, {stationsUpdated} updated. "
+                     f"networks: {networksAdded} added, {networksUpdated} updated")
+        return {'stationsAdded': stationsAdded, 'stationsUpdated': stationsUpdated,
+                'networksAdded': networksAdded, 'networksUpdated': networksUpdated}
+
+    # Insert the new rows and update the changed rows of a metadata table, leaving the others untouched
+    #
+    # @ Param c - cursor of the database connection
+    # @ Param table - table name
+    # @ Param columns - list of columns, the first one is the primary key
+    # @ Param rows - dictionary with the primary key as key and the row as value
+    #
+    # @ returns a tuple (number of rows added, number of rows updated)
+    #
+    def upsert_rows(self, c, table, columns, rows):
+        existing = {row[0]: row for row in c.execute(f"SELECT {', '.join(columns)} FROM {table}")}
+        changed = [row for key, row in rows.items() if existing.get(key) != row]
+        numAdded = sum(1 for row in changed if row[0] not in existing)
+        updates = ', '.join(f"{column} = excluded.{column}" for column in columns[1:])
+        c.executemany(f"""INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['?']*len(columns))})
+                      ON CONFLICT({columns[0]}) DO UPDATE SET {updates}""", changed)
+        # The cached query results include the station metadata
+        if changed:
+            self.next_version(c, 'metadata_version')
+        return numAdded, len(changed) - numAdded
+
+    # Increase a version counter of the Metadata table
+    #
+    # @ Param c - cursor of the database connection, in the transaction changing the data
+    # @ Param key - 'data_version' or 'metadata_version'
+    #
+    # @ returns the new version
+    #
+    def next_version(self, c, key='data_version'):
+        row = c.execute("SELECT value FROM Metadata WHERE key = ?", (key,)).fetchone()
+        version = int(row[0]) + 1 if row is not None else 1
+        c.execute("INSERT OR REPLACE INTO Metadata (key, value) VALUES (?, ?)", (key, str(version)))
+        return version
+
+    # Set the days an insert touched to a new data version, so only the cached results of those variables and days are stale
+    #
+    # @ Param c - cursor of the database connection, in the transaction of the insert
+    # @ Param melted - dictionary of columnar arrays per variable from melt_station_dfs
+    #
+    def bump_versions(self, c, melted):
+        version = self.next_version(c)
+        rows = []
+        for variable, (thisType, stids, datetimes, values, units) in melted.items():
+            days = np.unique(datetimes.astype('datetime64[D]').astype(np.int64))
+            rows += [(variable, day, version) for day in days.tolist()]
+        c.executemany("""INSERT INTO DataVersions (VARIABLE, DAY, VERSION) VALUES (?, ?, ?)
+                      ON CONFLICT (VARIABLE, DAY) DO UPDATE SET VERSION = excluded.VERSION""", rows)
 
     # Insert data into the database
     #
     # @ Param listOfDfs- list of dataframes with data from Synoptic
     #
+    # @ returns the number of values written (values already in the database are ignored and not counted)
+    #
     def insert_data(self, listOfDfs):
-        logging.debug('SynopticDB.insert_data - Adding data to the repo')
-        # Open connection to sqlite database
-        with sqlite3.connect(self.dbPath) as conn:
-            # Create a cursor object to execute SQL queries
+        # Put the listOfDfs into a list if it isn't already in a list
+        if not isinstance(listOfDfs, list):
+            listOfDfs = [listOfDfs]
+        logger.debug('SynopticDB.insert_data - Number of inserts: %d', len(listOfDfs))
+        with self.metrics.timer('insert'):
+            # Melt each station's data and group the values by variable
+            with self.metrics.timer('parse'):
+                melted = melt_station_dfs(listOfDfs, self.parse_pool())
+            return self.insert_melted(melted)
+
+    # Write the melted data into the database, the second half of insert_data
+    #
+    # @ Param melted - dictionary of columnar arrays per variable from melt_station_dfs
+    #
+    # @ returns the number of values written (values already in the database are ignored and not counted)
+    #
+    def insert_melted(self, melted):
+        melted = self.encode_text(melted)
+        # Write the values of each period to its own partition
+        if self.partition is not None:
+            numValues = sum(self.insert_partition(key, partMelted) for key, partMelted in self.split_partitions(melted).items())
+        else:
+            # Open connection to sqlite database
+            with self.get_connection() as conn:
+                # Create a cursor object to execute SQL queries
+                c = conn.cursor()
+                # Write all of the variables in a single transaction
+                if not conn.in_transaction:
+                    c.execute("BEGIN")
+                with self.metrics.timer('write'):
+                    if self.layout == "long":
+                        numValues = self.write_long_rows(c, melted)
+                    else:
+                        numValues = self.write_table_rows(c, melted)
+                    self.update_rollups(c, melted)
+                    self.bump_versions(c, melted)
+                # Commit changes to the database
+                with self.metrics.timer('commit'):
+                    conn.commit()
+        self.metrics.incr('rows_inserted', numValues)
+        logger.debug('SynopticDB.insert_melted - Inserted %d values of %d variables', numValues, len(melted))
+        return numValues
+
+    # Replace the strings of the text variables with their ids in the TextValues dictionary, adding the new strings.
+    # The dictionary is committed first, so the data can be written to the main database or to the partitions.
+    #
+    # @ Param melted - dictionary of columnar arrays per variable from melt_station_dfs
+    #
+    # @ returns the melted data with the values of the dictionary encoded variables as TEXT_IDs (type INTEGER)
+    #
+    def encode_text(self, melted):
+        textVariables = self.text_variables()
+        candidates = [variable for variable, m in melted.items() if m[0] == "TEXT" or variable in textVariables]
+        if not candidates:
+            return melted
+        encoded = {}
+        with self.get_connection() as conn:
+            c = conn.cursor()
+            if not conn.in_transaction:
+                c.execute("BEGIN")
+            # New text variables use the dictionary, the ones stored before it keep their strings
+            newVariables = [variable for variable in candidates if variable not in textVariables]
+            if newVariables:
+                storedVariables = self.stored_variables(refresh=True)
+                newVariables = [variable for variable in newVariables if variable not in storedVariables]
+                c.executemany("INSERT OR IGNORE INTO TextVariables (VARIABLE) VALUES (?)", ((variable,) for variable in newVariables))
+            for variable in candidates:
+                if variable in textVariables or variable in newVariables:
+                    codes, uniques = pd.factorize(melted[variable][3])
+                    encoded[variable] = (codes, [str(value) for value in uniques])
+            strings = sorted(set().union(*(uniques for _, uniques in encoded.values())))
+            c.executemany("INSERT OR IGNORE INTO TextValues (VALUE) VALUES (?)", ((string,) for string in strings))
+            textIds = dict(c.execute("SELECT VALUE, TEXT_ID FROM TextValues WHERE VALUE IN (SELECT value FROM json_each(?))",
+                                     (json.dumps(strings),)))
+            conn.commit()
+        melted = dict(melted)
+        for variable, (codes, uniques) in encoded.items():
+            thisType, stids, datetimes, values, units = melted[variable]
+            ids = np.array([textIds[string] for string in uniques], dtype=np.int64)
+            melted[variable] = ("INTEGER", stids, datetimes, ids[codes], units)
+        return melted
+
+    # Returns the set of text variables whose values are ids in the TextValues dictionary
+    #
+    def text_variables(self):
+        # Read-only databases written before the dictionary do not have the table
+        if "TextVariables" not in self.list_table_names():
+            return set()
+        with self.get_connection() as conn:
+            return {row[0] for row in conn.execute("SELECT VARIABLE FROM TextVariables")}
+
+    # Returns the set of variables with observations in the database
+    #
+    # @ Param refresh - read the tables of the database again
+    #
+    def stored_variables(self, refresh=False):
+        if self.layout == "long":
+            with self.get_connection() as conn:
+                return {row[0] for row in conn.execute("SELECT DISTINCT VARIABLE FROM Variables")}
+        if self.partition is not None:
+            with self.get_connection() as conn:
+                return {row[0] for row in conn.execute("SELECT DISTINCT TABLE_NAME FROM Partitions")}
+        if refresh:
+            self._tableNames = None
+        return set(self.list_variable_tables())
+
+    # Split the melted data by partition period
+    #
+    # @ Param melted - dictionary of columnar arrays per variable from melt_station_dfs
+    #
+    # @ returns a dictionary with the start of the period (numpy datetime64) as key and the melted data of the period as value
+    #
+    def split_partitions(self, melted):
+        partitions = {}
+        for variable, (thisType, stids, datetimes, values, units) in melted.items():
+            keys = datetimes.astype(f'datetime64[{PARTITION_PERIODS[self.partition]}]')
+            for key in np.unique(keys):
+                mask = keys == key
+                partitions.setdefault(key, {})[variable] = (thisType, stids[mask], datetimes[mask], values[mask], units[mask])
+        return partitions
+
+    # Insert the melted data of one period into its partition. In WAL mode SQLite does not commit a transaction over
+    # attached files atomically, so each transaction writes to a single file: the keys of the long layout in the main
+    # database, then the rows in the partition, then the rollups, data versions and partition tables in the main
+    # database. Every step is idempotent, so after a crash between them inserting the data again (sync requests it
+    # again, the coverage is recorded after the insert) completes the bookkeeping.
+    #
+    # @ Param key - start of the period (numpy datetime64)
+    # @ Param melted - dictionary of columnar arrays per variable of the period
+    #
+    # @ returns the number of values written
+    #
+    def insert_partition(self, key, melted):
+        name = str(key).replace('-', '_')
+        schema = f"p_{name}"
+        startEpoch = int(key.astype('datetime64[s]').astype(np.int64))
+        endEpoch = int((key + 1).astype('datetime64[s]').astype(np.int64))
+        conn = self.open_connection([name])
+        try:
             c = conn.cursor()
-            # Put the listOfDfs into a list if it isn't already in a list
-            if not isinstance(listOfDfs, list):
-                listOfDfs = [listOfDfs]
-            logging.debug(f'SynopticDB.insert_data - Number of inserts: {len(listOfDfs)}')
-            # Get a list of all of the avaialbe tables in the database
+            with self.metrics.timer('write'):
+                keys = None
+                if self.layout == "long":
+                    c.execute("BEGIN")
+                    keys = self.long_keys(c, melted)
+                    conn.commit()
+                c.execute("BEGIN")
+                if self.layout == "long":
+                    c.execute(OBSERVATIONS_SQL.format(f"{schema}."))
+                    numWritten = self.write_long_rows(c, melted, schema, keys)
+                    tables = ['Observations']
+                else:
+                    numWritten = self.write_table_rows(c, melted, schema)
+                    tables = list(melted)
+            with self.metrics.timer('commit'):
+                conn.commit()
+            with self.metrics.timer('write'):
+                c.execute("BEGIN")
+                self.update_rollups(c, melted, schema)
+                self.bump_versions(c, melted)
+                # Register the tables of the partition
+                c.executemany("INSERT OR IGNORE INTO Partitions (NAME, TABLE_NAME, START_EPOCH, END_EPOCH) VALUES (?, ?, ?, ?)",
+                              ((name, table, startEpoch, endEpoch) for table in tables))
+            with self.metrics.timer('commit'):
+                conn.commit()
+        finally:
+            conn.close()
+        return numWritten
+
+    # Path of the database file of a partition
+    #
+    def partition_path(self, name):
+        return f"{osp.splitext(self.dbPath)[0]}_{name}.db"
+
+    # Write the melted data into one table per variable
+    #
+    # @ Param c - cursor of the database connection
+    # @ Param melted - dictionary of columnar arrays per variable from melt_station_dfs
+    # @ Param schema - attached partition where the tables are, None for the main database
+    #
+    # @ returns the number of rows written
+    #
+    def write_table_rows(self, c, melted, schema=None):
+        # Get a list of all of the avaialbe tables in the database
+        if schema is None:
             dbTableNames = self.list_table_names()
-            # Each site in the listOfDfs is one station's data
-            for count, siteDf in enumerate(listOfDfs):
-                if count % 1000 == 0:
-                    logging.debug(f'SynopticDB.insert_data - Inserting: {count} / {len(listOfDfs)}')
-                # List of all of the columns from the dataframe
-                dfVariableNames = siteDf.keys()
-                # Convert the datetime to datetime format
-                siteDf.index = pd.to_datetime(siteDf.index)
-                for idx, row in siteDf.iterrows():
-                    # Loop through all of the column names in the row
-                    for variable in  dfVariableNames:
-                        # Unsure of how to handle these variables
-                        bannedVars = ['cloud_layer_1','weather_summary']
-                        if variable in bannedVars:
-                            continue
-                        # get the current value in the row
-                        try:
-                            currValue = row[variable]
-                        except:
-                            continue
-                        # If the current value is a NaN, continue
-                        try:
-                            if np.isnan(float(currValue)):
-                                continue
-                        except:
-                            if isinstance(currValue, str):
-                                if row[variable].lower() in ("nan", "n/a", "na", "none", "nonetype"):
-                                    continue
-                        # Used to correctly label the value in the database (either string or numeric value)
-                        thisType = "REAL" if isinstance(currValue, (int, float)) else "TEXT"
-                        thisValue = float(currValue) if thisType == "REAL" else str(currValue)
-                        # Check if the current table name is already in the database
-                        if variable not in dbTableNames:
-                            # If the variable name from the MesoWest file isn't in the database already
-                            c.execute("CREATE TABLE {} ({} {}, {} {}, {} {}, {} {}, UNIQUE(STID, DATETIME, VALUE))".format(
-                                        variable, "STID", "TEXT", "DATETIME", "DATETIME", "VALUE", thisType, "UNITS","TEXT")) 
-                            # Add the variable name to the current table names in the database
-                            dbTableNames.append(variable)
-                        # Prepare the data to be inserted into the database
-                        stationID = siteDf.attrs['STID']
-                        datetime = row.name.strftime('%Y-%m-%d %H:%M:%S')
-                        dataValue = thisValue
-                        dataUnit = siteDf.attrs['UNITS'].get(variable)
-                        values = [stationID, datetime, dataValue, dataUnit]
-                        # Insert data into the database
-                        c.execute(f"INSERT OR IGNORE INTO {variable} (STID, DATETIME, VALUE, UNITS) VALUES (?, ?, ?, ?)", values)
-                # Commit changes to the database
+            prefix = ""
+        else:
+            dbTableNames = [row[0] for row in c.execute(f"SELECT name FROM {schema}.sqlite_master WHERE type='table'").fetchall()]
+            prefix = f"{schema}."
+        numWritten = 0
+        for variable, (thisType, stids, datetimes, values, units) in melted.items():
+            # Check if the current table name is already in the database
+            if variable not in dbTableNames:
+                # If the variable name from the MesoWest file isn't in the database already
+                c.execute("CREATE TABLE {}{} ({} {}, {} {}, {} {}, {} {}, UNIQUE(STID, DATETIME, VALUE))".format(
+                            prefix, variable, "STID", "TEXT", "DATETIME", "DATETIME", "VALUE", thisType, "UNITS","TEXT"))
+                # Add the variable name to the current table names in the database
+                dbTableNames.append(variable)
+                if schema is None:
+                    self._tableNames = None
+            # Format all the datetimes of the table at once
+            datetimes = pd.DatetimeIndex(datetimes).strftime('%Y-%m-%d %H:%M:%S')
+            # Insert all the rows of the table at once
+            c.executemany(f"INSERT OR IGNORE INTO {prefix}{variable} (STID, DATETIME, VALUE, UNITS) VALUES (?, ?, ?, ?)",
+                          zip(stids.tolist(), datetimes, values.tolist(), units.tolist()))
+            # Values already in the table are ignored and not counted
+            numWritten += c.rowcount
+        return numWritten
+
+    # Write the melted data into the observations table of the long layout
+    #
+    # @ Param c - cursor of the database connection
+    # @ Param melted - dictionary of columnar arrays per variable from melt_station_dfs
+    # @ Param schema - attached partition where the observations table is, None for the main database
+    # @ Param keys - station and variable keys from long_keys, None to get them in the transaction of the rows
+    #
+    # @ returns the number of rows written
+    #
+    def write_long_rows(self, c, melted, schema=None, keys=None):
+        if not melted:
+            return 0
+        stationKeys, variableKeys = keys if keys is not None else self.long_keys(c, melted)
+        numWritten = 0
+        for variable, (thisType, stids, datetimes, values, units) in melted.items():
+            stationIds = [stationKeys[stid] for stid in stids.tolist()]
+            variableIds = [variableKeys[(variable, unit)] for unit in units.tolist()]
+            epochs = datetimes.astype('datetime64[s]').astype(np.int64).tolist()
+            c.executemany(f"INSERT OR IGNORE INTO {schema + '.' if schema else ''}Observations (STATION_ID, VARIABLE_ID, EPOCH, VALUE) VALUES (?, ?, ?, ?)",
+                          zip(stationIds, variableIds, epochs, values.tolist()))
+            numWritten += c.rowcount
+        return numWritten
+
+    # Get the integer keys of the stations and of the variable and units pairs of the melted data, adding the new ones
+    #
+    # @ returns a tuple (dictionary of station id -> key, dictionary of (variable, units) -> key)
+    #
+    def long_keys(self, c, melted):
+        # Make sure every station has an integer key
+        allStids = list(set().union(*(set(m[1].tolist()) for m in melted.values())))
+        c.executemany("INSERT OR IGNORE INTO StationKeys (STID) VALUES (?)", ((stid,) for stid in allStids))
+        stationKeys = {}
+        for i in range(0, len(allStids), 900):
+            chunk = allStids[i:i+900]
+            c.execute(f"SELECT STID, STATION_ID FROM StationKeys WHERE STID IN ({','.join(['?']*len(chunk))})", chunk)
+            stationKeys.update(c.fetchall())
+        # Make sure every variable and units pair has an integer key
+        variableKeys = self.variable_keys(c, {(variable, unit) for variable, m in melted.items() for unit in set(m[4].tolist())})
+        return stationKeys, variableKeys
+
+    # Get the integer keys of the variable and units pairs, adding the ones that are not in the Variables table
+    #
+    # @ Param c - cursor of the database connection
+    # @ Param pairs - set of (variable, units) tuples
+    #
+    # @ returns a dictionary with the (variable, units) tuple as key and the variable id as value
+    #
+    def variable_keys(self, c, pairs):
+        c.execute("SELECT VARIABLE, UNITS, VARIABLE_ID FROM Variables")
+        variableKeys = {(variable, unit): key for variable, unit, key in c.fetchall()}
+        for pair in sorted(pairs, key=str):
+            if pair not in variableKeys:
+                c.execute("INSERT INTO Variables (VARIABLE, UNITS) VALUES (?, ?)", pair)
+                variableKeys[pair] = c.lastrowid
+        return variableKeys
+
+    # Update the rollups of the stations and time buckets touched by an insert, in the transaction of the insert
+    #
+    # @ Param c - cursor of the database connection
+    # @ Param melted - dictionary of columnar arrays per variable from melt_station_dfs
+    # @ Param schema - attached partition where the observations are, None for the main database
+    #
+    def update_rollups(self, c, melted, schema=None):
+        for variable, (thisType, stids, datetimes, values, units) in melted.items():
+            if thisType != "REAL" or not len(stids):
+                continue
+            epochs = datetimes.astype('datetime64[s]').astype(np.int64)
+            self.compute_rollups(c, variable, int(epochs.min()), int(epochs.max()) + 1, np.unique(stids).tolist(), schema)
+
+    # Compute the rollups of a variable in a time range from the observations, replacing the ones in the database
+    #
+    # @ Param c - cursor of the database connection
+    # @ Param variable - variable name
+    # @ Param startEpoch - start of the time range in epoch seconds, extended to the start of its buckets
+    # @ Param endEpoch - end of the time range in epoch seconds (excluded), extended to the end of its buckets
+    # @ Param stids - list of station ids, None for all the stations
+    # @ Param schema - attached partition where the observations are, None for the main database
+    #
+    def compute_rollups(self, c, variable, startEpoch, endEpoch, stids=None, schema=None):
+        prefix = f"{schema}." if schema else ""
+        previous = None
+        for resolution, seconds in ROLLUP_RESOLUTIONS.items():
+            args = {'resolution': resolution, 'variable': variable, 'seconds': seconds,
+                    'start': startEpoch // seconds * seconds, 'end': -(-endEpoch // seconds) * seconds}
+            stationCondition = ""
+            if stids is not None:
+                args['stations'] = json.dumps(stids)
+                stationCondition = "AND STID IN (SELECT value FROM json_each(:stations))"
+            if previous is not None:
+                # Coarser resolutions are computed from the previous resolution
+                args['previous'] = previous
+                c.execute(f'''INSERT OR REPLACE INTO Rollups (RESOLUTION, VARIABLE, STID, BUCKET, MIN, MAX, SUM, COUNT, UNITS)
+                        SELECT :resolution, VARIABLE, STID, BUCKET / :seconds * :seconds AS NEW_BUCKET, MIN(MIN), MAX(MAX), SUM(SUM), SUM(COUNT), MAX(UNITS)
+                        FROM Rollups WHERE RESOLUTION = :previous AND VARIABLE = :variable {stationCondition}
+                        AND BUCKET >= :start AND BUCKET < :end GROUP BY STID, NEW_BUCKET''', args)
+            elif self.layout == "long":
+                c.execute(f'''INSERT OR REPLACE INTO Rollups (RESOLUTION, VARIABLE, STID, BUCKET, MIN, MAX, SUM, COUNT, UNITS)
+                        SELECT :resolution, :variable, k.STID, o.EPOCH / :seconds * :seconds AS NEW_BUCKET,
+                        MIN(o.VALUE), MAX(o.VALUE), SUM(o.VALUE), COUNT(o.VALUE), MAX(v.UNITS)
+                        FROM Variables v JOIN StationKeys k JOIN {prefix}Observations o ON o.STATION_ID = k.STATION_ID AND o.VARIABLE_ID = v.VARIABLE_ID
+                        WHERE v.VARIABLE = :variable {stationCondition.replace("STID", "k.STID")}
+                        AND o.EPOCH >= :start AND o.EPOCH < :end GROUP BY k.STID, NEW_BUCKET''', args)
+            else:
+                args.update({'startDatetime': from_epoch(args['start']).strftime("%Y-%m-%d %H:%M:%S"),
+                             'endDatetime': from_epoch(args['end']).strftime("%Y-%m-%d %H:%M:%S")})
+                c.execute(f'''INSERT OR REPLACE INTO Rollups (RESOLUTION, VARIABLE, STID, BUCKET, MIN, MAX, SUM, COUNT, UNITS)
+                        SELECT :resolution, :variable, STID, CAST(strftime('%s', DATETIME) AS INTEGER) / :seconds * :seconds AS NEW_BUCKET,
+                        MIN(VALUE), MAX(VALUE), SUM(VALUE), COUNT(VALUE), MAX(UNITS)
+                        FROM {prefix}{variable} WHERE DATETIME >= :startDatetime AND DATETIME < :endDatetime {stationCondition}
+                        GROUP BY STID, NEW_BUCKET''', args)
+            previous = resolution
+
+    # Compute the rollups of all the numeric variables from the observations in the database,
+    # for databases that had data before the rollups were introduced
+    #
+    def rebuild_rollups(self):
+        if self.layout == "long":
+            with self.get_connection() as conn:
+                variables = [row[0] for row in conn.execute("SELECT DISTINCT VARIABLE FROM Variables")]
+        elif self.partition is not None:
+            with self.get_connection() as conn:
+                variables = [row[0] for row in conn.execute("SELECT DISTINCT TABLE_NAME FROM Partitions")]
+        else:
+            variables = self.list_variable_tables()
+        variables = [variable for variable, thisType in self.variable_types(variables).items() if thisType == "REAL"]
+        if self.partition is None:
+            sources = [(None, None, 0, to_epoch(dt.datetime(9000, 1, 1)))]
+        else:
+            with self.get_connection() as conn:
+                sources = conn.execute("SELECT NAME, GROUP_CONCAT(TABLE_NAME), MIN(START_EPOCH), MAX(END_EPOCH) FROM Partitions GROUP BY NAME ORDER BY NAME").fetchall()
+        for name, tables, startEpoch, endEpoch in sources:
+            conn = self.get_connection() if name is None else self.open_connection([name])
+            try:
+                c = conn.cursor()
+                if not conn.in_transaction:
+                    c.execute("BEGIN")
+                for variable in variables:
+                    if tables is None or self.layout == "long" or variable in tables.split(','):
+                        logger.info(f"Computing the rollups of {variable}" + (f" in partition {name}" if name else ""))
+                        self.compute_rollups(c, variable, startEpoch, endEpoch, schema=None if name is None else f"p_{name}")
+                c.execute("UPDATE DataVersions SET VERSION = ?", (self.next_version(c),))
                 conn.commit()
+            finally:
+                if name is not None:
+                    conn.close()
 
-    # Uses SynopticPy to get data from the Synoptic Weather Site and insert the data into the database
+    # Get data from the Synoptic Weather Site and insert the data into the database
     #
-    def get_synData(self, max_retries=5):
+    # @ Param max_retries - number of times each hour of data is requested before giving up
+    # @ Param workers - number of threads requesting data from Synoptic
+    #
+    def get_synData(self, max_retries=5, workers=1):
+        return self.harvest(workers=workers, max_retries=max_retries)
+
+    # Get ALL of the data from the United States from ALL sources
+    #
+    # @ Param workers - number of threads requesting data from Synoptic
+    #
+    def get_all_synoptic_data(self, workers=4):
+        # Get all the station IDs in the database
+        allSTIDs = self.find_stids_from_params(None, None, None, None)
+        # Run the harvest for all of the available stations in the database
+        self.params['stationIDs'] = allSTIDs
+        return self.harvest(workers=workers)
+
+    # Get only the data that is missing from the coverage ledger for the time range and stations in the parameters.
+    # Interrupted runs can be resumed by calling sync again, the jobs already inserted are not requested again.
+    #
+    # @ Param workers - number of threads requesting data from Synoptic
+    # @ Param windowHours - maximum length of the time window of each job in hours
+    # @ Param shardSize - maximum number of stations per job
+    # @ Param overlap - timedelta requested again before each gap, to get the observations that reach Synoptic late
+    # @ Param max_retries - number of times each job is requested before giving up
+    # @ Param backend - 'threads' or 'asyncio' (see Harvester)
+    #
+    # @ returns a dictionary with the number of jobs, failed jobs, rows inserted, seconds and rows per second
+    #
+    def sync(self, workers=4, windowHours=1, shardSize=1875, overlap=timedelta(0), max_retries=5, backend='threads'):
+        startTime = self.params.get('startDatetime')
+        endTime = self.params.get('endDatetime') or dt.datetime.now(dt.timezone.utc)
+        if startTime is None:
+            startTime = endTime - timedelta(days=1)
+        harvester = Harvester(self, workers=workers, max_retries=max_retries, backend=backend)
+        jobs = []
+        for shard in split_shards(self.params.get('stationIDs'), shardSize):
+            params = dict(self.params, stationIDs=shard)
+            for gapStart, gapEnd in self.missing_intervals(shard_key(params), startTime, endTime):
+                gapStart = max(gapStart - overlap, from_epoch(to_epoch(startTime)))
+                jobs += [(params, windowStart, windowEnd) for windowStart, windowEnd in split_windows(gapStart, gapEnd, windowHours)]
+        logger.info(f'Syncing {len(jobs)} missing jobs between {startTime} and {endTime} with {workers} workers')
+        return harvester.run(jobs)
+
+    # Record in the coverage ledger that a time range has been requested and inserted for a station shard.
+    # Ranges overlapping or touching the new one are merged with it.
+    #
+    # @ Param shard - key of the station shard (see harvester.shard_key)
+    # @ Param startTime - start of the time range
+    # @ Param endTime - end of the time range
+    #
+    def record_coverage(self, shard, startTime, endTime):
+        start, end = to_epoch(startTime), to_epoch(endTime)
+        with self.get_connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT MIN(START_EPOCH), MAX(END_EPOCH) FROM Coverage WHERE SHARD = ? AND START_EPOCH <= ? AND END_EPOCH >= ?",
+                      (shard, end, start))
+            minStart, maxEnd = c.fetchone()
+            c.execute("DELETE FROM Coverage WHERE SHARD = ? AND START_EPOCH <= ? AND END_EPOCH >= ?", (shard, end, start))
+            if minStart is not None:
+                start, end = min(start, minStart), max(end, maxEnd)
+            c.execute("INSERT INTO Coverage (SHARD, START_EPOCH, END_EPOCH, FETCHED_UTC) VALUES (?, ?, ?, ?)",
+                      (shard, start, end, dt.datetime.now(dt.timezone.utc).strftime('%Y-%m-%d_%H:%M:%S')))
+            conn.commit()
+
+    # Find the ranges of a time range that are not in the coverage ledger of a station shard
+    #
+    # @ Param shard - key of the station shard (see harvester.shard_key)
+    # @ Param startTime - start of the time range
+    # @ Param endTime - end of the time range
+    #
+    # @ returns a list of (start, end) tuples of naive UTC datetimes
+    #
+    def missing_intervals(self, shard, startTime, endTime):
+        start, end = to_epoch(startTime), to_epoch(endTime)
+        with self.get_connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT START_EPOCH, END_EPOCH FROM Coverage WHERE SHARD = ? AND END_EPOCH > ? AND START_EPOCH < ? ORDER BY START_EPOCH",
+                      (shard, start, end))
+            covered = c.fetchall()
+        gaps = []
+        for coveredStart, coveredEnd in covered:
+            if coveredStart > start:
+                gaps.append((start, coveredStart))
+            start = max(start, coveredEnd)
+        if start < end:
+            gaps.append((start, end))
+        return [(from_epoch(gapStart), from_epoch(gapEnd)) for gapStart, gapEnd in gaps if gapEnd - gapStart >= MIN_GAP_SECONDS]
+
+    # Get the data from Synoptic with a pool of threads, one (time window x station shard) job at a time per thread.
+    # All the data is inserted into the database from the calling thread.
+    #
+    # @ Param workers - number of threads requesting data from Synoptic
+    # @ Param windowHours - length of the time window of each job in hours
+    # @ Param shardSize - maximum number of stations per job (Synoptic can handle 1875 stations pulled at one time)
+    # @ Param maxInFlight - maximum number of jobs fetched and not inserted yet, bounds the memory used
+    # @ Param max_retries - number of times each job is requested before giving up
+    # @ Param backend - 'threads' or 'asyncio' (see Harvester)
+    #
+    # @ returns a dictionary with the number of jobs, failed jobs, rows inserted, seconds and rows per second
+    #
+    def harvest(self, workers=4, windowHours=1, shardSize=1875, maxInFlight=None, max_retries=5, backend='threads'):
         # Get all of the database parameters
         startTime = self.params.get('startDatetime')
         endTime = self.params.get('endDatetime')
-        # If either startTime or endTime are None values, grab the last day's data
+        # If either startTime or endTime are None values, grab the last hour's data
         if startTime is None or endTime is None:
             endTime = dt.datetime.now(dt.timezone.utc)
             startTime = endTime - relativedelta(hours=1)
-        tmpTime = startTime + relativedelta(hours=1)
-        # Get the data from Synoptic 
-        while tmpTime <= endTime:
-            logging.info('Getting data between {} and {}'.format(startTime,tmpTime))
-            startUtc = startTime.strftime('%Y%m%d%H00')
-            endUtc = tmpTime.strftime('%Y%m%d%H00')
-            # Iterate and get all of the data for all of the provided state values
-            try:
-                get_timeseries(self, startUtc, endUtc, max_retries)
-                logging.debug('Finished adding data to database')
-                logging.debug(' ')
-            except Exception as e:
-                logging.warning('get_synData with exception: {}'.format(e))
-            # Update metadata
-            self.update_metadata(tmpTime)
-            # Increment the time by one hour
-            startTime += relativedelta(hours=1)
-            tmpTime += relativedelta(hours=1)
+        harvester = Harvester(self, workers=workers, maxInFlight=maxInFlight, max_retries=max_retries, backend=backend)
+        jobs = harvester.build_jobs(self.params, startTime, endTime, windowHours=windowHours, shardSize=shardSize)
+        logger.info(f'Harvesting {len(jobs)} jobs between {startTime} and {endTime} with {workers} workers')
+        return harvester.run(jobs)
 
-    # Get ALL of the data from the United States from ALL sources
+    # Insert the responses saved in a spool again, without requesting Synoptic. The responses are decompressed and
+    # melted on a pool of processes while the calling thread writes them in time order, and the coverage ledger records
+    # their windows, so a later sync only requests what the spool did not have. The station and network metadata saved
+    # in the spool are written first, so a database created with fetchMetadata=False can be queried without Synoptic.
     #
-    def get_all_synoptic_data(self):
-        # Get all the station IDs in the database
-        allSTIDs = self.find_stids_from_params(None, None, None, None)
-        numOfStids = len(allSTIDs["STID"])
-        i = 0
-        # Run get_synData for all of the available stations in the database
-        # Note: Synoptic can handle 1875 stations pulled at one time 
-        while numOfStids >= 0:
-            self.params['stationIDs'] = allSTIDs["STID"][i:i+1875]
-            self.get_synData()
-            numOfStids=-1875
-            i+=1875
+    # @ Param spool - Spool to replay, the spool of the database by default
+    # @ Param startTime - only replay the responses ending after this datetime, None for no start
+    # @ Param endTime - only replay the responses starting before this datetime, None for no end
+    # @ Param workers - number of processes melting the responses, 1 to do it in this process
+    #
+    # @ returns a dictionary with the number of responses, rows inserted, seconds and rows per second
+    #
+    def replay(self, spool=None, startTime=None, endTime=None, workers=4):
+        spool = spool if spool is not None else self.spool
+        if spool is None:
+            raise ValueError("No spool to replay")
+        entries = spool.entries(to_epoch(startTime) if startTime is not None else None,
+                                to_epoch(endTime) if endTime is not None else None)
+        logger.info(f'Replaying {len(entries)} responses from {spool.folder} with {workers} workers')
+        stationDict, networkDict = spool.load_metadata('stations'), spool.load_metadata('networks')
+        if stationDict is not None and networkDict is not None:
+            self.write_metadata(stationDict, networkDict)
+        else:
+            logger.warning(f"replay - {spool.folder} does not have the station and network metadata, "
+                           "the replayed data can only be queried after refresh_metadata")
+        startClock = time.perf_counter()
+        rows = 0
+        executor = start_process_pool(workers) if workers > 1 and len(entries) > 1 else None
+        try:
+            compacts = melt_spooled_responses(spool.folder, [entry[3] for entry in entries], executor, 2*workers)
+            for (params, start, end, sha), compact in zip(entries, compacts):
+                rows += self.insert_melted(merge_station_chunks([compact]))
+                self.record_coverage(shard_key(params), from_epoch(start), from_epoch(end))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        seconds = time.perf_counter() - startClock
+        logger.info(f'Replayed {len(entries)} responses, {rows} rows in {seconds:.1f} s')
+        return {'responses': len(entries), 'rows': rows, 'seconds': seconds, 'rowsPerSecond': rows/seconds if seconds else 0.}
 
     # Queries the database based on the request parameters provided by the user
     #
     # @returns a dataframe containing all the data the user requested
     #
     def query_db(self):
+        makeFile = self.params.get("makeFile")
+        # Return the cached result if the data of the query did not change since it was cached
+        cacheKey = self.cache_key() if self.cache is not None else None
+        cached = self.cache.get(cacheKey) if cacheKey is not None else None
+        if cached is not None:
+            self.metrics.incr('cache_hits')
+            result, stationDf = cached
+            tableNames = [table for table in ensure_list(self.params.get("vars"))
+                          if f'{table.upper()}_VALUE' in result.columns or f'{table.upper()}_COUNT' in result.columns]
+        else:
+            if cacheKey is not None:
+                self.metrics.incr('cache_misses')
+            # Resolve the tables, stations and time range of the query once
+            tableNames, stids, startDate, endDate = self.resolve_query_params()
+            resolution = self.params.get("resolution")
+            result = None
+            if len(tableNames) and len(stids):
+                with self.metrics.timer('query'):
+                    if resolution is not None:
+                        # Read the pre-aggregated statistics instead of the observations
+                        result = self.query_rollups(tableNames, stids, startDate, endDate, resolution)
+                    else:
+                        # Get all the variables with a single statement and align them on station and datetime
+                        variables, rows = self.query_rows(tableNames, stids, startDate, endDate)
+                        rows = list(rows)
+                        self.metrics.incr('rows_queried', len(rows))
+                        result = pivot_rows(rows, tableNames, variables, epochs=self.layout == "long")
+            if result is None or not len(result):
+                logger.warning("No data was found in the database with the given parameters")
+                return None, None
+            # Get all station data for stations within the query
+            stationDf = self.query_station_data_by_ids(stids)
+            if cacheKey is not None:
+                self.cache.put(cacheKey, result, stationDf)
+        # Create a data and station file if the makeFile parameter is True (csv) or a columnar format ('parquet' or 'arrow')
+        if makeFile:
+            now = dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%d_%H:%M:%S")
+            if makeFile in EXPORT_FORMATS:
+                variableTypes, rollup = self.export_types(tableNames)
+                write_frames([result], f"SYN_{now}.{makeFile}", variableTypes, fileFormat=makeFile, rollup=rollup)
+                write_frames([stationDf], f"SYN_stations_{now}.{makeFile}", None, fileFormat=makeFile)
+            else:
+                result.to_csv(f"SYN_{now}.csv")
+                stationDf.to_csv(f"SYN_stations_{now}.csv",index=False)
+        return result, stationDf
+
+    # Queries the database like query_db, but yields the data in dataframes of bounded size.
+    # The rows are read already sorted by station ID and datetime, so the whole result is never in memory.
+    #
+    # @ Param chunkSize - maximum number of observations read from the database for each dataframe
+    #
+    # @ yields dataframes with the same columns as query_db, in station ID and datetime order
+    #
+    def query_db_iter(self, chunkSize=100000):
+        tableNames, stids, startDate, endDate = self.resolve_query_params()
+        if not len(tableNames) or not len(stids):
+            return
+        # The rollups are small, they are returned in a single dataframe
+        if self.params.get("resolution") is not None:
+            result = self.query_rollups(tableNames, stids, startDate, endDate, self.params.get("resolution"))
+            if result is not None and len(result):
+                yield result
+            return
+        epochs = self.layout == "long"
+        variables, rowIter = self.query_rows(tableNames, stids, startDate, endDate, ordered=True)
+        try:
+            carry = []
+            while True:
+                batch = list(islice(rowIter, chunkSize))
+                if not batch:
+                    break
+                self.metrics.incr('rows_queried', len(batch))
+                rows = carry + batch
+                # A short batch is the last one
+                if len(batch) < chunkSize:
+                    carry = []
+                    yield pivot_rows(rows, tableNames, variables, epochs=epochs)
+                    break
+                # The observations of the last station and datetime could continue in the next chunk
+                last = len(rows)
+                while last > 0 and rows[last-1][1:3] == rows[-1][1:3]:
+                    last -= 1
+                if last == 0:
+                    carry = rows
+                    continue
+                carry = rows[last:]
+                yield pivot_rows(rows[:last], tableNames, variables, epochs=epochs)
+            if carry:
+                yield pivot_rows(carry, tableNames, variables, epochs=epochs)
+        finally:
+            rowIter.close()
+
+    # Query the numeric variables as a dense station x time x variable cube on a regular time grid. Each cell holds the
+    # observation closest to its grid time within the tolerance. The rows are read sorted from the cursor and snapped
+    # to the cube a few whole stations at a time, without building dataframes.
+    #
+    # @ Param step - timedelta or seconds between the grid times, the grid starts at startDatetime and ends at or before endDatetime
+    # @ Param tolerance - timedelta or seconds between an observation and its grid time, half the step by default
+    # @ Param path - .npy file where the values are memory mapped (the mask is in <path>_mask.npy), None to keep the cube in memory
+    # @ Param dtype - type of the values
+    # @ Param chunkSize - number of observations read from the database at once
+    #
+    # @ returns a dictionary with 'values' (stations x times x variables, NaN where there is no observation), 'mask'
+    #   (True where a cell has an observation), 'stids', 'times' (datetime64[s]), 'variables' and 'units' (one per variable)
+    #
+    def query_cube(self, step, tolerance=None, path=None, dtype=np.float64, chunkSize=100000):
+        tableNames, stids, startDate, endDate = self.resolve_query_params()
+        step = to_seconds(step)
+        tolerance = step // 2 if tolerance is None else to_seconds(tolerance)
+        if step <= 0:
+            raise SynopticError("The step of the cube must be positive")
+        # Text variables do not fit in a numeric cube
+        variableTypes = self.variable_types(tableNames)
+        for table in tableNames:
+            if variableTypes[table] == 'TEXT':
+                logger.warning(f"Variable '{table}' has text values and is not in the cube")
+        tableNames = [table for table in tableNames if variableTypes[table] != 'TEXT']
+        stids = sorted(stids)
+        start = to_epoch(startDate)
+        numTimes = (to_epoch(endDate) - start) // step + 1 if endDate >= startDate else 0
+        shape = (len(stids), numTimes, len(tableNames))
+        if path is not None:
+            from numpy.lib.format import open_memmap
+            values = open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+            mask = open_memmap(f"{osp.splitext(path)[0]}_mask.npy", mode='w+', dtype=bool, shape=shape)
+            # Fill the file a few stations at a time, so the cube never has to fit in memory
+            slab = max(1, (64*1024**2) // max(1, numTimes*len(tableNames)*values.itemsize))
+            for i in range(0, len(stids), slab):
+                values[i:i+slab] = np.nan
+        else:
+            values = np.full(shape, np.nan, dtype=dtype)
+            mask = np.zeros(shape, dtype=bool)
+        units = [None]*len(tableNames)
+        if all(shape):
+            stationIndex = pd.Index(stids)
+            epochs = self.layout == "long"
+            # Observations up to the tolerance outside the time range snap to the first and last grid times
+            queryStart, queryEnd = from_epoch(start - tolerance), from_epoch(start + (numTimes-1)*step + tolerance)
+            with self.metrics.timer('query'):
+                variables, rowIter = self.query_rows(tableNames, stids, queryStart, queryEnd, ordered=True)
+                lookup = np.full(max(variables, default=0) + 1, -1, dtype=np.int64)
+                lookup[list(variables)] = [index for index, _ in variables.values()]
+                for index, unit in variables.values():
+                    units[index] = units[index] or unit
+                try:
+                    carry = []
+                    while True:
+                        batch = list(islice(rowIter, chunkSize))
+                        self.metrics.incr('rows_queried', len(batch))
+                        rows = carry + batch
+                        # The candidates of a cell are all in one block when the blocks hold whole stations
+                        last = len(rows)
+                        if len(batch) == chunkSize:
+                            while last > 0 and rows[last-1][1] == rows[-1][1]:
+                                last -= 1
+                            if last == 0:
+                                carry = rows
+                                continue
+                        if last:
+                            snap_rows(rows[:last], values, mask, units, stationIndex, lookup, start, step, tolerance, epochs=epochs)
+                        carry = rows[last:]
+                        if len(batch) < chunkSize:
+                            break
+                finally:
+                    rowIter.close()
+        if path is not None:
+            values.flush()
+            mask.flush()
+        times = (start + step*np.arange(numTimes, dtype=np.int64)).astype('datetime64[s]')
+        return {'values': values, 'mask': mask, 'stids': stids, 'times': times, 'variables': tableNames, 'units': units}
+
+    # Query the rollups of the variables for the stations and time range
+    #
+    # @ Param tableNames - list of variables in the database
+    # @ Param stids - list of station ids
+    # @ Param startDate - start datetime of the query, the bucket holding it is the first one returned
+    # @ Param endDate - end datetime of the query
+    # @ Param resolution - resolution of the rollups ('hour' or 'day')
+    #
+    # @returns a dataframe with STID, DATETIME (start of the bucket) and the MIN, MAX, MEAN, COUNT and UNITS of each variable
+    #
+    def query_rollups(self, tableNames, stids, startDate, endDate, resolution):
+        if resolution not in ROLLUP_RESOLUTIONS:
+            raise SynopticError(f"Unknown resolution {resolution}. Pick one from {list(ROLLUP_RESOLUTIONS)}")
+        seconds = ROLLUP_RESOLUTIONS[resolution]
+        with self.get_connection() as conn:
+            rows = conn.execute('''SELECT VARIABLE, STID, BUCKET, MIN, MAX, SUM, COUNT, UNITS FROM Rollups
+                    WHERE RESOLUTION = ? AND VARIABLE IN (SELECT value FROM json_each(?)) AND STID IN (SELECT value FROM json_each(?))
+                    AND BUCKET BETWEEN ? AND ?''', (resolution, json.dumps(tableNames), json.dumps(stids),
+                    to_epoch(startDate) // seconds * seconds, to_epoch(endDate))).fetchall()
+        if not rows:
+            return None
+        df = pd.DataFrame(rows, columns=['VARIABLE', 'STID', 'BUCKET', 'MIN', 'MAX', 'SUM', 'COUNT', 'UNITS'])
+        df['MEAN'] = df['SUM'] / df['COUNT']
+        wide = df.pivot(index=['STID', 'BUCKET'], columns='VARIABLE', values=ROLLUP_STATS)
+        columns = [(stat, table) for table in tableNames for stat in ROLLUP_STATS if (stat, table) in wide.columns]
+        result = wide[columns]
+        result.columns = [f'{(table).upper()}_{stat}' for stat, table in columns]
+        result = result.reset_index()
+        result.insert(1, 'DATETIME', pd.to_datetime(result.pop('BUCKET'), unit='s'))
+        return result.infer_objects()
+
+    # Run the query of the variables, stations and time range on the database, or on the partitions overlapping the time range
+    #
+    # @ Param tableNames - list of variables in the database
+    # @ Param stids - list of station ids
+    # @ Param startDate - start datetime of the query
+    # @ Param endDate - end datetime of the query
+    # @ Param ordered - sort the rows by station id and datetime
+    #
+    # @returns a tuple (dictionary of variable code -> (index in tableNames, units), generator of rows), see build_query_sql
+    #
+    def query_rows(self, tableNames, stids, startDate, endDate, ordered=False):
+        if self.partition is None:
+            query, args, variables = self.build_query_sql(tableNames, stids, startDate, endDate, ordered=ordered)
+            return variables, self.iter_rows([(None, query, args)], ordered)
+        partitions = self.find_partitions(tableNames, startDate, endDate)
+        names = sorted(partitions)
+        statements = []
+        variables = {}
+        # A connection can only attach a few databases, so the partitions are queried in groups
+        for i in range(0, len(names), MAX_ATTACHED):
+            group = names[i:i+MAX_ATTACHED]
+            query, args, variables = self.build_query_sql(tableNames, stids, startDate, endDate, ordered=ordered,
+                                                          partitions={name: partitions[name] for name in group})
+            statements.append((group, query, args))
+        return variables, self.iter_rows(statements, ordered)
+
+    # Generator running the statements and yielding their rows
+    #
+    # @ Param statements - list of (partitions to attach or None, SQL statement, named parameters)
+    # @ Param ordered - the rows of each statement are sorted by station id and datetime, and are merged keeping that order
+    #
+    def iter_rows(self, statements, ordered=False):
+        connections = []
+        cursors = []
+        try:
+            for partitions, query, args in statements:
+                if partitions is None:
+                    # Use a cursor of its own, so the connection can be used while the generator is suspended
+                    conn = self.get_connection()
+                else:
+                    conn = self.open_connection(partitions)
+                    connections.append(conn)
+                cursors.append(conn.cursor().execute(query, args))
+            if ordered and len(cursors) > 1:
+                # The partitions do not overlap in time, so no station and datetime is split between the statements
+                yield from heapq.merge(*cursors, key=itemgetter(1, 2))
+            else:
+                for c in cursors:
+                    yield from c
+        finally:
+            for c in cursors:
+                c.close()
+            for conn in connections:
+                conn.close()
+
+    # Find the partitions overlapping a time range and the tables of the variables in each of them
+    #
+    # @ Param tableNames - list of variables in the database
+    # @ Param startDate - start datetime of the query
+    # @ Param endDate - end datetime of the query
+    #
+    # @returns a dictionary with the partition name as key and the list of tables as value
+    #
+    def find_partitions(self, tableNames, startDate, endDate):
+        tables = ['Observations'] if self.layout == "long" else tableNames
+        partitions = {}
+        with self.get_connection() as conn:
+            for name, table in conn.execute('''SELECT NAME, TABLE_NAME FROM Partitions
+                    WHERE END_EPOCH > ? AND START_EPOCH <= ? AND TABLE_NAME IN (SELECT value FROM json_each(?))
+                    ORDER BY NAME''', (to_epoch(startDate), to_epoch(endDate), json.dumps(tables))):
+                partitions.setdefault(name, []).append(table)
+        return partitions
+
+    # Delete the partitions whose period ends before a datetime. Dropping old data is removing its files.
+    # The coverage ledger is trimmed as well, so the dropped ranges can be requested again.
+    #
+    # @ Param before - datetime, the partitions ending before it are deleted
+    #
+    # @returns the list of partition names deleted
+    #
+    def drop_partitions(self, before):
+        if self.partition is None:
+            raise SynopticError("The database is not partitioned")
+        cutoff = to_epoch(before)
+        with self.get_connection() as conn:
+            c = conn.cursor()
+            rows = c.execute("SELECT NAME, MAX(END_EPOCH) FROM Partitions WHERE END_EPOCH <= ? GROUP BY NAME ORDER BY NAME", (cutoff,)).fetchall()
+            names = [row[0] for row in rows]
+            if names:
+                # Only the data up to the end of the last partition deleted is gone
+                droppedEnd = max(row[1] for row in rows)
+                c.execute("DELETE FROM Partitions WHERE END_EPOCH <= ?", (cutoff,))
+                c.execute("DELETE FROM Coverage WHERE END_EPOCH <= ?", (droppedEnd,))
+                c.execute("UPDATE Coverage SET START_EPOCH = ? WHERE START_EPOCH < ? AND END_EPOCH > ?", (droppedEnd, droppedEnd, droppedEnd))
+                c.execute("UPDATE DataVersions SET VERSION = ? WHERE DAY < ?", (self.next_version(c), -(-droppedEnd // 86400)))
+                conn.commit()
+        for name in names:
+            path = self.partition_path(name)
+            for filePath in [path, path + '-wal', path + '-shm']:
+                if osp.exists(filePath):
+                    os.remove(filePath)
+            logger.info(f"Dropped partition {name}")
+        return names
+
+    # Stream the result of the query to a sink without holding the whole result in memory
+    #
+    # @ Param sink - path of a csv file, or a function called with each dataframe
+    # @ Param chunkSize - maximum number of observations read from the database for each dataframe
+    #
+    # @ returns the number of rows written
+    #
+    def stream_query(self, sink, chunkSize=100000):
+        numRows = 0
+        for chunk in self.query_db_iter(chunkSize):
+            if callable(sink):
+                sink(chunk)
+            else:
+                chunk.to_csv(sink, mode='w' if numRows == 0 else 'a', header=numRows == 0, index=False)
+            numRows += len(chunk)
+        return numRows
+
+    # Export the result of the query to Parquet or Arrow IPC files without holding the whole result in memory
+    #
+    # @ Param path - output file, or output directory if the data is partitioned
+    # @ Param fileFormat - 'parquet' or 'arrow'
+    # @ Param partitionBy - list of partitions ('variable' and/or 'date'), or None for a single file with the columns of query_db
+    # @ Param chunkSize - maximum number of observations read from the database for each dataframe
+    # @ Param compression - compression codec of the files
+    #
+    # @ returns the number of rows written
+    #
+    def export_query(self, path, fileFormat='parquet', partitionBy=('variable', 'date'), chunkSize=100000, compression='zstd'):
+        tableNames, stids, _, _ = self.resolve_query_params()
+        variableTypes, rollup = self.export_types(tableNames)
+        numRows = write_frames(self.query_db_iter(chunkSize), path, variableTypes,
+                               fileFormat=fileFormat, partitionBy=partitionBy, compression=compression, rollup=rollup)
+        # Station metadata next to the data. Files starting with an underscore are skipped when reading the dataset
+        stationDf = self.query_station_data_by_ids(stids)
+        if len(stationDf):
+            stationPath = osp.join(path, f"_stations.{fileFormat}") if partitionBy else f"{osp.splitext(path)[0]}_stations.{fileFormat}"
+            write_frames([stationDf], stationPath, None, fileFormat=fileFormat, compression=compression)
+        return numRows
+
+    # Get the type of the variables in the dataframes of the query. With a resolution the dataframes have the rollups,
+    # which only exist for the numeric variables
+    #
+    # @ Param tableNames - list of variables in the database
+    #
+    # @ returns a tuple (dictionary of variable name -> 'REAL' or 'TEXT', True if the dataframes have the rollups)
+    #
+    def export_types(self, tableNames):
+        variableTypes = self.variable_types(tableNames)
+        if self.params.get("resolution") is None:
+            return variableTypes, False
+        return {variable: thisType for variable, thisType in variableTypes.items() if thisType == "REAL"}, True
+
+    # Get the type of the values of each variable
+    #
+    # @ Param tableNames - list of variables in the database
+    #
+    # @ returns a dictionary of variable name -> 'REAL' or 'TEXT', in the order of tableNames
+    #
+    def variable_types(self, tableNames):
+        variableTypes = {}
+        textVariables = self.text_variables()
+        for table in tableNames:
+            if table in textVariables:
+                variableTypes[table] = 'TEXT'
+                continue
+            conn, schema = self.get_connection(), "main"
+            if self.partition is not None:
+                # Look into the most recent partition holding the variable
+                row = conn.execute("SELECT MAX(NAME) FROM Partitions WHERE TABLE_NAME = ?",
+                                   ("Observations" if self.layout == "long" else table,)).fetchone()
+                if row[0] is not None:
+                    conn, schema = self.open_connection([row[0]]), f"p_{row[0]}"
+            try:
+                if self.layout == "long":
+                    row = conn.execute(f'''SELECT typeof(o.VALUE) FROM Variables v JOIN {schema}.Observations o ON o.VARIABLE_ID = v.VARIABLE_ID
+                                       WHERE v.VARIABLE = ? LIMIT 1''', (table,)).fetchone()
+                    thisType = row[0] if row else 'real'
+                else:
+                    thisType = next((column[2] for column in conn.execute(f"PRAGMA {schema}.table_info({table})") if column[1] == "VALUE"), 'REAL')
+            finally:
+                if schema != "main":
+                    conn.close()
+            variableTypes[table] = 'TEXT' if thisType.upper() == 'TEXT' else 'REAL'
+        return variableTypes
+
+    # Resolve the query parameters into the tables, station ids and time range to query
+    #
+    # @returns a tuple (list of existing table names, list of station ids, start datetime, end datetime)
+    #
+    def resolve_query_params(self):
         # Query parameters. Also ensures the values are in list format if they are needed in said format
         tableNames = ensure_list(self.params.get("vars"))
         stationIDs = self.params.get("stationIDs")
@@ -266,59 +1678,111 @@ class SynopticDB(object):
         maxLat = self.params.get("maxLatitude")
         minLon = self.params.get("minLongitude")
         maxLon = self.params.get("maxLongitude")
-        startDate = self.params.get("startDatetime").strftime("%Y-%m-%d %H:%M:%S")
-        endDate = self.params.get("endDatetime").strftime("%Y-%m-%d %H:%M:%S")
-        makeFile = self.params.get("makeFile")
         bbox = [minLat, maxLat, minLon, maxLon]
-        with sqlite3.connect(self.dbPath) as conn:
-            # Create a cursor object to execute SQL queries
-            c = conn.cursor()
-            # Check if tableNames parameter is provided and if the tables are available in the database
-            if not len(tableNames):
-                logging.error("No table names provided. Pick from available tables below:")
-                self.list_table_names()
-                raise SynopticError("No table names provided")
-            # Define a dictionary to store dataframes for each table
-            dfs = {}
-            # List of station ids in the table that can be queired
-            availStids = []
-            for table in tableNames:
-                c.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
-                if c.fetchone() is None:
-                    logging.warning(f"Table '{table}' does not exist in the database.")
-                    continue
-                # Get the station ids in the database that the user requests
-                stids = self.find_stids_from_params(stationIDs, networks, bbox, state)
-                # This variable will be used later to generate a csv of all of the station information requested
-                availStids += stids
-                # Check if either startDate or endDate are None values, grab the last day's data
-                if startDate is None or endDate is None:
-                    currDate = dt.datetime.now(dt.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
-                    startDate = (currDate - timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
-                    endDate = currDate.strftime("%Y-%m-%d %H:%M:%S")
-                # Query data from the table and stids within startDate and endDate
-                query = f"SELECT * FROM {table} WHERE STID IN ({','.join('?'*len(stids))}) AND DATETIME BETWEEN ? AND ?"
-                c.execute(query, stids + [startDate, endDate])
-                rows = c.fetchall()
-                if len(rows) > 0:
-                    df = pd.DataFrame(rows, columns=['STID', 'DATETIME', f'{(table).upper()}_VALUE', f'{(table).upper()}_UNITS'])
-                    # Store the dataframe in the dictionary with the table name as the key
-                    dfs[table] = df
-        # Merge dataframes from different tables
-        result = self.merge_dataframes(dfs)
-        if not isinstance(result, pd.DataFrame):
-            logging.warning("No data was found in the database with the given parameters")
-            return None, None
-        if len(result)>0:
-            result = self.sort_dataframe(result)
-        # Get all station data for stations within the query
-        stationDf = self.query_station_data_by_ids(availStids)
-        # Create a data and station file if the makeFile parameter is True
-        if makeFile:
-            now = dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%d_%H:%M:%S")
-            result.to_csv(f"SYN_{now}.csv")
-            stationDf.to_csv(f"SYN_stations_{now}.csv",index=False)
-        return result, stationDf
+        # Check if tableNames parameter is provided and if the tables are available in the database
+        if not len(tableNames):
+            logger.error("No table names provided. Pick from available tables below:")
+            self.list_table_names()
+            raise SynopticError("No table names provided")
+        storedVars = self.stored_variables()
+        # The table could have been created by another process since the catalog was cached
+        if not set(tableNames) <= storedVars:
+            storedVars = self.stored_variables(refresh=True)
+        for table in tableNames:
+            if table not in storedVars:
+                logger.warning(f"Table '{table}' does not exist in the database.")
+        tableNames = [table for table in tableNames if table in storedVars]
+        # Get the station ids in the database that the user requests
+        stids = self.find_stids_from_params(stationIDs, networks, bbox, state)
+        startDate, endDate = self.query_range()
+        return tableNames, stids, startDate, endDate
+
+    # Time range of the query
+    #
+    # @ returns a tuple (startDate, endDate), the last day if the parameters do not have both
+    #
+    def query_range(self):
+        startDate = self.params.get("startDatetime")
+        endDate = self.params.get("endDatetime")
+        # Check if either startDate or endDate are None values, grab the last day's data
+        if startDate is None or endDate is None:
+            endDate = dt.datetime.now(dt.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+            startDate = endDate - timedelta(days=1)
+        return startDate, endDate
+
+    # Key of the query in the cache: the query parameters (without makeFile), the version of the data of the variables
+    # and days of the query, and the version of the station metadata
+    #
+    # @ returns a hexadecimal hash, None if the results can not be cached
+    #
+    def cache_key(self):
+        # Databases written before the data versions (opened read-only) can not tell when a result is stale
+        if "DataVersions" not in self.list_table_names():
+            return None
+        params = {key: value for key, value in self.params.items() if key != "makeFile"}
+        # The order of the stations, networks and states does not change the result
+        for key in ["stationIDs", "networks", "states"]:
+            if isinstance(params.get(key), list):
+                params[key] = sorted(str(value) for value in params[key])
+        startDate, endDate = self.query_range()
+        params["startDatetime"], params["endDatetime"] = startDate, endDate
+        with self.get_connection() as conn:
+            dataVersion = conn.execute('''SELECT MAX(VERSION) FROM DataVersions
+                    WHERE VARIABLE IN (SELECT value FROM json_each(?)) AND DAY BETWEEN ? AND ?''',
+                    (json.dumps(ensure_list(params.get("vars"))), to_epoch(startDate) // 86400, to_epoch(endDate) // 86400)).fetchone()[0]
+            metadataVersion = conn.execute("SELECT value FROM Metadata WHERE key = 'metadata_version'").fetchone()
+        key = [self.dbPath, params, dataVersion, metadataVersion[0] if metadataVersion is not None else None]
+        return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+    # Build a single SQL statement that gets all the variables of the query, tagged with a variable code
+    #
+    # @ Param tableNames - list of variables in the database
+    # @ Param stids - list of station ids
+    # @ Param startDate - start datetime of the query
+    # @ Param endDate - end datetime of the query
+    # @ Param ordered - sort the rows by station id and datetime in the database
+    # @ Param partitions - dictionary of attached partition name -> list of its tables to read from, None for the main database
+    #
+    # @returns a tuple (SQL statement, named parameters, dictionary of variable code -> (index in tableNames, units)).
+    #   The rows are (code, STID, DATETIME, VALUE, UNITS) for the tables layout and (code, STID, EPOCH, VALUE) for the long layout
+    #
+    def build_query_sql(self, tableNames, stids, startDate, endDate, ordered=False, partitions=None):
+        # The station ids are sent as a single JSON parameter, so there is no limit on the number of stations
+        args = {'stations': json.dumps(stids)}
+        textVariables = self.text_variables()
+        if self.layout == "long":
+            args.update({'start': to_epoch(startDate), 'end': to_epoch(endDate)})
+            # Resolve the variable ids first so the primary key of the observations is used for the whole search
+            variables = {}
+            with self.get_connection() as conn:
+                for variable, unit, variableId in conn.execute("SELECT VARIABLE, UNITS, VARIABLE_ID FROM Variables"):
+                    if variable in tableNames:
+                        variables[variableId] = (tableNames.index(variable), unit)
+            sources = ["Observations"] if partitions is None else [f"p_{name}.Observations" for name in partitions]
+            # The values of the dictionary encoded text variables are read from the dictionary
+            textIds = [variableId for variableId, (index, _) in variables.items() if tableNames[index] in textVariables]
+            value = f"CASE WHEN o.VARIABLE_ID IN ({','.join(map(str, textIds))}) THEN (SELECT s.VALUE FROM main.TextValues s WHERE s.TEXT_ID = o.VALUE) ELSE o.VALUE END" \
+                if textIds else "o.VALUE"
+            query = ' UNION ALL '.join(f'''SELECT o.VARIABLE_ID, k.STID, o.EPOCH, {value} AS VALUE
+                    FROM StationKeys k JOIN {source} o ON o.STATION_ID = k.STATION_ID
+                    WHERE k.STID IN (SELECT value FROM json_each(:stations))
+                    AND o.VARIABLE_ID IN ({','.join(str(variableId) for variableId in variables)})
+                    AND o.EPOCH BETWEEN :start AND :end''' for source in sources)
+            if ordered:
+                query += " ORDER BY STID, EPOCH"
+            return query, args, variables
+        args.update({'start': startDate.strftime("%Y-%m-%d %H:%M:%S"), 'end': endDate.strftime("%Y-%m-%d %H:%M:%S")})
+        condition = "STID IN (SELECT value FROM json_each(:stations)) AND DATETIME BETWEEN :start AND :end"
+        if partitions is None:
+            sources = list(enumerate(tableNames))
+        else:
+            sources = [(tableNames.index(table), f"p_{name}.{table}") for name, tables in partitions.items() for table in tables]
+        query = ' UNION ALL '.join(f"SELECT {i} AS VAR, STID, DATETIME, s.VALUE AS VALUE, UNITS FROM {table} t JOIN main.TextValues s ON s.TEXT_ID = t.VALUE WHERE {condition}"
+                                   if tableNames[i] in textVariables else f"SELECT {i} AS VAR, STID, DATETIME, VALUE, UNITS FROM {table} WHERE {condition}"
+                                   for i, table in sources)
+        if ordered:
+            query += " ORDER BY STID, DATETIME"
+        return query, args, {i: (i, None) for i in range(len(tableNames))}
 
     # Finds all of the station ids that match with the parameters
     #
@@ -333,7 +1797,7 @@ class SynopticDB(object):
         bbox = ensure_list(bbox)
         states = ensure_list(states)
         # Open connection to SQLite database
-        with sqlite3.connect(self.dbPath) as conn:
+        with self.get_connection() as conn:
             c = conn.cursor()
             # Build the SQL query based on the provided parameters
             query = "SELECT STID FROM Stations"
@@ -342,8 +1806,9 @@ class SynopticDB(object):
             # These if statements look to see if any of the user query parameters have been provided
             # Note: queryParams uses extend as the sqlite database expects a flat list of values
             if len(stationIDs):
-                conditions.append(f"STID IN ({','.join(['?']*len(stationIDs))})")
-                queryParams.extend(stationIDs)
+                # A single JSON parameter, so any number of stations can be requested
+                conditions.append("STID IN (SELECT value FROM json_each(?))")
+                queryParams.append(json.dumps([str(stid) for stid in stationIDs]))
             if len(networks):
                 conditions.append("NETWORK_ID IN ({})".format(','.join(['?']*len(networks))))
                 queryParams.extend(networks)
@@ -362,22 +1827,54 @@ class SynopticDB(object):
             #stids = c.execute(query, queryParams).fetchall()
             return stids
 
-    # Merge all of the dataframes from the query function into a single dataframe
+    # Returns the spatial index of the station locations, building it from the Stations table the first time it is requested
     #
-    # @param dfs - list of dataframes from query function
+    # @ Param refresh - rebuild the index from the Stations table
     #
-    # @returns a single dataframe
+    def spatial_index(self, refresh=False):
+        if self._spatialIndex is None or refresh:
+            with self.get_connection() as conn:
+                rows = conn.execute('''SELECT STID, LATITUDE, LONGITUDE, NETWORK_ID FROM Stations
+                                    WHERE LATITUDE IS NOT NULL AND LONGITUDE IS NOT NULL''').fetchall()
+            stids, lats, lons, networks = zip(*rows) if rows else ([], [], [], [])
+            self._spatialIndex = StationIndex(stids, lats, lons, networks)
+            logger.debug(f"Built a spatial index of {len(self._spatialIndex)} stations")
+        return self._spatialIndex
+
+    # Finds the station ids within a distance of one or many points
     #
-    def merge_dataframes(self, dfs):
-        if not dfs:
-            return None
-        # Initialize the result dataframe with the first table's data
-        result = dfs.popitem()[1]
-        for table, df in dfs.items():
-            # Merge dataframes based on 'stid' and 'datetime' columns, handling NaN values
-            result = pd.merge(result, df, on=['stid', 'datetime'], how='outer', suffixes=('', f'_{table}'))
-        return result
-    
+    # @param lats - latitude or array of latitudes in degrees
+    # @param lons - longitude or array of longitudes in degrees
+    # @param radiusKm - great circle distance in km
+    # @param networks - network id or list of network ids, None for all the networks
+    #
+    # @returns a list of station ids sorted by distance, or a list of those lists for an array of points
+    #
+    def stations_within(self, lats, lons, radiusKm, networks=None):
+        return self.spatial_index().within(lats, lons, radiusKm, networks)
+
+    # Finds the k nearest station ids of one or many points
+    #
+    # @param lats - latitude or array of latitudes in degrees
+    # @param lons - longitude or array of longitudes in degrees
+    # @param k - number of stations per point
+    # @param networks - network id or list of network ids, None for all the networks
+    #
+    # @returns a tuple (station ids, distances in km) of shape (k,) for a single point or (number of points, k)
+    #
+    def nearest_stations(self, lats, lons, k=1, networks=None):
+        return self.spatial_index().nearest(lats, lons, k, networks)
+
+    # Finds the station ids inside a polygon
+    #
+    # @param polygon - list of (latitude, longitude) vertices
+    # @param networks - network id or list of network ids, None for all the networks
+    #
+    # @returns a list of station ids
+    #
+    def stations_in_polygon(self, polygon, networks=None):
+        return self.spatial_index().in_polygon(polygon, networks)
+
     # Returns a dataframe with all of the station data requested
     #
     # @param stationIDs - list of station ids 
@@ -386,13 +1883,13 @@ class SynopticDB(object):
     #
     def query_station_data_by_ids(self,stationIDs):
         # Open connection to SQLite database
-        with sqlite3.connect(self.dbPath) as conn:
+        with self.get_connection() as conn:
             # Create a cursor object to execute SQL queries
             c = conn.cursor()
             # Construct the SQL query to fetch data for the specified station IDs
-            query = f"SELECT * FROM Stations WHERE STID IN ({','.join(['?']*len(stationIDs))})"
-            # Execute the query with the list of station IDs as parameters
-            c.execute(query, stationIDs)
+            query = "SELECT * FROM Stations WHERE STID IN (SELECT value FROM json_each(?))"
+            # Execute the query with the list of station IDs as a single JSON parameter
+            c.execute(query, (json.dumps(list(stationIDs)),))
             # Fetch all the data rows
             data = c.fetchall()
             # Create a DataFrame from the fetched data
@@ -402,29 +1899,77 @@ class SynopticDB(object):
 
     # Returns a list of all table names in the database
     #
-    def list_table_names(self):
-        # Connect to the SQLite database
-        with sqlite3.connect(self.dbPath) as conn:
-            # Get a cursor object
+    # @ Param refresh - read the table names from the database instead of using the cached catalog
+    #
+    def list_table_names(self, refresh=False):
+        if refresh or self._tableNames is None:
+            # Connect to the SQLite database
+            with self.get_connection() as conn:
+                # Get a cursor object
+                c = conn.cursor()
+                # Query the SQLite master table for all table names
+                c.execute("SELECT name FROM sqlite_master WHERE type='table';")
+                # Fetch all the table names and store them in a list
+                self._tableNames = [row[0] for row in c.fetchall()]
+        # Return the list of table names
+        return list(self._tableNames)
+
+    # Returns a list of the tables that hold the observations of one variable (tables layout)
+    #
+    def list_variable_tables(self):
+        return [table for table in self.list_table_names() if table not in META_TABLES]
+
+    # Migrate a database from one table per variable to the long layout
+    #
+    # Each variable table is copied and dropped in its own transaction, so an interrupted migration can be run again
+    #
+    # @ Param vacuum - rebuild the database file at the end to give back the space of the dropped tables
+    #
+    def migrate_to_long_layout(self, vacuum=True):
+        if self.layout == "long":
+            logger.info("The database already uses the long layout")
+            return
+        if self.partition is not None:
+            raise SynopticError("Partitioned databases can not be migrated to the long layout")
+        variableTables = self.list_variable_tables()
+        with self.get_connection() as conn:
             c = conn.cursor()
-            # Query the SQLite master table for all table names
-            c.execute("SELECT name FROM sqlite_master WHERE type='table';")
-            # Fetch all the table names and store them in a list
-            tableNames = [row[0] for row in c.fetchall()]
-            # Return the list of table names
-            return tableNames
-    
+            self.create_long_tables(c)
+            conn.commit()
+            self._tableNames = None
+            for count, table in enumerate(variableTables):
+                logger.info(f"Migrating {table} ({count+1} / {len(variableTables)})")
+                if not conn.in_transaction:
+                    c.execute("BEGIN")
+                c.execute(f"INSERT OR IGNORE INTO StationKeys (STID) SELECT DISTINCT STID FROM {table}")
+                c.execute(f"SELECT DISTINCT UNITS FROM {table}")
+                self.variable_keys(c, {(table, unit) for (unit,) in c.fetchall()})
+                c.execute(f'''INSERT OR IGNORE INTO Observations (STATION_ID, VARIABLE_ID, EPOCH, VALUE)
+                        SELECT k.STATION_ID, v.VARIABLE_ID, CAST(strftime('%s', t.DATETIME) AS INTEGER), t.VALUE
+                        FROM {table} t JOIN StationKeys k ON k.STID = t.STID JOIN Variables v ON v.VARIABLE = ? AND v.UNITS IS t.UNITS''', (table,))
+                c.execute(f"DROP TABLE {table}")
+                conn.commit()
+                self._tableNames = None
+            c.execute("INSERT OR REPLACE INTO Metadata (key, value) VALUES (?, ?)", ("layout", "long"))
+            conn.commit()
+        self.layout = "long"
+        if vacuum:
+            logger.info("Vacuuming the database")
+            with self.get_connection() as conn:
+                conn.execute("VACUUM")
+
     # Check the contents of one of a table within the database
     #
     # @ Param tableName - the name of the table to be requested
+    # @ Param chunkSize - if provided, the table is read in dataframes of chunkSize rows
     #
-    # @ returns a dataframe of all the data from the requested table
+    # @ returns a dataframe of all the data from the requested table, or an iterator of dataframes if chunkSize is provided
     #
-    def check_table(self, tableName):
+    def check_table(self, tableName, chunkSize=None):
         tables = self.list_table_names()
         if tableName in tables:
             # create a connection to the mesoDB database
-            with sqlite3.connect(self.dbPath) as conn:
+            with self.get_connection() as conn:
                 if tableName == 'Metadata':
                     c = conn.cursor()
                     c.execute("SELECT key, value FROM metadata")
@@ -432,63 +1977,59 @@ class SynopticDB(object):
                     return rows
                 # define the SQL query to select the variables from a given table
                 query = f"SELECT * FROM {tableName}"
-                # execute the query and store the results in a pandas dataframe
-                dfTable = pd.read_sql_query(query, conn)
-                invalidTables = ['Networks', 'Stations']
-                if tableName not in invalidTables:
-                    dfTable = self.sort_dataframe(dfTable)
-                return dfTable
+                # Dictionary encoded text variables are read with their strings
+                if tableName in self.text_variables():
+                    query = f"SELECT t.STID, t.DATETIME, s.VALUE, t.UNITS FROM {tableName} t JOIN TextValues s ON s.TEXT_ID = t.VALUE"
+                # Variable tables are sorted by station ID and datetime, served by their unique index
+                if tableName not in META_TABLES:
+                    query += " ORDER BY STID, DATETIME"
+                # execute the query and store the results in a pandas dataframe (or an iterator of dataframes of chunkSize rows)
+                return pd.read_sql_query(query, conn, chunksize=chunkSize)
         else:
             SynopticError("The table provided is not in the database")
 
-    # Sort the given dataframe by station ID and then by datetime
-    #
-    # @ returns a dataframe sorted by station ID and datetime
-    #
-    def sort_dataframe(self,df):
-        sortedDf = df.sort_values(by=["STID", "DATETIME"], ignore_index=True)
-        return sortedDf
-
     # Remove a table from the database
     #
     # @param tableName - name of the table to be removed
     #
     def remove_table(self,tableName):
-        logging.info("Are you sure you want to delete the table?")
+        logger.info("Are you sure you want to delete the table?")
         userInput = input("Enter y or n: ")
         while userInput != "y" or userInput != "n":
             userInput = input("Enter y or n: ")
         if userInput == "y":
             # Connect to the SQLite database
-            with sqlite3.connect(self.dbPath) as conn:
+            with self.get_connection() as conn:
                 # Create a cursor object to interact with the database
                 c = conn.cursor()
                 # Specify the name of the table you want to delete
                 tableName = tableName
                 # Execute the DROP TABLE statement
                 c.execute(f'DROP TABLE IF EXISTS {tableName}')
+                c.execute("UPDATE DataVersions SET VERSION = ? WHERE VARIABLE = ?", (self.next_version(c), tableName))
                 # Commit the changes to the database
                 conn.commit()
+                self._tableNames = None
     
-    # Update metadata for last modified
+    # Update metadata for last modified, once per harvest or sync run
+    #
+    # @ Param utcTime - end of the newest time window inserted, last_get_data_utc only moves forward
     #
     def update_metadata(self, utcTime):
-        logging.info(f'Updating metadata {utcTime}')
-        metadata = dict(self.check_table('Metadata'))
-        with sqlite3.connect(self.dbPath) as conn:
+        logger.info(f'Updating metadata {utcTime}')
+        utcTime = utcTime.astimezone(dt.timezone.utc).replace(tzinfo=None) if utcTime.tzinfo is not None else utcTime
+        with self.get_connection() as conn:
              # Create a cursor object to interact with the database
              c = conn.cursor()
              # Update the last updated
              c.execute("INSERT OR REPLACE INTO Metadata (key, value) VALUES (?, ?)",
                  ("last_updated_utc", dt.datetime.now(dt.timezone.utc).strftime('%Y-%m-%d_%H:%M:%S')))
              # Update the last data time
-             last_get_data_utc = metadata.get('last_get_data_utc')
-             if last_get_data_utc is not None:
-                 last_get_data_utc = dt.datetime.strptime(last_get_data_utc, '%Y-%m-%d_%H:%M:%S')
-                 last_get_data_utc = max(last_get_data_utc, utcTime.replace(tzinfo=None))
-             last_get_data_utc = utcTime.strftime('%Y-%m-%d_%H:%M:%S')    
+             row = c.execute("SELECT value FROM Metadata WHERE key = 'last_get_data_utc'").fetchone()
+             if row is not None:
+                 utcTime = max(utcTime, dt.datetime.strptime(row[0], '%Y-%m-%d_%H:%M:%S'))
              c.execute("INSERT OR REPLACE INTO Metadata (key, value) VALUES (?, ?)",
-                 ("last_get_data_utc", last_get_data_utc))
+                 ("last_get_data_utc", utcTime.strftime('%Y-%m-%d_%H:%M:%S')))
              # Commit the changes to the database
              conn.commit()
 
@@ -496,7 +2037,7 @@ class SynopticDB(object):
     #
     def list_variables(self):
         listOfVars = ['air_temp','relative_humidity','wind_speed','wind_direction','wind_gust','solar_radiation','precip_accum','fuel_moisture']   
-        logging.info("Typical Requested Variables:")
+        logger.info("Typical Requested Variables:")
         for var in listOfVars:
-            logging.info(var) 
+            logger.info(var) 
 
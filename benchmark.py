@@ -0,0 +1,264 @@
+# Import Necessary Libraries
+import argparse
+import datetime as dt
+from datetime import timedelta
+import glob
+import json
+import logging
+import multiprocessing
+import numpy as np
+import os.path as osp
+import pandas as pd
+import resource
+import shutil
+import tempfile
+import time
+from .harvester import split_windows
+from .SynopticDB import SynopticDB
+from .utils import set_services
+
+# Synthetic variables: units, mean, daily amplitude and noise
+SYNTHETIC_VARS = {
+    'air_temp': ('Celsius', 15., 8., 1.),
+    'relative_humidity': ('%', 50., 20., 5.),
+    'wind_speed': ('m/s', 4., 2., 1.5),
+    'wind_direction': ('Degrees', 180., 0., 90.),
+    'wind_gust': ('m/s', 7., 3., 2.),
+    'solar_radiation': ('W/m**2', 250., 250., 30.),
+    'precip_accum': ('Millimeters', 5., 0., 2.),
+    'fuel_moisture': ('gm', 12., 3., 1.),
+}
+STATES = ['CA', 'NV', 'OR', 'WA', 'AZ', 'UT', 'ID', 'MT', 'WY', 'CO', 'NM', 'TX']
+
+# Transform a Synoptic time (YYYYmmddHHMM string or datetime) into a UTC timestamp
+#
+def to_timestamp(utcTime):
+    if isinstance(utcTime, str):
+        return pd.Timestamp(dt.datetime.strptime(utcTime, '%Y%m%d%H%M'), tz='UTC')
+    utcTime = pd.Timestamp(utcTime)
+    return utcTime.tz_localize('UTC') if utcTime.tz is None else utcTime.tz_convert('UTC')
+
+# Random numbers hashed from their keys (splitmix64), so every value depends only on its keys and not on the
+# other values drawn with it
+#
+# @ Param epochs - numpy array of epoch seconds
+# @ Param keys - integers or integer arrays (seed, station, variable, ...) mixed into the hash, broadcast with the epochs
+#
+# @ returns a numpy array of uniform numbers in (0, 1]
+#
+def hash_uniform(epochs, *keys):
+    x = np.asarray(epochs).astype(np.uint64)
+    with np.errstate(over='ignore'):
+        for key in keys:
+            x = x ^ np.asarray(key).astype(np.int64).astype(np.uint64)
+            x = x + np.uint64(0x9E3779B97F4A7C15)
+            x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+            x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+            x = x ^ (x >> np.uint64(31))
+    return ((x >> np.uint64(11)) + np.uint64(1)) * 2.**-53
+
+# Standard normal numbers hashed from their keys (Box-Muller transform of two hash_uniform streams)
+#
+def hash_normal(epochs, *keys):
+    return np.sqrt(-2.*np.log(hash_uniform(epochs, *keys, 0))) * np.cos(2*np.pi*hash_uniform(epochs, *keys, 1))
+
+# Synthetic replacement of synoptic.services and of the station and network metadata requests.
+# The data is deterministic: the same request always returns the same values.
+#
+class SyntheticSynoptic(object):
+    # Constructor for SyntheticSynoptic class
+    #
+    # @ Param numStations - number of stations
+    # @ Param numNetworks - number of networks
+    # @ Param variables - list of variables reported by every station, from SYNTHETIC_VARS
+    # @ Param freq - time between observations
+    # @ Param missing - fraction of missing values
+    # @ Param seed - seed of the random numbers
+    #
+    def __init__(self, numStations=100, numNetworks=20, variables=None, freq='5min', missing=0.02, seed=0):
+        self.variables = variables or list(SYNTHETIC_VARS)
+        self.freq = freq
+        self.missing = missing
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        self.stids = [f'SYN{i:06d}' for i in range(numStations)]
+        self.lats = rng.uniform(31., 49., numStations)
+        self.lons = rng.uniform(-124., -103., numStations)
+        self.elevations = rng.uniform(0., 3500., numStations)
+        self.networks = rng.integers(1, numNetworks+1, numStations)
+        self.states = [STATES[i % len(STATES)] for i in range(numStations)]
+        self.numNetworks = numNetworks
+        self.index = {stid: i for i, stid in enumerate(self.stids)}
+
+    # Station metadata payload like the Synoptic stations/metadata service
+    #
+    def get_stations(self, token=None):
+        return {'STATION': [{
+            'STID': stid, 'NAME': f'Synthetic station {i}', 'STATE': self.states[i],
+            'LATITUDE': f'{self.lats[i]:.5f}', 'LONGITUDE': f'{self.lons[i]:.5f}', 'ELEVATION': f'{self.elevations[i]:.0f}',
+            'UNITS': {'position': 'm', 'elevation': 'ft'}, 'MNET_ID': str(self.networks[i]),
+            'PERIOD_OF_RECORD': {'start': '2000-01-01T00:00:00Z', 'end': '2024-01-01T00:00:00Z'}}
+            for i, stid in enumerate(self.stids)]}
+
+    # Network metadata payload like the Synoptic networks service
+    #
+    def get_networks(self, token=None):
+        return {'MNET': [{'ID': str(i), 'SHORTNAME': f'SYN{i}', 'LONGNAME': f'Synthetic network {i}'}
+                         for i in range(1, self.numNetworks+1)]}
+
+    # Station dataframes like synoptic.services.stations_timeseries
+    #
+    # @ Param start - start of the time range (YYYYmmddHHMM or datetime)
+    # @ Param end - end of the time range (YYYYmmddHHMM or datetime), included like in the Synoptic API
+    # @ Param stid - station id or list of station ids, None for all the stations
+    # @ Param vars - variable or list of variables, None for all the variables
+    # @ Param network - network id or list of network ids
+    # @ Param state - state or list of states
+    #
+    # @ returns a list of dataframes indexed by UTC datetime, with the STID and UNITS attributes
+    #
+    def stations_timeseries(self, start, end, stid=None, vars=None, network=None, state=None, **kwargs):
+        index = pd.date_range(to_timestamp(start).ceil(self.freq), to_timestamp(end), freq=self.freq, name='date_time')
+        if not len(index):
+            return []
+        stations = [self.index[s] for s in np.atleast_1d(stid) if s in self.index] if stid is not None else range(len(self.stids))
+        if network is not None:
+            networks = {int(n) for n in np.atleast_1d(network)}
+            stations = [i for i in stations if self.networks[i] in networks]
+        if state is not None:
+            states = set(np.atleast_1d(state))
+            stations = [i for i in stations if self.states[i] in states]
+        variables = [v for v in np.atleast_1d(vars) if v in SYNTHETIC_VARS] if vars is not None else self.variables
+        epochs = index.as_unit('s').asi8
+        dayPhase = 2*np.pi*(epochs % 86400)/86400.
+        # Noise and missing values of every (station, variable, time), hashed from the seed, station, variable and time
+        # so overlapping requests return the same values
+        stations = np.asarray(stations, dtype=np.int64)
+        keys = (self.seed, stations[:, None, None], np.array([list(SYNTHETIC_VARS).index(v) for v in variables])[None, :, None])
+        noise = hash_normal(epochs[None, None, :], *keys, 0)
+        missing = hash_uniform(epochs[None, None, :], *keys, 1) < self.missing
+        dfs = []
+        for j, i in enumerate(stations):
+            data = {}
+            for k, variable in enumerate(variables):
+                units, mean, amplitude, noiseStd = SYNTHETIC_VARS[variable]
+                values = mean + amplitude*np.sin(dayPhase - np.pi/2 + self.lons[i]/15.) + noiseStd*noise[j, k]
+                values[missing[j, k]] = np.nan
+                data[variable] = np.round(values, 2)
+            df = pd.DataFrame(data, index=index)
+            df.attrs['STID'] = self.stids[i]
+            df.attrs['NAME'] = f'Synthetic station {i}'
+            df.attrs['latitude'] = self.lats[i]
+            df.attrs['longitude'] = self.lons[i]
+            df.attrs['UNITS'] = {variable: SYNTHETIC_VARS[variable][0] for variable in variables}
+            dfs.append(df)
+        return dfs
+
+# Size in bytes of the database files (main file, partitions and write-ahead logs)
+#
+def database_size(dbPath):
+    base = osp.splitext(dbPath)[0]
+    return sum(osp.getsize(path) for path in set(glob.glob(f'{base}*.db*')) if osp.isfile(path))
+
+# Measure ingest and queries at one scale. Run it in its own process so the peak memory belongs to this scale
+#
+# @ Param numStations - number of synthetic stations
+# @ Param hours - hours of data ingested, in hourly windows like the harvester
+# @ Param folder - folder of the database, a temporary folder if not provided
+# @ Param layout - storage layout of the database
+# @ Param partition - partition period of the database
+# @ Param queries - number of queries timed
+# @ Param queryStations - number of stations per query
+# @ Param queryHours - hours of data per query
+# @ Param seed - seed of the synthetic data and of the queries
+#
+# @ returns a dictionary with the measures
+#
+def benchmark_scale(numStations, hours=24, folder=None, layout=None, partition=None, queries=50, queryStations=10, queryHours=6, seed=0):
+    logging.disable(logging.INFO)
+    services = SyntheticSynoptic(numStations, seed=seed)
+    set_services(services)
+    tmpFolder = tempfile.mkdtemp(dir=folder)
+    dbPath = osp.join(tmpFolder, 'benchmark.db')
+    start = dt.datetime(2024, 1, 1)
+    try:
+        db = SynopticDB(dbPath, layout=layout, partition=partition, token='synthetic')
+        # Ingest
+        numRows = 0
+        ingestSeconds = 0.
+        for windowStart, windowEnd in split_windows(start, start + timedelta(hours=hours), 1):
+            dfs = services.stations_timeseries(windowStart, windowEnd - timedelta(minutes=1))
+            startClock = time.perf_counter()
+            numRows += db.insert_data(dfs)
+            ingestSeconds += time.perf_counter() - startClock
+        # Queries of a few stations and hours
+        rng = np.random.default_rng(seed)
+        queryVars = services.variables[:2]
+        latencies = []
+        for _ in range(queries):
+            queryStart = start + timedelta(hours=int(rng.integers(0, max(1, hours - queryHours + 1))))
+            db.params.update({'stationIDs': rng.choice(services.stids, min(queryStations, numStations), replace=False).tolist(),
+                              'vars': queryVars, 'startDatetime': queryStart, 'endDatetime': queryStart + timedelta(hours=queryHours),
+                              'makeFile': False})
+            startClock = time.perf_counter()
+            db.query_db()
+            latencies.append(time.perf_counter() - startClock)
+        # Station searches with a bounding box
+        searches = []
+        for _ in range(queries):
+            lat, lon = rng.uniform(33., 47.), rng.uniform(-122., -105.)
+            startClock = time.perf_counter()
+            db.find_stids_from_params(None, None, [lat - 1., lat + 1., lon - 1., lon + 1.], None)
+            searches.append(time.perf_counter() - startClock)
+        db.close()
+        result = {'stations': numStations, 'hours': hours, 'layout': db.layout, 'partition': db.partition, 'rows': numRows,
+                  'ingestSeconds': ingestSeconds, 'ingestRowsPerSecond': numRows / ingestSeconds if ingestSeconds > 0 else 0.,
+                  'dbSizeBytes': database_size(dbPath),
+                  # ru_maxrss is in KiB on Linux
+                  'peakRssMB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.}
+        for name, values in [('query', latencies), ('findStids', searches)]:
+            p50, p95, p99 = np.percentile(np.array(values)*1000., [50, 95, 99])
+            result.update({f'{name}P50ms': p50, f'{name}P95ms': p95, f'{name}P99ms': p99})
+        return result
+    finally:
+        set_services(None)
+        shutil.rmtree(tmpFolder, ignore_errors=True)
+
+# Run the benchmark at several scales, each one in a new process
+#
+# @ Param scales - list of numbers of stations
+# @ Param kwargs - arguments of benchmark_scale
+#
+# @ returns a list of dictionaries with the measures of each scale
+#
+def run_benchmark(scales=(100, 1000, 5000), **kwargs):
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for numStations in scales:
+        with context.Pool(1) as pool:
+            results.append(pool.apply(benchmark_scale, (numStations,), kwargs))
+    return results
+
+# Print the results of the benchmark as a table
+#
+def print_results(results):
+    columns = ['stations', 'rows', 'ingestRowsPerSecond', 'queryP50ms', 'queryP95ms', 'queryP99ms',
+               'findStidsP50ms', 'findStidsP99ms', 'dbSizeBytes', 'peakRssMB']
+    print(pd.DataFrame(results)[columns].round(2).to_string(index=False))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmark of SynopticDB with synthetic Synoptic data')
+    parser.add_argument('--scales', type=int, nargs='+', default=[100, 1000, 5000], help='numbers of stations')
+    parser.add_argument('--hours', type=int, default=24, help='hours of data ingested')
+    parser.add_argument('--layout', choices=['tables', 'long'], default=None)
+    parser.add_argument('--partition', choices=['year', 'month', 'day'], default=None)
+    parser.add_argument('--queries', type=int, default=50, help='number of queries timed')
+    parser.add_argument('--folder', default=None, help='folder of the temporary databases')
+    parser.add_argument('--json', default=None, help='also write the results to this JSON file')
+    args = parser.parse_args()
+    results = run_benchmark(args.scales, hours=args.hours, layout=args.layout, partition=args.partition,
+                            queries=args.queries, folder=args.folder)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,154 @@
+# Import Necessary Libraries
+from collections import OrderedDict
+import logging
+import os
+import os.path as osp
+import threading
+from .export import import_pyarrow
+
+logger = logging.getLogger(__name__)
+
+# Cache of the results of query_db. The keys include the data version of the variables and days of the query,
+# so an ingest only makes stale the results it could have changed, and stale results are never returned.
+# Results live in a bounded in-memory LRU tier and, if a folder is given, in Parquet files on disk.
+#
+class QueryCache(object):
+    # Constructor for QueryCache class
+    #
+    # @ Param maxEntries - maximum number of results kept in memory
+    # @ Param maxBytes - maximum size in bytes of the results kept in memory
+    # @ Param folder - folder of the on-disk tier, None to keep the results only in memory
+    # @ Param maxDiskBytes - maximum size in bytes of the on-disk tier, the least recently used files are removed first
+    #
+    def __init__(self, maxEntries=64, maxBytes=512*1024**2, folder=None, maxDiskBytes=4*1024**3):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.folder = folder
+        self.maxDiskBytes = maxDiskBytes
+        self._lock = threading.Lock()
+        # Key -> (result, stationDf, size in bytes), the most recently used last
+        self.entries = OrderedDict()
+        self.numBytes = 0
+        if folder is not None:
+            import_pyarrow()
+            os.makedirs(folder, exist_ok=True)
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Get a cached result
+    #
+    # @ Param key - key of the query
+    #
+    # @ returns a tuple (result, stationDf) with copies of the dataframes, or None if the result is not cached
+    #
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if entry is None and self.folder is not None:
+            entry = self.read(key)
+            if entry is not None:
+                self.remember(key, *entry)
+        if entry is None:
+            return None
+        return entry[0].copy(), entry[1].copy()
+
+    # Cache a result
+    #
+    # @ Param key - key of the query
+    # @ Param result - dataframe returned by query_db
+    # @ Param stationDf - station dataframe returned by query_db
+    #
+    def put(self, key, result, stationDf):
+        result, stationDf = result.copy(), stationDf.copy()
+        self.remember(key, result, stationDf)
+        if self.folder is not None:
+            self.write(key, result, stationDf)
+
+    # Remove all the cached results
+    #
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.numBytes = 0
+        for path in self.disk_files():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    # Add a result to the in-memory tier, removing the least recently used ones beyond the bounds
+    #
+    def remember(self, key, result, stationDf):
+        size = int(result.memory_usage(deep=True).sum() + stationDf.memory_usage(deep=True).sum())
+        if size > self.maxBytes:
+            return
+        with self._lock:
+            if key in self.entries:
+                self.numBytes -= self.entries.pop(key)[2]
+            self.entries[key] = (result, stationDf, size)
+            self.numBytes += size
+            while len(self.entries) > self.maxEntries or self.numBytes > self.maxBytes:
+                _, (_, _, oldSize) = self.entries.popitem(last=False)
+                self.numBytes -= oldSize
+
+    # Paths of the files of a result in the on-disk tier
+    #
+    def disk_paths(self, key):
+        return osp.join(self.folder, f"{key}.parquet"), osp.join(self.folder, f"{key}_stations.parquet")
+
+    # Paths of all the files of the on-disk tier
+    #
+    def disk_files(self):
+        if self.folder is None:
+            return []
+        return [osp.join(self.folder, name) for name in os.listdir(self.folder) if name.endswith('.parquet')]
+
+    # Read a result from the on-disk tier
+    #
+    # @ returns a tuple (result, stationDf), or None if the files are not there
+    #
+    def read(self, key):
+        import pyarrow.parquet as pq
+        paths = self.disk_paths(key)
+        try:
+            frames = [pq.read_table(path, memory_map=True).to_pandas() for path in paths]
+            # Recently used files are kept longer
+            for path in paths:
+                os.utime(path)
+        except OSError:
+            return None
+        return tuple(frames)
+
+    # Write a result to the on-disk tier, removing the least recently used files beyond its size
+    #
+    def write(self, key, result, stationDf):
+        pa, ds, pafs = import_pyarrow()
+        import pyarrow.parquet as pq
+        try:
+            for path, df in zip(self.disk_paths(key), (result, stationDf)):
+                # Written under another name first, so readers never see a partial file
+                tmpPath = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmpPath)
+                os.replace(tmpPath, path)
+        except Exception as e:
+            logger.warning(f"QueryCache.write - could not write the result to disk: {e}")
+            return
+        # Other processes can share the folder, so the files can disappear while they are listed
+        files = []
+        for path in self.disk_files():
+            try:
+                files.append((osp.getmtime(path), osp.getsize(path), path))
+            except OSError:
+                pass
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.maxDiskBytes:
+                break
+            total -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
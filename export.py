@@ -0,0 +1,217 @@
+# Import Necessary Libraries
+import logging
+import os
+import os.path as osp
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# File formats supported by the exports and their pyarrow dataset format names
+EXPORT_FORMATS = {'parquet': 'parquet', 'arrow': 'ipc'}
+# Ways the exported data can be partitioned
+PARTITIONS = ['variable', 'date']
+
+# Import pyarrow, which is only needed for the columnar exports
+#
+def import_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        import pyarrow.fs as pafs
+    except ImportError:
+        raise ImportError("pyarrow is required to export Parquet or Arrow files. Install it with: conda install -c conda-forge pyarrow")
+    return pa, ds, pafs
+
+# Check the file format and return the pyarrow dataset format with its write options
+#
+# @ Param fileFormat - 'parquet' or 'arrow'
+# @ Param compression - compression codec of the files
+#
+def file_format(fileFormat, compression='zstd'):
+    pa, ds, pafs = import_pyarrow()
+    if fileFormat not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown file format {fileFormat}. Pick one from {list(EXPORT_FORMATS)}")
+    dsFormat = ds.ParquetFileFormat() if fileFormat == 'parquet' else ds.IpcFileFormat()
+    return dsFormat, dsFormat.make_write_options(compression=compression)
+
+# Columns of each variable in the query dataframes and their types
+#
+# @ Param thisType - 'REAL' or 'TEXT'
+# @ Param rollup - the dataframes have the hourly or daily statistics of the rollups instead of the observations
+#
+# @ returns a list of (column suffix, pyarrow type)
+#
+def value_fields(thisType, rollup=False):
+    pa, ds, pafs = import_pyarrow()
+    if rollup:
+        return [('MIN', pa.float64()), ('MAX', pa.float64()), ('MEAN', pa.float64()), ('COUNT', pa.int64()), ('UNITS', pa.string())]
+    return [('VALUE', pa.float64() if thisType == 'REAL' else pa.string()), ('UNITS', pa.string())]
+
+# Build the schema of the wide query dataframes
+#
+# @ Param variableTypes - dictionary of variable name -> 'REAL' or 'TEXT'
+# @ Param rollup - the dataframes have the statistics of the rollups
+#
+def wide_schema(variableTypes, rollup=False):
+    pa, ds, pafs = import_pyarrow()
+    fields = [('STID', pa.string()), ('DATETIME', pa.timestamp('s'))]
+    for variable, thisType in variableTypes.items():
+        fields += [(f'{(variable).upper()}_{suffix}', fieldType) for suffix, fieldType in value_fields(thisType, rollup)]
+    return pa.schema(fields)
+
+# Build the schema of the data of one variable
+#
+# @ Param thisType - 'REAL' or 'TEXT'
+# @ Param partitionBy - list of partitions, the date partition adds a date column
+# @ Param rollup - the dataframes have the statistics of the rollups
+#
+def variable_schema(thisType, partitionBy, rollup=False):
+    pa, ds, pafs = import_pyarrow()
+    fields = [('STID', pa.string()), ('DATETIME', pa.timestamp('s'))] + value_fields(thisType, rollup)
+    if 'date' in partitionBy:
+        fields.append(('date', pa.string()))
+    return pa.schema(fields)
+
+# Transform a wide query dataframe into a pyarrow table with a fixed schema
+#
+def to_table(df, schema):
+    pa, ds, pafs = import_pyarrow()
+    df = df.copy()
+    df['DATETIME'] = pd.to_datetime(df['DATETIME'])
+    for field in schema:
+        # Variables without data in the dataframe get empty columns
+        if field.name not in df.columns:
+            df[field.name] = None
+        if field.type == pa.int64():
+            df[field.name] = pd.to_numeric(df[field.name], errors='coerce').astype('Int64')
+        elif field.type == pa.float64():
+            df[field.name] = pd.to_numeric(df[field.name], errors='coerce')
+        elif field.type == pa.string():
+            df[field.name] = df[field.name].astype(object).where(df[field.name].notna(), None)
+    return pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False)
+
+# Write the dataframes of a query to a columnar file or to a partitioned dataset
+#
+# @ Param frames - iterable of wide dataframes from query_db or query_db_iter
+# @ Param path - output file (no partitions) or output directory (partitions)
+# @ Param variableTypes - dictionary of variable name -> 'REAL' or 'TEXT', in the order of the columns
+# @ Param fileFormat - 'parquet' or 'arrow'
+# @ Param partitionBy - list of partitions ('variable' and/or 'date'), or None for a single file
+# @ Param compression - compression codec of the files
+# @ Param rollup - the dataframes have the statistics of the rollups (query with a resolution) instead of the observations
+#
+# @ returns the number of rows written
+#
+def write_frames(frames, path, variableTypes, fileFormat='parquet', partitionBy=None, compression='zstd', rollup=False):
+    pa, ds, pafs = import_pyarrow()
+    dsFormat, writeOptions = file_format(fileFormat, compression)
+    partitionBy = [partition for partition in (partitionBy or []) if partition in PARTITIONS]
+    numRows = 0
+    if not partitionBy:
+        # Single file with the same columns as query_db
+        # Without variable types (e.g. station metadata) the schema is taken from the first dataframe
+        frames = iter(frames)
+        if variableTypes is None:
+            first = next(frames, None)
+            if first is None:
+                return numRows
+            table = pa.Table.from_pandas(first, preserve_index=False)
+            schema = table.schema
+            tables = [table]
+        else:
+            schema = wide_schema(variableTypes, rollup)
+            tables = []
+        if fileFormat == 'parquet':
+            import pyarrow.parquet as pq
+            writer = pq.ParquetWriter(path, schema, compression=compression)
+        else:
+            writer = pa.ipc.new_file(path, schema, options=pa.ipc.IpcWriteOptions(compression=compression))
+        with writer:
+            for table in tables:
+                writer.write_table(table)
+                numRows += table.num_rows
+            for df in frames:
+                writer.write_table(to_table(df, schema))
+                numRows += len(df)
+        logger.info(f'write_frames - Wrote {numRows} rows to {path}')
+        return numRows
+    # Hive style partitioned dataset, variable=<name>/date=<YYYY-MM-DD>/part-<chunk>-<variable>-<i>.<format>
+    # Each variable has its own schema (numeric or text values). Partitioned only by date, the rows keep the columns of query_db
+    partitioning = ['date'] if 'date' in partitionBy else None
+    for count, df in enumerate(frames):
+        numRows += len(df)
+        datetimes = pd.to_datetime(df['DATETIME'])
+        if 'variable' not in partitionBy:
+            schema = wide_schema(variableTypes, rollup).append(pa.field('date', pa.string()))
+            ds.write_dataset(to_table(df.assign(date=datetimes.dt.strftime('%Y-%m-%d')), schema), path, format=dsFormat,
+                             file_options=writeOptions, partitioning=partitioning, partitioning_flavor='hive',
+                             basename_template=f'part-{count}-{{i}}.{fileFormat}', existing_data_behavior='overwrite_or_ignore')
+            continue
+        for variable, thisType in variableTypes.items():
+            fields = value_fields(thisType, rollup)
+            values = df.get(f'{(variable).upper()}_{fields[0][0]}')
+            if values is None:
+                continue
+            mask = values.notna()
+            if not mask.any():
+                continue
+            varDf = pd.DataFrame({'STID': df['STID'][mask], 'DATETIME': datetimes[mask]})
+            for suffix, _ in fields:
+                varDf[suffix] = df[f'{(variable).upper()}_{suffix}'][mask]
+            if partitioning:
+                varDf['date'] = datetimes[mask].dt.strftime('%Y-%m-%d')
+            ds.write_dataset(to_table(varDf, variable_schema(thisType, partitionBy, rollup)), osp.join(path, f'variable={variable}'),
+                             format=dsFormat, file_options=writeOptions, partitioning=partitioning, partitioning_flavor='hive',
+                             basename_template=f'part-{count}-{variable}-{{i}}.{fileFormat}', existing_data_behavior='overwrite_or_ignore')
+    logger.info(f'write_frames - Wrote {numRows} rows to {path}')
+    return numRows
+
+# Read a file or dataset written by write_frames, loading only the columns and partitions requested
+#
+# @ Param path - file or directory written by write_frames
+# @ Param fileFormat - 'parquet' or 'arrow'
+# @ Param columns - list of columns to load, or None for all the columns
+# @ Param variables - list of variables to load from a dataset partitioned by variable, or None for all of them
+# @ Param startDate - first date (YYYY-MM-DD) to load from a dataset partitioned by date
+# @ Param endDate - last date (YYYY-MM-DD) to load from a dataset partitioned by date
+#
+# @ returns a dataframe. Data partitioned by variable gets a VARIABLE column
+#
+def read_frames(path, fileFormat='parquet', columns=None, variables=None, startDate=None, endDate=None):
+    pa, ds, pafs = import_pyarrow()
+    dsFormat, _ = file_format(fileFormat)
+    # Memory map the files instead of reading them into buffers
+    filesystem = pafs.LocalFileSystem(use_mmap=True)
+    if osp.isfile(path):
+        return ds.dataset(path, format=dsFormat, filesystem=filesystem).to_table(columns=columns).to_pandas()
+    filterExpr = None
+    if startDate is not None:
+        filterExpr = ds.field('date') >= str(startDate)[:10]
+    if endDate is not None:
+        endExpr = ds.field('date') <= str(endDate)[:10]
+        filterExpr = endExpr if filterExpr is None else filterExpr & endExpr
+    # Each variable has its own schema, so they are read one by one
+    variableDirs = sorted(name for name in os.listdir(path) if name.startswith('variable='))
+    if not variableDirs:
+        return read_partitions(path, dsFormat, filesystem, columns, filterExpr)
+    dfs = []
+    for variableDir in variableDirs:
+        variable = variableDir.split('=', 1)[1]
+        if variables is not None and variable not in variables:
+            continue
+        df = read_partitions(osp.join(path, variableDir), dsFormat, filesystem, columns, filterExpr)
+        df.insert(0, 'VARIABLE', variable)
+        dfs.append(df)
+    if not dfs:
+        return pd.DataFrame()
+    return pd.concat(dfs, ignore_index=True)
+
+# Read a directory of files, filtering the date partitions if the directory has them
+#
+def read_partitions(path, dsFormat, filesystem, columns=None, filterExpr=None):
+    pa, ds, pafs = import_pyarrow()
+    if any(name.startswith('date=') for name in os.listdir(path)):
+        dataset = ds.dataset(path, format=dsFormat, filesystem=filesystem,
+                             partitioning=ds.partitioning(pa.schema([('date', pa.string())]), flavor='hive'))
+        return dataset.to_table(columns=columns, filter=filterExpr).to_pandas()
+    return ds.dataset(path, format=dsFormat, filesystem=filesystem).to_table(columns=columns).to_pandas()
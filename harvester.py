@@ -0,0 +1,281 @@
+# Import Necessary Libraries
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dateutil.relativedelta import relativedelta
+import hashlib
+import json
+import logging
+import threading
+import time
+from .scheduler import JobQueue, StorageError, retryable
+from .utils import AsyncSynopticClient, ensure_list, fetch_timeseries, fetch_timeseries_async, get_client, redact_token
+
+logger = logging.getLogger(__name__)
+
+# Split a time range into consecutive windows
+#
+# @ Param startTime - start of the time range
+# @ Param endTime - end of the time range
+# @ Param windowHours - length of each window in hours
+#
+# @ returns a list of (start, end) tuples covering the time range
+#
+def split_windows(startTime, endTime, windowHours=1):
+    windows = []
+    while startTime < endTime:
+        tmpTime = min(startTime + relativedelta(hours=windowHours), endTime)
+        windows.append((startTime, tmpTime))
+        startTime = tmpTime
+    return windows
+
+# Split a list of station ids into shards that Synoptic can handle in one request
+#
+# @ Param stationIDs - list of station ids, or None to request all the stations matching the other parameters
+# @ Param shardSize - maximum number of stations per shard (Synoptic can handle 1875 stations pulled at one time)
+#
+# @ returns a list of shards (lists of station ids, or [None] if there are no station ids)
+#
+def split_shards(stationIDs, shardSize=1875):
+    if not stationIDs:
+        return [None]
+    if not isinstance(stationIDs, list):
+        return [stationIDs]
+    return [stationIDs[i:i+shardSize] for i in range(0, len(stationIDs), shardSize)]
+
+# Key identifying a station shard in the coverage ledger, built from the parameters sent to Synoptic
+#
+# @ Param params - query parameters of the shard (see SynopticDB.init_params)
+#
+# @ returns a short hexadecimal hash
+#
+def shard_key(params):
+    request = {}
+    for key in ['stationIDs', 'networks', 'states', 'vars']:
+        value = ensure_list(params.get(key))
+        request[key] = sorted(str(v) for v in value)
+    request['bbox'] = [params.get(key) for key in ['minLatitude', 'maxLatitude', 'minLongitude', 'maxLongitude']]
+    return hashlib.sha1(json.dumps(request, sort_keys=True).encode()).hexdigest()[:16]
+
+# Priority of a job, the most recent windows are requested first and the backfill behind them
+#
+def recent_first(job):
+    params, startTime, endTime = job
+    return -endTime.timestamp()
+
+# Ways the harvester requests the jobs: a pool of threads sharing the HTTP client, or an asyncio event loop
+BACKENDS = ['threads', 'asyncio']
+
+# Runs (time window x station shard) jobs on a pool of threads, or on an asyncio event loop, requesting data from Synoptic.
+# The thread calling run is the only one writing to the database.
+#
+class Harvester(object):
+    # Constructor for Harvester class
+    #
+    # @ Param db - SynopticDB object where the data is inserted
+    # @ Param workers - number of threads requesting data from Synoptic
+    # @ Param maxInFlight - maximum number of jobs being fetched or waiting to be inserted, bounds the memory used
+    # @ Param max_retries - number of times a job is requested before giving up
+    # @ Param reportEvery - seconds between progress reports
+    # @ Param backend - 'threads' for one thread per connection, or 'asyncio' to await all the jobs in flight
+    #   from a single event loop over the connections (requires aiohttp)
+    #
+    def __init__(self, db, workers=4, maxInFlight=None, max_retries=5, reportEvery=30, backend='threads'):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend}. Pick one from {BACKENDS}")
+        self.db = db
+        self.workers = max(1, workers)
+        self.maxInFlight = maxInFlight or 2*self.workers
+        self.max_retries = max_retries
+        self.reportEvery = reportEvery
+        self.backend = backend
+
+    # Build the jobs for a time range and a list of station shards
+    #
+    # @ Param params - query parameters (see SynopticDB.init_params)
+    # @ Param startTime - start of the time range
+    # @ Param endTime - end of the time range
+    # @ Param windowHours - length of each window in hours
+    # @ Param shardSize - maximum number of stations per shard
+    #
+    # @ returns a list of (params, startTime, endTime) jobs
+    #
+    def build_jobs(self, params, startTime, endTime, windowHours=1, shardSize=1875):
+        jobs = []
+        for windowStart, windowEnd in split_windows(startTime, endTime, windowHours):
+            for shard in split_shards(params.get('stationIDs'), shardSize):
+                jobs.append((dict(params, stationIDs=shard), windowStart, windowEnd))
+        return jobs
+
+    # Request the data of one job from Synoptic, once. Failed jobs are tried again by run after a backoff delay
+    #
+    # @ returns the list of station dataframes
+    #
+    def fetch(self, job):
+        params, startTime, endTime = job
+        with self.db.metrics.timer('fetch'):
+            listOfDfs = fetch_timeseries(params, startTime.strftime('%Y%m%d%H%M'), endTime.strftime('%Y%m%d%H%M'),
+                                         self.db.get_token(), self.db.metrics, self.db.spool)
+        self.count_rows(listOfDfs)
+        return listOfDfs
+
+    # Asyncio version of fetch
+    #
+    # @ Param asyncClient - AsyncSynopticClient making the requests
+    #
+    async def fetch_async(self, asyncClient, job):
+        params, startTime, endTime = job
+        with self.db.metrics.timer('fetch'):
+            listOfDfs = await fetch_timeseries_async(asyncClient, params, startTime.strftime('%Y%m%d%H%M'),
+                                                     endTime.strftime('%Y%m%d%H%M'), self.db.get_token(), self.db.metrics, self.db.spool)
+        self.count_rows(listOfDfs)
+        return listOfDfs
+
+    # Count the values fetched
+    #
+    def count_rows(self, listOfDfs):
+        if self.db.metrics.enabled and listOfDfs:
+            self.db.metrics.incr('rows_fetched', sum(df.size for df in listOfDfs))
+
+    # Insert the data of one job into the database and record it in the coverage ledger
+    #
+    # @ returns the number of values inserted, raises StorageError if the data could not be written
+    #
+    def store(self, job, listOfDfs):
+        params, startTime, endTime = job
+        try:
+            rows = self.db.insert_data(listOfDfs) if listOfDfs is not None else 0
+            self.db.record_coverage(shard_key(params), startTime, endTime)
+        except Exception as e:
+            raise StorageError(e) from e
+        return rows
+
+    # Run the jobs, the most recent windows first. Requests are sent when the scheduler of the database allows it,
+    # and failed requests are queued again after a backoff delay. Jobs that could not be stored are not requested again.
+    #
+    # @ Param jobs - list of (params, startTime, endTime) jobs
+    # @ Param priority - function of a job returning its priority, lower values are requested first. Newest first by default
+    #
+    # @ returns a dictionary with the number of jobs, failed jobs (fetch and storage failures), rows inserted, seconds and rows per second
+    #
+    def run(self, jobs, priority=recent_first):
+        queue = JobQueue()
+        for job in jobs:
+            queue.push(job, priority(job))
+        scheduler = self.db.scheduler
+        metrics = self.db.metrics
+        report = {'jobs': len(queue), 'done': 0, 'failed': 0, 'fetchFailed': 0, 'storeFailed': 0, 'rows': 0}
+        startClock = time.perf_counter()
+        lastReport = startClock
+        inFlight = {}
+        # End of the newest window stored, written to the Metadata table once at the end of the run
+        lastStored = None
+        with self.submitter() as submit:
+            while True:
+                # Keep at most maxInFlight jobs fetched and not inserted, as fast as the rate limit allows
+                pause = None
+                while len(inFlight) < self.maxInFlight:
+                    pause = queue.wait_time()
+                    if pause is None or pause > 0:
+                        break
+                    pause = scheduler.try_acquire()
+                    if pause > 0:
+                        break
+                    job, jobPriority, attempt = queue.pop()
+                    inFlight[submit(job)] = (job, jobPriority, attempt + 1)
+                    pause = None
+                if not inFlight and pause is None:
+                    break
+                if not inFlight:
+                    time.sleep(pause)
+                    continue
+                done, _ = wait(inFlight, timeout=pause, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job, jobPriority, attempt = inFlight.pop(future)
+                    try:
+                        listOfDfs = future.result()
+                    except Exception as e:
+                        if attempt < self.max_retries and retryable(e):
+                            delay = scheduler.delay(attempt, e)
+                            metrics.incr('fetch_retries')
+                            logger.warning(f'Harvester.fetch - failed with exception: {redact_token(e)}, trying again in {delay:.1f} s, '
+                                           f'remaining tries {self.max_retries-attempt}')
+                            queue.push(job, jobPriority, attempt, delay)
+                            continue
+                        metrics.incr('fetch_failures')
+                        report['fetchFailed'] += 1
+                        logger.warning(f'Harvester.run - request between {job[1]} and {job[2]} failed after {attempt} tries: {redact_token(e)}')
+                    else:
+                        try:
+                            report['rows'] += self.store(job, listOfDfs)
+                            lastStored = job[2] if lastStored is None else max(lastStored, job[2])
+                        except StorageError as e:
+                            metrics.incr('store_failures')
+                            report['storeFailed'] += 1
+                            logger.error(f'Harvester.run - data between {job[1]} and {job[2]} could not be stored: {e}')
+                    report['done'] += 1
+                if time.perf_counter() - lastReport >= self.reportEvery:
+                    lastReport = time.perf_counter()
+                    self.log_progress(report, lastReport - startClock)
+        if lastStored is not None:
+            try:
+                self.db.update_metadata(lastStored)
+            except Exception as e:
+                logger.error(f'Harvester.run - the metadata could not be updated: {e}')
+        report['failed'] = report['fetchFailed'] + report['storeFailed']
+        report['seconds'] = time.perf_counter() - startClock
+        report['rowsPerSecond'] = report['rows'] / report['seconds'] if report['seconds'] > 0 else 0.
+        self.log_progress(report, report['seconds'])
+        return report
+
+    # Context manager starting the backend, returning a function that submits a job and returns its future
+    #
+    def submitter(self):
+        if self.backend == 'asyncio':
+            return AsyncioSubmitter(self)
+        return ThreadSubmitter(self)
+
+    # Log the progress and throughput of the harvest
+    #
+    def log_progress(self, report, seconds):
+        rate = report['rows'] / seconds if seconds > 0 else 0.
+        logger.info(f"Harvester - {report['done']} / {report['jobs']} jobs ({report['fetchFailed']} fetch and {report['storeFailed']} storage failures), "
+                     f"{report['rows']} rows in {seconds:.1f} s ({rate:.0f} rows/s)")
+
+# Submits the jobs of a harvester to a pool of threads sharing the HTTP client
+#
+class ThreadSubmitter(object):
+    def __init__(self, harvester):
+        self.harvester = harvester
+
+    def __enter__(self):
+        # One persistent connection per thread
+        get_client().reserve(self.harvester.workers)
+        self.executor = ThreadPoolExecutor(max_workers=self.harvester.workers)
+        return lambda job: self.executor.submit(self.harvester.fetch, job)
+
+    def __exit__(self, *args):
+        self.executor.shutdown()
+
+# Submits the jobs of a harvester to an asyncio event loop running in its own thread.
+# The number of workers is the number of connections open at once.
+#
+class AsyncioSubmitter(object):
+    def __init__(self, harvester):
+        self.harvester = harvester
+
+    def __enter__(self):
+        # Same server and timeouts as the shared HTTP client
+        syncClient = get_client()
+        self.asyncClient = AsyncSynopticClient(syncClient.baseUrl, self.harvester.workers, syncClient.timeout)
+        # asyncio is only imported by the asyncio backend
+        import asyncio
+        self.asyncio = asyncio
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        return lambda job: asyncio.run_coroutine_threadsafe(self.harvester.fetch_async(self.asyncClient, job), self.loop)
+
+    def __exit__(self, *args):
+        self.asyncio.run_coroutine_threadsafe(self.asyncClient.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
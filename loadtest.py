@@ -0,0 +1,180 @@
+# Import Necessary Libraries
+import argparse
+import datetime as dt
+from datetime import timedelta
+import http.client
+import json
+import logging
+import multiprocessing
+import numpy as np
+import os.path as osp
+import shutil
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+from .benchmark import SyntheticSynoptic
+from .harvester import split_windows
+from .server import QueryServer
+from .SynopticDB import SynopticDB
+from .utils import set_services
+
+logger = logging.getLogger(__name__)
+
+# Create a database with synthetic data
+#
+# @ Param dbPath - path of the new database
+# @ Param numStations - number of stations
+# @ Param start - start of the data
+# @ Param hours - hours of data
+#
+# @ returns the SyntheticSynoptic generator of the data
+#
+def build_database(dbPath, numStations, start, hours, seed=0):
+    services = SyntheticSynoptic(numStations, seed=seed)
+    set_services(services)
+    try:
+        db = SynopticDB(dbPath, token='synthetic')
+        for windowStart, windowEnd in split_windows(start, start + timedelta(hours=hours), 1):
+            db.insert_data(services.stations_timeseries(windowStart, windowEnd - timedelta(minutes=1)))
+        db.close()
+    finally:
+        set_services(None)
+    return services
+
+# Keep inserting new hours of synthetic data until stopped, in its own process like a sync job
+#
+# @ Param stopEvent - multiprocessing event stopping the ingestion
+# @ Param counter - shared value counting the rows inserted
+#
+def ingest(dbPath, numStations, start, stopEvent, counter, seed=0):
+    logging.disable(logging.INFO)
+    services = SyntheticSynoptic(numStations, seed=seed)
+    set_services(services)
+    db = SynopticDB(dbPath, token='synthetic')
+    windowStart = start
+    while not stopEvent.is_set():
+        rows = db.insert_data(services.stations_timeseries(windowStart, windowStart + timedelta(minutes=59)))
+        with counter.get_lock():
+            counter.value += rows
+        windowStart += timedelta(hours=1)
+    db.close()
+
+# Send queries from concurrent clients, each with its own keep-alive connection
+#
+# @ Param url - base URL of the server
+# @ Param stids - station ids queried
+# @ Param variables - variables queried
+# @ Param start - start of the data queried
+# @ Param hours - hours of data available from start
+# @ Param clients - number of concurrent clients
+# @ Param duration - seconds of the test
+# @ Param queryStations - number of random stations of each query
+# @ Param queryHours - hours of each query
+#
+# @ returns a dictionary with the number of requests, errors and rows, the requests per second and the latency percentiles
+#
+def run_load_test(url, stids, variables, start, hours, clients=8, duration=10., queryStations=10, queryHours=6, seed=0):
+    address = urlsplit(url)
+    latencies = [[] for _ in range(clients)]
+    errors = [0]*clients
+    rows = [0]*clients
+    deadline = time.perf_counter() + duration
+
+    def client(i):
+        rng = np.random.default_rng([seed, i])
+        conn = http.client.HTTPConnection(address.hostname, address.port, timeout=60)
+        try:
+            while time.perf_counter() < deadline:
+                queryStart = start + timedelta(hours=int(rng.integers(0, max(1, hours - queryHours + 1))))
+                query = urlencode({'stids': ','.join(rng.choice(stids, min(queryStations, len(stids)), replace=False)),
+                                   'vars': ','.join(variables), 'start': queryStart.strftime('%Y%m%d%H%M'),
+                                   'end': (queryStart + timedelta(hours=queryHours)).strftime('%Y%m%d%H%M')})
+                startClock = time.perf_counter()
+                try:
+                    conn.request('GET', f'/query?{query}')
+                    response = conn.getresponse()
+                    response.read()
+                except (OSError, http.client.HTTPException) as e:
+                    logger.warning(f"run_load_test - client {i}: {e}")
+                    errors[i] += 1
+                    conn.close()
+                    continue
+                latencies[i].append(time.perf_counter() - startClock)
+                if response.status != 200:
+                    errors[i] += 1
+                else:
+                    rows[i] += int(response.getheader('X-Rows', 0))
+        finally:
+            conn.close()
+
+    startClock = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - startClock
+    allLatencies = np.concatenate([np.array(values) for values in latencies]) * 1000.
+    result = {'clients': clients, 'requests': len(allLatencies), 'errors': sum(errors), 'rows': sum(rows), 'seconds': seconds,
+              'requestsPerSecond': len(allLatencies) / seconds}
+    if len(allLatencies):
+        p50, p90, p99 = np.percentile(allLatencies, [50, 90, 99])
+        result.update({'p50ms': p50, 'p90ms': p90, 'p99ms': p99, 'maxms': allLatencies.max()})
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test of the SynopticDB query server with synthetic data')
+    parser.add_argument('--stations', type=int, default=1000, help='number of stations of the synthetic database')
+    parser.add_argument('--hours', type=int, default=24, help='hours of data of the synthetic database')
+    parser.add_argument('--url', default=None, help='query a running server instead of starting one, on a database built by this script')
+    parser.add_argument('--database', default=None, help='path of the synthetic database, kept after the test')
+    parser.add_argument('--workers', type=int, default=16, help='worker threads of the server')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16], help='numbers of concurrent clients')
+    parser.add_argument('--duration', type=float, default=10., help='seconds of each test')
+    parser.add_argument('--ingest', action='store_true', help='insert new data from another process during the tests')
+    parser.add_argument('--json', default=None, help='also write the results to this JSON file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    start = dt.datetime(2024, 1, 1)
+    tmpFolder = None
+    dbPath = args.database
+    if dbPath is None:
+        tmpFolder = tempfile.mkdtemp()
+        dbPath = osp.join(tmpFolder, 'loadtest.db')
+    try:
+        if not osp.exists(dbPath):
+            buildClock = time.perf_counter()
+            build_database(dbPath, args.stations, start, args.hours)
+            print(f"Built {dbPath} in {time.perf_counter() - buildClock:.1f} s")
+        services = SyntheticSynoptic(args.stations)
+        server = None
+        url = args.url
+        if url is None:
+            server = QueryServer(dbPath, port=0, workers=max(args.workers, max(args.clients)))
+            url = server.start()
+        ingestion = None
+        if args.ingest:
+            context = multiprocessing.get_context('spawn')
+            stopEvent, counter = context.Event(), context.Value('q', 0)
+            ingestion = context.Process(target=ingest, args=(dbPath, args.stations, start + timedelta(hours=args.hours), stopEvent, counter))
+            ingestion.start()
+        results = []
+        try:
+            for clients in args.clients:
+                result = run_load_test(url, services.stids, services.variables[:2], start, args.hours, clients, args.duration)
+                result['ingestedRows'] = counter.value if ingestion is not None else 0
+                results.append(result)
+                print(json.dumps({key: round(value, 2) if isinstance(value, float) else value for key, value in result.items()}))
+        finally:
+            if ingestion is not None:
+                stopEvent.set()
+                ingestion.join()
+            if server is not None:
+                server.shutdown()
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
+    finally:
+        if tmpFolder is not None:
+            shutil.rmtree(tmpFolder, ignore_errors=True)
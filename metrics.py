@@ -0,0 +1,190 @@
+# Import Necessary Libraries
+from collections import defaultdict
+import json
+import threading
+import time
+
+# Context manager measuring the time of a block and adding it to a timer
+#
+class Timer(object):
+    def __init__(self, metrics, key):
+        self.metrics = metrics
+        self.key = key
+
+    def __enter__(self):
+        self.startClock = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.seconds = time.perf_counter() - self.startClock
+        self.metrics.observe_key(self.key, self.seconds)
+
+# Context manager that does nothing, used when the metrics are disabled
+#
+class NullTimer(object):
+    seconds = 0.
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+NULL_TIMER = NullTimer()
+
+# Key of a metric with its labels
+#
+def metric_key(name, labels):
+    return (name, tuple(sorted(labels.items()))) if labels else (name, ())
+
+# Format the labels of a metric for the Prometheus text format
+#
+def prometheus_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels) + '}'
+
+# Counters and timers of the stages of SynopticDB (fetch, parse, insert, commit, query, metadata).
+# Thread safe, so the harvester threads can share it.
+#
+class Metrics(object):
+    enabled = True
+
+    # Constructor for Metrics class
+    #
+    # @ Param prefix - prefix of the metric names in the Prometheus export
+    #
+    def __init__(self, prefix='synopticdb'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.reset()
+
+    # Remove all the measures
+    #
+    def reset(self):
+        with self._lock:
+            self.counters = defaultdict(float)
+            # Timer key -> [count, total seconds, max seconds]
+            self.timers = {}
+
+    # Add to a counter
+    #
+    # @ Param name - counter name (e.g. rows_inserted)
+    # @ Param value - amount added
+    # @ Param labels - labels of the counter (e.g. stage='fetch')
+    #
+    def incr(self, name, value=1, **labels):
+        key = metric_key(name, labels)
+        with self._lock:
+            self.counters[key] += value
+
+    # Measure the time of a block of code
+    #
+    #   with metrics.timer('insert'):
+    #       ...
+    #
+    # @ Param name - timer name
+    # @ Param labels - labels of the timer
+    #
+    def timer(self, name, **labels):
+        return Timer(self, metric_key(name, labels))
+
+    # Add a duration to a timer
+    #
+    # @ Param name - timer name
+    # @ Param seconds - duration
+    # @ Param labels - labels of the timer
+    #
+    def observe(self, name, seconds, **labels):
+        self.observe_key(metric_key(name, labels), seconds)
+
+    def observe_key(self, key, seconds):
+        with self._lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                self.timers[key] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+    # Current value of the metrics
+    #
+    # @ returns a dictionary with the counters and the timers (count, seconds, max seconds), keyed by name and labels
+    #
+    def snapshot(self):
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in self.counters.items()]
+            timers = [{'name': name, 'labels': dict(labels), 'count': count, 'seconds': total, 'maxSeconds': maximum}
+                      for (name, labels), (count, total, maximum) in self.timers.items()]
+        return {'counters': counters, 'timers': timers}
+
+    # Export the metrics in the Prometheus text format. Counters end in _total and timers are summaries in seconds
+    #
+    def to_prometheus(self):
+        with self._lock:
+            counters = sorted(self.counters.items())
+            timers = sorted(self.timers.items())
+        lines = []
+        for name in sorted({name for (name, _), _ in counters}):
+            lines.append(f'# TYPE {self.prefix}_{name}_total counter')
+            lines += [f'{self.prefix}_{name}_total{prometheus_labels(labels)} {value:g}'
+                      for (counterName, labels), value in counters if counterName == name]
+        for name in sorted({name for (name, _), _ in timers}):
+            lines.append(f'# TYPE {self.prefix}_{name}_seconds summary')
+            for (timerName, labels), (count, total, maximum) in timers:
+                if timerName == name:
+                    lines.append(f'{self.prefix}_{name}_seconds_count{prometheus_labels(labels)} {count}')
+                    lines.append(f'{self.prefix}_{name}_seconds_sum{prometheus_labels(labels)} {total:.6f}')
+                    lines.append(f'{self.prefix}_{name}_seconds_max{prometheus_labels(labels)} {maximum:.6f}')
+        return '\n'.join(lines) + '\n'
+
+    # Write the metrics in the Prometheus text format, e.g. for the node exporter textfile collector
+    #
+    def write_prometheus(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_prometheus())
+
+    # Append the current metrics as one JSON line
+    #
+    # @ Param path - path of the JSON lines file
+    # @ Param extra - dictionary of additional fields of the line (e.g. run id)
+    #
+    def write_jsonl(self, path, **extra):
+        line = dict(extra, time=time.time(), **self.snapshot())
+        with open(path, 'a') as f:
+            f.write(json.dumps(line) + '\n')
+
+# Metrics that are not recorded. Every call is a no-op, so disabled instrumentation costs close to nothing
+#
+class NullMetrics(object):
+    enabled = False
+
+    def reset(self):
+        pass
+
+    def incr(self, name, value=1, **labels):
+        pass
+
+    def timer(self, name, **labels):
+        return NULL_TIMER
+
+    def observe(self, name, seconds, **labels):
+        pass
+
+    def observe_key(self, key, seconds):
+        pass
+
+    def snapshot(self):
+        return {'counters': [], 'timers': []}
+
+    def to_prometheus(self):
+        return ''
+
+    def write_prometheus(self, path):
+        pass
+
+    def write_jsonl(self, path, **extra):
+        pass
+
+NULL_METRICS = NullMetrics()
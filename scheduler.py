@@ -0,0 +1,168 @@
+# Import Necessary Libraries
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# HTTP status codes worth requesting again: timeout, throttled and server errors
+RETRY_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+# The data was fetched but could not be written to the database
+class StorageError(Exception):
+    pass
+
+# HTTP status of the response of a failed request (requests or aiohttp), None if there was no response
+#
+def error_status(e):
+    response = getattr(e, 'response', None)
+    status = getattr(response, 'status_code', None)
+    return status if status is not None else getattr(e, 'status', None)
+
+# Check if a failed request should be requested again. Connection errors, timeouts, throttling and server errors are,
+# invalid requests (bad token, unknown station, ...) are not
+#
+def retryable(e):
+    if not getattr(e, 'retryable', True):
+        return False
+    status = error_status(e)
+    return status is None or status in RETRY_STATUS
+
+# Seconds the server asked to wait before the next request, None if it did not
+#
+def retry_after(e):
+    response = getattr(e, 'response', None)
+    headers = getattr(response, 'headers', None) or getattr(e, 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+# Token bucket limiting the rate of the requests. Holds up to burst tokens, refilled at rate tokens per second,
+# and each request takes one. Thread safe.
+#
+class TokenBucket(object):
+    # Constructor for TokenBucket class
+    #
+    # @ Param rate - tokens added per second, the sustained number of requests per second
+    # @ Param burst - maximum number of tokens, the number of requests that can be sent at once after a pause
+    #
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError("The rate of the token bucket must be positive")
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1., rate))
+        self.tokens = self.burst
+        self.lastClock = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Take a token if there is one
+    #
+    # @ returns 0 if a token was taken, otherwise the seconds until the next token
+    #
+    def try_acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.lastClock)*self.rate)
+            self.lastClock = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.
+            return (1 - self.tokens) / self.rate
+
+    # Wait until a token is taken
+    #
+    def acquire(self):
+        while True:
+            pause = self.try_acquire()
+            if pause <= 0:
+                return
+            time.sleep(pause)
+
+# Schedules the requests to Synoptic: a token bucket matched to the Synoptic plan, and exponential backoff
+# with full jitter between the tries of a failed request. One scheduler is shared by all the requests of a database.
+#
+class RequestScheduler(object):
+    # Constructor for RequestScheduler class
+    #
+    # @ Param rate - requests per second allowed by the Synoptic plan, None for no limit
+    # @ Param burst - requests that can be sent at once after a pause, the rate by default
+    # @ Param backoffBase - maximum seconds before the second try of a request, doubled at each try
+    # @ Param backoffMax - maximum seconds between two tries of a request
+    # @ Param seed - seed of the jitter
+    #
+    def __init__(self, rate=None, burst=None, backoffBase=1., backoffMax=60., seed=None):
+        self.bucket = TokenBucket(rate, burst) if rate is not None else None
+        self.backoffBase = backoffBase
+        self.backoffMax = backoffMax
+        self.random = random.Random(seed)
+
+    # Take a request token if there is one
+    #
+    # @ returns 0 if the request can be sent now, otherwise the seconds until it can
+    #
+    def try_acquire(self):
+        return self.bucket.try_acquire() if self.bucket is not None else 0.
+
+    # Seconds to wait before trying a failed request again
+    #
+    # @ Param attempt - number of tries already made
+    # @ Param e - exception of the last try, its Retry-After header is honored
+    #
+    def delay(self, attempt, e=None):
+        delay = self.random.uniform(0, min(self.backoffMax, self.backoffBase*2**(attempt-1)))
+        serverDelay = retry_after(e) if e is not None else None
+        return max(delay, serverDelay) if serverDelay is not None else delay
+
+# Queue of the jobs waiting to be requested, the lowest priority value first. Jobs waiting for a backoff delay
+# are held apart until they are ready, so they never block the other jobs.
+#
+class JobQueue(object):
+    def __init__(self):
+        # (priority, count, job, attempt) of the jobs that can be requested now
+        self.ready = []
+        # (notBefore, count, priority, job, attempt) of the jobs waiting for a backoff delay
+        self.delayed = []
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.ready) + len(self.delayed)
+
+    # Add a job
+    #
+    # @ Param job - job to request
+    # @ Param priority - lower values are requested first
+    # @ Param attempt - number of tries already made
+    # @ Param delay - seconds before the job can be requested
+    #
+    def push(self, job, priority, attempt=0, delay=0.):
+        if delay > 0:
+            heapq.heappush(self.delayed, (time.monotonic() + delay, next(self.counter), priority, job, attempt))
+        else:
+            heapq.heappush(self.ready, (priority, next(self.counter), job, attempt))
+
+    # Seconds until a job can be requested
+    #
+    # @ returns 0 if a job is ready, None if the queue is empty
+    #
+    def wait_time(self):
+        now = time.monotonic()
+        while self.delayed and self.delayed[0][0] <= now:
+            _, count, priority, job, attempt = heapq.heappop(self.delayed)
+            heapq.heappush(self.ready, (priority, count, job, attempt))
+        if self.ready:
+            return 0.
+        if self.delayed:
+            return self.delayed[0][0] - now
+        return None
+
+    # Remove the ready job with the lowest priority value
+    #
+    # @ returns a tuple (job, priority, attempt)
+    #
+    def pop(self):
+        priority, _, job, attempt = heapq.heappop(self.ready)
+        return job, priority, attempt
@@ -0,0 +1,305 @@
+# Import Necessary Libraries
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import datetime as dt
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import io
+import json
+import logging
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+import numpy as np
+import pandas as pd
+from .export import import_pyarrow
+from .SynopticDB import SynopticDB, SynopticError
+
+logger = logging.getLogger(__name__)
+
+# Media type of the Arrow IPC stream responses
+ARROW_STREAM = 'application/vnd.apache.arrow.stream'
+
+# Transform a time of a request (YYYYmmddHHMM or ISO 8601) into a naive UTC datetime
+#
+def parse_time(value):
+    if value is None:
+        return None
+    try:
+        return dt.datetime.strptime(value, '%Y%m%d%H%M')
+    except ValueError:
+        utcTime = dt.datetime.fromisoformat(value)
+        return utcTime.astimezone(dt.timezone.utc).replace(tzinfo=None) if utcTime.tzinfo is not None else utcTime
+
+# Transform the arguments of a request into the query parameters of SynopticDB (see SynopticDB.init_params)
+#
+# @ Param query - dictionary of argument -> list of values, from urllib.parse.parse_qs
+#
+# @ returns a dictionary of query parameters
+#
+def request_params(query):
+    def values(name, kind=str):
+        items = [item for value in query.get(name, []) for item in value.split(',') if item != '']
+        return [kind(item) for item in items] or None
+    bbox = values('bbox', float)
+    if bbox is not None and len(bbox) != 4:
+        raise ValueError("bbox must be minLatitude,maxLatitude,minLongitude,maxLongitude")
+    minLat, maxLat, minLon, maxLon = bbox if bbox is not None else [None]*4
+    return {'vars': values('vars'), 'stationIDs': values('stids'), 'networks': values('networks', int), 'states': values('states'),
+            'minLatitude': minLat, 'maxLatitude': maxLat, 'minLongitude': minLon, 'maxLongitude': maxLon,
+            'startDatetime': parse_time(query.get('start', [None])[0]), 'endDatetime': parse_time(query.get('end', [None])[0]),
+            'resolution': query.get('resolution', [None])[0], 'makeFile': False}
+
+# Serialize a dataframe into an Arrow IPC stream
+#
+def to_arrow_stream(df):
+    pa, ds, pafs = import_pyarrow()
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+# Stations table kept in memory and shared by the workers of the server. It is read again when the station
+# metadata changes (metadata_version in the Metadata table), e.g. after a refresh_metadata by the ingestion.
+#
+class StationCache(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = None
+        self.stations = None
+        # Numpy arrays of the columns used by the station parameters
+        self.columns = None
+
+    # Get the Stations table
+    #
+    # @ Param db - SynopticDB of the calling worker
+    #
+    # @ returns a tuple (dataframe with the columns of the Stations table, dictionary of column -> numpy array)
+    #
+    def get(self, db):
+        with db.get_connection() as conn:
+            row = conn.execute("SELECT value FROM Metadata WHERE key = 'metadata_version'").fetchone()
+            version = row[0] if row is not None else None
+            with self._lock:
+                if self.stations is None or version != self.version:
+                    c = conn.execute("SELECT * FROM Stations")
+                    self.stations = pd.DataFrame(c.fetchall(), columns=[desc[0] for desc in c.description])
+                    self.columns = {column: self.stations[column].to_numpy() for column in ['STID', 'NETWORK_ID', 'STATE']}
+                    self.columns.update({column: pd.to_numeric(self.stations[column], errors='coerce').to_numpy(dtype=np.float64)
+                                         for column in ['LATITUDE', 'LONGITUDE']})
+                    self.version = version
+                    logger.info(f"StationCache.get - loaded {len(self.stations)} stations")
+                return self.stations, self.columns
+
+    # Find the station ids matching the station parameters of a query, like SynopticDB.find_stids_from_params
+    #
+    # @ returns a tuple (list of station ids, mask of those stations in the Stations dataframe, Stations dataframe)
+    #
+    def find(self, db, params):
+        stations, columns = self.get(db)
+        mask = np.ones(len(stations), dtype=bool)
+        if params.get('stationIDs'):
+            mask &= np.isin(columns['STID'], params['stationIDs'])
+        if params.get('networks'):
+            mask &= np.isin(columns['NETWORK_ID'], params['networks'])
+        if params.get('minLatitude') is not None:
+            latitudes, longitudes = columns['LATITUDE'], columns['LONGITUDE']
+            mask &= (latitudes >= params['minLatitude']) & (latitudes <= params['maxLatitude'])
+            mask &= (longitudes >= params['minLongitude']) & (longitudes <= params['maxLongitude'])
+        if params.get('states'):
+            mask &= np.isin(columns['STATE'], params['states'])
+        return columns['STID'][mask].tolist(), mask, stations
+
+# HTTP server answering each connection on a fixed pool of worker threads, so every worker keeps its database
+# connections warm from one request to the next
+#
+class PooledHTTPServer(HTTPServer):
+    def __init__(self, address, handler, workers):
+        super().__init__(address, handler)
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='query')
+
+    def process_request(self, request, clientAddress):
+        self.executor.submit(self.process_request_thread, request, clientAddress)
+
+    def process_request_thread(self, request, clientAddress):
+        try:
+            self.finish_request(request, clientAddress)
+        except Exception:
+            self.handle_error(request, clientAddress)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+# Local read-only query service. Analysts request query_db results over HTTP and receive Arrow IPC streams,
+# while the ingestion keeps writing to the database in another process (WAL mode).
+#
+#   GET /query?vars=air_temp,wind_speed&stids=KSLC,KPVU&start=202401010000&end=202401020000  -> query_db result
+#       also networks=1,2 states=UT,CA bbox=minLat,maxLat,minLon,maxLon resolution=hour|day
+#   GET /stations?networks=1&states=UT  -> stations matching the parameters
+#   GET /health  -> JSON status
+#
+class QueryServer(object):
+    # Constructor for QueryServer class
+    #
+    # @ Param dbPath - path of an existing database
+    # @ Param host - address the server listens on, the local host only by default
+    # @ Param port - port the server listens on, 0 for any free port
+    # @ Param workers - number of worker threads, each with its own read-only SynopticDB and connections.
+    #   Each keep-alive connection holds a worker, so it should be at least the number of concurrent clients
+    # @ Param cache - QueryCache shared by the workers, None for no result cache
+    # @ Param metrics - Metrics object shared by the workers
+    #
+    def __init__(self, dbPath, host='127.0.0.1', port=8765, workers=8, cache=None, metrics=None):
+        import_pyarrow()
+        self.dbPath = dbPath
+        self.cache = cache
+        self.metrics = metrics
+        self.stationCache = StationCache()
+        self._local = threading.local()
+        self._dbs = []
+        self._lock = threading.Lock()
+        # Fail now if the database can not be opened
+        self.get_db()
+        server = self
+        class Handler(QueryHandler):
+            queryServer = server
+        self.httpd = PooledHTTPServer((host, port), Handler, workers)
+        self.address = self.httpd.server_address
+        self.thread = None
+
+    @staticmethod
+    def url_of(address):
+        return f"http://{address[0]}:{address[1]}"
+
+    # Base URL of the server
+    #
+    def url(self):
+        return self.url_of(self.address)
+
+    # Returns the read-only SynopticDB of the calling worker thread, opening it the first time
+    #
+    def get_db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = SynopticDB(self.dbPath, readOnly=True, cache=self.cache, metrics=self.metrics)
+            self._local.db = db
+            with self._lock:
+                self._dbs.append(db)
+        return db
+
+    # Answer a data query
+    #
+    # @ Param params - query parameters from request_params
+    #
+    # @ returns the result dataframe of query_db, or an empty dataframe
+    #
+    def query(self, params):
+        db = self.get_db()
+        stids, _, _ = self.stationCache.find(db, params)
+        if not stids or not params.get('vars'):
+            return pd.DataFrame({'STID': pd.Series(dtype=str), 'DATETIME': pd.Series(dtype=str)})
+        db.params.update(params)
+        # The stations are already resolved from the cache
+        db.params.update({'stationIDs': stids, 'networks': None, 'states': None,
+                          'minLatitude': None, 'maxLatitude': None, 'minLongitude': None, 'maxLongitude': None})
+        result, _ = db.query_db()
+        return result if result is not None else pd.DataFrame({'STID': pd.Series(dtype=str), 'DATETIME': pd.Series(dtype=str)})
+
+    # Answer a station query
+    #
+    def stations(self, params):
+        _, mask, stations = self.stationCache.find(self.get_db(), params)
+        return stations[mask]
+
+    # Serve in the calling thread until shutdown is called
+    #
+    def serve_forever(self):
+        logger.info(f"Serving {self.dbPath} on {self.url()}")
+        self.httpd.serve_forever()
+
+    # Serve in a background thread
+    #
+    # @ returns the base URL of the server
+    #
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread is not None:
+            self.thread.join()
+        with self._lock:
+            for db in self._dbs:
+                db.close()
+            self._dbs = []
+
+# Request handler of the QueryServer. HTTP/1.1 keeps the connections of the clients open between requests
+#
+class QueryHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # The headers and the body are separate writes, with Nagle's algorithm the body waits for the delayed ACK of the headers
+    disable_nagle_algorithm = True
+    # Seconds an idle keep-alive connection holds its worker
+    timeout = 30
+    queryServer = None
+
+    def do_GET(self):
+        startClock = time.perf_counter()
+        url = urlsplit(self.path)
+        try:
+            if url.path == '/health':
+                return self.send(200, json.dumps({'status': 'ok', 'database': self.queryServer.dbPath}).encode(), 'application/json')
+            params = request_params(parse_qs(url.query))
+            if url.path == '/query':
+                df = self.queryServer.query(params)
+            elif url.path == '/stations':
+                df = self.queryServer.stations(params)
+            else:
+                return self.send(404, json.dumps({'error': f"Unknown path {url.path}"}).encode(), 'application/json')
+            body = to_arrow_stream(df)
+        except (SynopticError, ValueError) as e:
+            return self.send(400, json.dumps({'error': str(e)}).encode(), 'application/json')
+        except Exception as e:
+            logger.exception(f"QueryHandler.do_GET - {self.path} failed")
+            return self.send(500, json.dumps({'error': str(e)}).encode(), 'application/json')
+        self.send(200, body, ARROW_STREAM, {'X-Rows': str(len(df)), 'X-Seconds': f"{time.perf_counter() - startClock:.6f}"})
+
+    def send(self, status, body, contentType, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Requests are logged at debug level, the load tests send thousands of them
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local read-only query server of a SynopticDB database')
+    parser.add_argument('database', help='path of the database')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=8, help='worker threads, at least the number of concurrent clients')
+    parser.add_argument('--cache', type=int, default=0, help='number of results kept in memory, 0 for no cache')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    cache = None
+    if args.cache:
+        from .cache import QueryCache
+        cache = QueryCache(maxEntries=args.cache)
+    server = QueryServer(args.database, args.host, args.port, workers=args.workers, cache=cache)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
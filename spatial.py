@@ -0,0 +1,185 @@
+# Import Necessary Libraries
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Mean radius of the Earth in km
+EARTH_RADIUS_KM = 6371.0088
+# Maximum number of (point, station) distances computed at once when scipy is not available
+BLOCK_SIZE = 2**22
+
+# Transform latitudes and longitudes in degrees into unit vectors on the sphere
+#
+# @ Param lats - latitudes in degrees
+# @ Param lons - longitudes in degrees
+#
+# @ returns an array of shape (n, 3)
+#
+def to_unit_vectors(lats, lons):
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    lons = np.radians(np.asarray(lons, dtype=np.float64))
+    cosLats = np.cos(lats)
+    return np.column_stack((cosLats*np.cos(lons), cosLats*np.sin(lons), np.sin(lats)))
+
+# Transform great circle distances in km into chord lengths between unit vectors, and back
+#
+def km_to_chord(km):
+    return 2*np.sin(np.minimum(np.asarray(km, dtype=np.float64)/EARTH_RADIUS_KM, np.pi)/2)
+
+def chord_to_km(chord):
+    return 2*EARTH_RADIUS_KM*np.arcsin(np.clip(np.asarray(chord, dtype=np.float64)/2, 0, 1))
+
+# Find which points are inside a polygon using ray casting
+#
+# @ Param lats - latitudes of the points
+# @ Param lons - longitudes of the points
+# @ Param polygon - list of (latitude, longitude) vertices
+#
+# @ returns a boolean array
+#
+def points_in_polygon(lats, lons, polygon):
+    polygon = np.asarray(polygon, dtype=np.float64)
+    polyLats, polyLons = polygon[:, 0], polygon[:, 1]
+    inside = np.zeros(len(lats), dtype=bool)
+    nextLats, nextLons = np.roll(polyLats, -1), np.roll(polyLons, -1)
+    for lat1, lon1, lat2, lon2 in zip(polyLats, polyLons, nextLats, nextLons):
+        crosses = (lat1 > lats) != (lat2 > lats)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lonCross = lon1 + (lats - lat1)*(lon2 - lon1)/(lat2 - lat1)
+        inside ^= crosses & (lons < lonCross)
+    return inside
+
+# Spatial index of the station locations. Uses a KD-tree on unit vectors when scipy is available,
+# and blocks of vectorized distances with numpy otherwise.
+#
+class StationIndex(object):
+    # Constructor for StationIndex class
+    #
+    # @ Param stids - array of station ids
+    # @ Param lats - array of station latitudes in degrees
+    # @ Param lons - array of station longitudes in degrees
+    # @ Param networks - array of station network ids
+    #
+    def __init__(self, stids, lats, lons, networks=None):
+        self.stids = np.asarray(stids, dtype=object)
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.networks = np.asarray(networks if networks is not None else [None]*len(self.stids), dtype=object)
+        self.points = to_unit_vectors(self.lats, self.lons)
+        try:
+            from scipy.spatial import cKDTree
+            self.tree = cKDTree(self.points) if len(self.points) else None
+        except ImportError:
+            logger.debug('StationIndex - scipy not found, using numpy distances')
+            self.tree = None
+        # Indexes of the stations of a set of networks
+        self._subsets = {}
+
+    def __len__(self):
+        return len(self.stids)
+
+    # Get the index restricted to a set of networks
+    #
+    # @ Param networks - network id or list of network ids, None for all the stations
+    #
+    def subset(self, networks):
+        if networks is None:
+            return self
+        networks = tuple(sorted(set(np.atleast_1d(networks).tolist())))
+        if networks not in self._subsets:
+            mask = np.isin(self.networks, list(networks))
+            self._subsets[networks] = StationIndex(self.stids[mask], self.lats[mask], self.lons[mask], self.networks[mask])
+        return self._subsets[networks]
+
+    # Find the stations within a distance of one or many points
+    #
+    # @ Param lats - latitude or array of latitudes in degrees
+    # @ Param lons - longitude or array of longitudes in degrees
+    # @ Param radiusKm - great circle distance in km
+    # @ Param networks - network id or list of network ids to search, None for all the stations
+    #
+    # @ returns a list of station ids sorted by distance for a single point, or a list of those lists for an array of points
+    #
+    def within(self, lats, lons, radiusKm, networks=None):
+        index = self.subset(networks)
+        single = np.ndim(lats) == 0
+        queries = to_unit_vectors(np.atleast_1d(lats), np.atleast_1d(lons))
+        chord = float(km_to_chord(radiusKm))
+        results = []
+        if not len(index):
+            results = [[] for _ in range(len(queries))]
+        elif index.tree is not None:
+            for query, found in zip(queries, index.tree.query_ball_point(queries, chord)):
+                found = np.asarray(found, dtype=np.int64)
+                order = np.argsort(np.linalg.norm(index.points[found] - query, axis=1), kind='stable')
+                results.append(index.stids[found[order]].tolist())
+        else:
+            for distances in index.chord_blocks(queries):
+                for row in distances:
+                    found = np.flatnonzero(row <= chord)
+                    results.append(index.stids[found[np.argsort(row[found], kind='stable')]].tolist())
+        return results[0] if single else results
+
+    # Find the k nearest stations of one or many points
+    #
+    # @ Param lats - latitude or array of latitudes in degrees
+    # @ Param lons - longitude or array of longitudes in degrees
+    # @ Param k - number of stations per point
+    # @ Param networks - network id or list of network ids to search, None for all the stations
+    #
+    # @ returns a tuple (station ids, distances in km) of shape (k,) for a single point or (number of points, k).
+    #   If there are less than k stations, the missing ones are None with an infinite distance
+    #
+    def nearest(self, lats, lons, k=1, networks=None):
+        index = self.subset(networks)
+        single = np.ndim(lats) == 0
+        queries = to_unit_vectors(np.atleast_1d(lats), np.atleast_1d(lons))
+        found = np.full((len(queries), k), -1, dtype=np.int64)
+        chords = np.full((len(queries), k), np.inf)
+        kk = min(k, len(index))
+        if kk and index.tree is not None:
+            treeChords, treeFound = index.tree.query(queries, k=kk)
+            chords[:, :kk] = np.reshape(treeChords, (len(queries), kk))
+            found[:, :kk] = np.reshape(treeFound, (len(queries), kk))
+        elif kk:
+            start = 0
+            for distances in index.chord_blocks(queries):
+                part = np.argpartition(distances, kk-1, axis=1)[:, :kk]
+                partChords = np.take_along_axis(distances, part, axis=1)
+                order = np.argsort(partChords, axis=1, kind='stable')
+                found[start:start+len(distances), :kk] = np.take_along_axis(part, order, axis=1)
+                chords[start:start+len(distances), :kk] = np.take_along_axis(partChords, order, axis=1)
+                start += len(distances)
+        stids = np.where(found >= 0, index.stids[np.maximum(found, 0)] if len(index) else None, None)
+        distances = np.where(found >= 0, chord_to_km(np.where(np.isfinite(chords), chords, 0)), np.inf)
+        return (stids[0], distances[0]) if single else (stids, distances)
+
+    # Find the stations inside a polygon
+    #
+    # @ Param polygon - list of (latitude, longitude) vertices
+    # @ Param networks - network id or list of network ids to search, None for all the stations
+    #
+    # @ returns a list of station ids
+    #
+    def in_polygon(self, polygon, networks=None):
+        index = self.subset(networks)
+        polygon = np.asarray(polygon, dtype=np.float64)
+        # Only the stations inside the bounding box of the polygon are tested
+        candidates = np.flatnonzero((index.lats >= polygon[:, 0].min()) & (index.lats <= polygon[:, 0].max()) &
+                                    (index.lons >= polygon[:, 1].min()) & (index.lons <= polygon[:, 1].max()))
+        inside = points_in_polygon(index.lats[candidates], index.lons[candidates], polygon)
+        return index.stids[candidates[inside]].tolist()
+
+    # Chord distances between blocks of query points and all the stations
+    #
+    # @ Param queries - array of unit vectors of shape (n, 3)
+    #
+    # @ yields arrays of shape (block size, number of stations)
+    #
+    def chord_blocks(self, queries):
+        blockSize = max(1, BLOCK_SIZE // max(1, len(self.points)))
+        for start in range(0, len(queries), blockSize):
+            # |a - b|^2 = 2 - 2 a.b for unit vectors
+            dots = queries[start:start+blockSize] @ self.points.T
+            yield np.sqrt(np.maximum(2 - 2*dots, 0))
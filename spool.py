@@ -0,0 +1,149 @@
+# Import Necessary Libraries
+import calendar
+import datetime as dt
+import gzip
+import hashlib
+import json
+import logging
+import os
+import os.path as osp
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Query parameters identifying the stations of a spooled response (see harvester.shard_key)
+SHARD_PARAMS = ['stationIDs', 'networks', 'states', 'vars', 'minLatitude', 'maxLatitude', 'minLongitude', 'maxLongitude']
+
+# Transform a Synoptic time (YYYYmmddHHMM) into epoch seconds
+#
+def synoptic_epoch(utcTime):
+    return calendar.timegm(dt.datetime.strptime(utcTime, '%Y%m%d%H%M').timetuple())
+
+# Read and decompress a spooled response
+#
+# @ Param folder - folder of the spool
+# @ Param sha - content hash of the response
+#
+# @ returns the decoded JSON response
+#
+def read_response(folder, sha):
+    with gzip.open(osp.join(folder, 'objects', sha[:2], f'{sha}.json.gz'), 'rb') as f:
+        return json.loads(f.read())
+
+# Spool of the raw responses of the Synoptic timeseries requests, so the data can be ingested again without downloading it.
+# Each response is saved once, gzip compressed, under the SHA-256 of its content. An SQLite index records the time window
+# and the stations of the requests that returned it.
+#
+class Spool(object):
+    # Constructor for Spool class
+    #
+    # @ Param folder - folder of the spool, created if it does not exist
+    # @ Param compressLevel - gzip compression level of the responses
+    #
+    def __init__(self, folder, compressLevel=6):
+        self.folder = folder
+        self.compressLevel = compressLevel
+        os.makedirs(osp.join(folder, 'objects'), exist_ok=True)
+        # Shared by the harvester threads
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(osp.join(folder, 'index.db'), check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=wal")
+        # The last response of a request replaces the previous ones, it has the observations that reached Synoptic late
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS Responses
+                (PARAMS TEXT, START_EPOCH INTEGER, END_EPOCH INTEGER, SHA TEXT, BYTES INTEGER, FETCHED_UTC TEXT,
+                PRIMARY KEY (PARAMS, START_EPOCH, END_EPOCH))''')
+        # Last station and network metadata responses, so a database can be built from the spool without requesting them
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS Metadata
+                (KIND TEXT PRIMARY KEY, SHA TEXT, BYTES INTEGER, FETCHED_UTC TEXT)''')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    # Path of the file of a response
+    #
+    def object_path(self, sha):
+        return osp.join(self.folder, 'objects', sha[:2], f'{sha}.json.gz')
+
+    # Save a response
+    #
+    # @ Param params - query parameters of the request (see SynopticDB.init_params), the token is never saved
+    # @ Param startUtc - start of the time window (YYYYmmddHHMM)
+    # @ Param endUtc - end of the time window (YYYYmmddHHMM)
+    # @ Param body - raw bytes of the response
+    #
+    # @ returns the content hash of the response
+    #
+    def save(self, params, startUtc, endUtc, body):
+        sha = self.write_object(body)
+        request = json.dumps({key: params.get(key) for key in SHARD_PARAMS}, sort_keys=True, default=str)
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO Responses (PARAMS, START_EPOCH, END_EPOCH, SHA, BYTES, FETCHED_UTC) VALUES (?, ?, ?, ?, ?, ?)",
+                              (request, synoptic_epoch(startUtc), synoptic_epoch(endUtc), sha, len(body),
+                               dt.datetime.now(dt.timezone.utc).strftime('%Y-%m-%d_%H:%M:%S')))
+            self.conn.commit()
+        return sha
+
+    # Save the last station or network metadata response
+    #
+    # @ Param kind - 'stations' or 'networks'
+    # @ Param body - raw bytes of the response
+    #
+    # @ returns the content hash of the response
+    #
+    def save_metadata(self, kind, body):
+        sha = self.write_object(body)
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO Metadata (KIND, SHA, BYTES, FETCHED_UTC) VALUES (?, ?, ?, ?)",
+                              (kind, sha, len(body), dt.datetime.now(dt.timezone.utc).strftime('%Y-%m-%d_%H:%M:%S')))
+            self.conn.commit()
+        return sha
+
+    # Read the last station or network metadata response
+    #
+    # @ Param kind - 'stations' or 'networks'
+    #
+    # @ returns the decoded JSON response, None if the spool does not have it
+    #
+    def load_metadata(self, kind):
+        with self._lock:
+            row = self.conn.execute("SELECT SHA FROM Metadata WHERE KIND = ?", (kind,)).fetchone()
+        return self.load(row[0]) if row is not None else None
+
+    # Write the compressed file of a response, once per content
+    #
+    # @ returns the content hash of the response
+    #
+    def write_object(self, body):
+        sha = hashlib.sha256(body).hexdigest()
+        path = self.object_path(sha)
+        # Identical responses are only written once
+        if not osp.exists(path):
+            os.makedirs(osp.dirname(path), exist_ok=True)
+            tmpPath = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmpPath, 'wb') as f:
+                f.write(gzip.compress(body, self.compressLevel))
+            os.replace(tmpPath, path)
+        return sha
+
+    # List the spooled responses overlapping a time range
+    #
+    # @ Param startEpoch - start of the time range in epoch seconds, None for no start
+    # @ Param endEpoch - end of the time range in epoch seconds, None for no end
+    #
+    # @ returns a list of (params, start epoch, end epoch, sha) tuples in time order
+    #
+    def entries(self, startEpoch=None, endEpoch=None):
+        with self._lock:
+            rows = self.conn.execute('''SELECT PARAMS, START_EPOCH, END_EPOCH, SHA FROM Responses
+                    WHERE END_EPOCH > ? AND START_EPOCH < ? ORDER BY START_EPOCH, PARAMS''',
+                    (startEpoch if startEpoch is not None else -2**62, endEpoch if endEpoch is not None else 2**62)).fetchall()
+        return [(json.loads(params), start, end, sha) for params, start, end, sha in rows]
+
+    # Read a spooled response
+    #
+    # @ returns the decoded JSON response
+    #
+    def load(self, sha):
+        return read_response(self.folder, sha)
@@ -0,0 +1,54 @@
+# Import Necessary Libraries
+import datetime as dt
+from datetime import timedelta
+import importlib
+import os.path as osp
+import sys
+from types import SimpleNamespace
+import pytest
+
+# The modules import each other relatively, so the folder of the repository is imported as a package by its name
+REPO = osp.dirname(osp.dirname(osp.abspath(__file__)))
+sys.path.insert(0, osp.dirname(REPO))
+PACKAGE = osp.basename(REPO)
+
+# Start of the synthetic data of the tests
+START = dt.datetime(2024, 1, 1)
+
+@pytest.fixture(scope='session')
+def modules():
+    return SimpleNamespace(**{name: importlib.import_module(f'{PACKAGE}.{name}')
+                              for name in ['SynopticDB', 'benchmark', 'cache', 'metrics', 'utils']})
+
+# Synthetic replacement of the Synoptic requests, so the databases are created without a token or network access
+#
+@pytest.fixture
+def synthetic(modules, monkeypatch, tmp_path):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    services = modules.benchmark.SyntheticSynoptic(20, numNetworks=4, variables=['air_temp', 'wind_speed', 'relative_humidity'])
+    modules.utils.set_services(services)
+    yield services
+    modules.utils.set_services(None)
+
+# Create databases in the temporary folder of the test, closed at the end of the test
+#
+# @ returns a function taking the file name and the keyword arguments of SynopticDB
+#
+@pytest.fixture
+def make_db(modules, synthetic, tmp_path):
+    dbs = []
+    def make(name='test.db', **kwargs):
+        db = modules.SynopticDB.SynopticDB(str(tmp_path / name), token='synthetic', **kwargs)
+        db.params.update(vars=list(synthetic.variables), startDatetime=START, endDatetime=START + timedelta(days=2), makeFile=False)
+        dbs.append(db)
+        return db
+    yield make
+    for db in dbs:
+        db.close()
+
+# Insert hours of synthetic data
+#
+# @ returns the number of rows inserted
+#
+def insert_hours(db, services, start, hours):
+    return db.insert_data(services.stations_timeseries(start, start + timedelta(hours=hours) - timedelta(minutes=1)))
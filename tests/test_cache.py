@@ -0,0 +1,21 @@
+# Import Necessary Libraries
+from datetime import timedelta
+import pandas as pd
+from conftest import START, insert_hours
+
+def test_insert_invalidates_cache(make_db, synthetic, modules):
+    metrics = modules.metrics.Metrics()
+    db = make_db(cache=modules.cache.QueryCache(maxEntries=8), metrics=metrics)
+    insert_hours(db, synthetic, START, 2)
+    first, _ = db.query_db()
+    cached, _ = db.query_db()
+    pd.testing.assert_frame_equal(cached, first)
+    assert metrics.counters[('cache_hits', ())] == 1
+    # New observations of the same variables and day change the result of the query
+    insert_hours(db, synthetic, START + timedelta(hours=2), 1)
+    result, _ = db.query_db()
+    assert metrics.counters[('cache_hits', ())] == 1
+    assert len(result) == len(first) + 20*12
+    db.cache = None
+    uncached, _ = db.query_db()
+    pd.testing.assert_frame_equal(result, uncached)
@@ -0,0 +1,17 @@
+# Import Necessary Libraries
+from datetime import timedelta
+from conftest import START
+
+def test_sync_requests_missing_windows(make_db, synthetic):
+    db = make_db()
+    db.params.update(endDatetime=START + timedelta(hours=3))
+    report = db.sync(workers=2)
+    assert report['jobs'] == 3 and report['failed'] == 0 and report['rows'] > 0
+    # The windows inserted are in the coverage ledger, nothing is requested again
+    assert db.sync(workers=2)['jobs'] == 0
+    metadata = dict(db.check_table('Metadata'))
+    assert metadata['last_get_data_utc'] == (START + timedelta(hours=3)).strftime('%Y-%m-%d_%H:%M:%S')
+    # An older window does not move the last data time back
+    db.params.update(startDatetime=START - timedelta(hours=1), endDatetime=START)
+    assert db.sync(workers=2)['jobs'] == 1
+    assert dict(db.check_table('Metadata'))['last_get_data_utc'] == metadata['last_get_data_utc']
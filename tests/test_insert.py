@@ -0,0 +1,32 @@
+# Import Necessary Libraries
+from datetime import timedelta
+import pytest
+from conftest import START, insert_hours
+
+# Number of observations (values that are not missing) of station dataframes
+#
+def count_values(dfs):
+    return sum(int(df.notna().sum().sum()) for df in dfs)
+
+LAYOUTS = [{}, {'layout': 'long'}, {'partition': 'day'}, {'layout': 'long', 'partition': 'day'}]
+
+@pytest.mark.parametrize('kwargs', LAYOUTS)
+def test_insert_returns_rows_written(make_db, synthetic, kwargs):
+    db = make_db(**kwargs)
+    dfs = synthetic.stations_timeseries(START, START + timedelta(hours=2, minutes=59))
+    assert db.insert_data(dfs) == count_values(dfs)
+    # The same observations are already stored
+    assert db.insert_data(dfs) == 0
+    # Overlapping windows only write the new observations
+    newDfs = synthetic.stations_timeseries(START + timedelta(hours=3), START + timedelta(hours=3, minutes=59))
+    assert insert_hours(db, synthetic, START + timedelta(hours=2), 2) == count_values(newDfs)
+
+@pytest.mark.parametrize('kwargs', LAYOUTS)
+def test_reinsert_keeps_query(make_db, synthetic, kwargs):
+    db = make_db(**kwargs)
+    insert_hours(db, synthetic, START, 3)
+    before, _ = db.query_db()
+    insert_hours(db, synthetic, START, 3)
+    after, _ = db.query_db()
+    assert len(before) == 20*36
+    assert after.equals(before)
@@ -0,0 +1,46 @@
+# Import Necessary Libraries
+import numpy as np
+import pandas as pd
+import pytest
+from conftest import START, insert_hours
+
+@pytest.mark.parametrize('layout', ['tables', 'long'])
+def test_query_iter_matches_query(make_db, synthetic, layout):
+    db = make_db(layout=layout)
+    insert_hours(db, synthetic, START, 4)
+    result, _ = db.query_db()
+    chunks = list(db.query_db_iter(chunkSize=500))
+    assert len(chunks) > 1
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), result)
+
+@pytest.mark.parametrize('resolution, freq', [('hour', 'h'), ('day', 'D')])
+def test_rollups_match_observations(make_db, synthetic, resolution, freq):
+    db = make_db()
+    insert_hours(db, synthetic, START, 30)
+    raw, _ = db.query_db()
+    db.params['resolution'] = resolution
+    rollups, _ = db.query_db()
+    buckets = pd.to_datetime(raw['DATETIME']).dt.floor(freq)
+    rollups['DATETIME'] = pd.to_datetime(rollups['DATETIME']).astype(buckets.dtype)
+    for variable in synthetic.variables:
+        column = variable.upper()
+        grouped = raw.groupby(['STID', buckets])[f'{column}_VALUE']
+        expected = pd.DataFrame({'mean': grouped.mean(), 'count': grouped.count()}).reset_index()
+        expected = expected[expected['count'] > 0]
+        merged = expected.merge(rollups, on=['STID', 'DATETIME'], how='outer', validate='one_to_one')
+        assert len(merged) == len(expected)
+        np.testing.assert_allclose(merged[f'{column}_MEAN'], merged['mean'])
+        np.testing.assert_array_equal(merged[f'{column}_COUNT'], merged['count'])
+
+@pytest.mark.parametrize('layout', ['tables', 'long'])
+@pytest.mark.parametrize('resolution', [None, 'hour'])
+def test_partitions_match_single_file(make_db, synthetic, layout, resolution):
+    single = make_db('single.db', layout=layout)
+    partitioned = make_db('partitioned.db', layout=layout, partition='day')
+    for db in (single, partitioned):
+        insert_hours(db, synthetic, START, 30)
+        db.params['resolution'] = resolution
+    expected, expectedStations = single.query_db()
+    result, stations = partitioned.query_db()
+    pd.testing.assert_frame_equal(result, expected)
+    pd.testing.assert_frame_equal(stations, expectedStations)
@@ -0,0 +1,92 @@
+# Import Necessary Libraries
+import logging
+import re
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# String values that are considered missing data
+MISSING_STRINGS = ["nan", "n/a", "na", "none", "nonetype"]
+# Kinds of pandas.api.types.infer_dtype holding only numbers
+NUMERIC_KINDS = ['empty', 'floating', 'integer', 'mixed-integer-float', 'decimal', 'boolean']
+# Cloud layer variables (cloud_layer_1, cloud_layer_2_set_1d, ...), split into their sky condition and height
+CLOUD_LAYER = re.compile(r'^cloud_layer_\d+(_set_\d+d?)?$')
+# Cloud group of a METAR (BKN025 is broken at 2500 ft) or a sky condition and height in ft (OVC 1500)
+CLOUD_GROUP = re.compile(r'^\s*(SKC|CLR|NSC|NCD|FEW|SCT|BKN|OVC|VV)(?:(\d{3})(?!\d)|\s*(\d+(?:\.\d+)?))?', re.IGNORECASE)
+
+# Split a column of a station dataframe into the variables stored in the database. The type of the column is found
+# once from its dtype and its distinct values, never value by value: numbers and numeric strings are REAL, strings are
+# TEXT, dictionaries are split into one variable per key, and cloud layers into their sky condition and height.
+#
+# @ Param variable - name of the column
+# @ Param column - numpy array of the values
+# @ Param unit - units of the column, None if it has none
+#
+# @ returns a list of (variable, column type, values, mask of the values that are not missing, units) tuples
+#
+def split_column(variable, column, unit=None):
+    if column.dtype.kind in 'biuf':
+        values = column.astype(np.float64)
+        return [(variable, "REAL", values, ~np.isnan(values), unit)]
+    column = np.asarray(column, dtype=object)
+    kind = pd.api.types.infer_dtype(column, skipna=True)
+    if kind in NUMERIC_KINDS:
+        values = pd.to_numeric(pd.Series(column, dtype=object), errors='coerce').to_numpy(dtype=np.float64)
+        return [(variable, "REAL", values, ~np.isnan(values), unit)]
+    if kind == 'mixed' and any(isinstance(value, dict) for value in column):
+        return split_records(variable, column, unit)
+    # Classify the distinct values only
+    try:
+        codes, uniques = pd.factorize(column)
+    except TypeError:
+        codes, uniques = pd.factorize(column.astype(str))
+    strings = np.array([str(value) for value in uniques], dtype=object)
+    missing = np.isin(np.char.lower(strings.astype(str)), MISSING_STRINGS) if len(strings) else np.zeros(0, dtype=bool)
+    safeCodes = np.maximum(codes, 0)
+    mask = (codes >= 0) & ~missing[safeCodes] if len(strings) else np.zeros(len(column), dtype=bool)
+    if CLOUD_LAYER.match(variable):
+        return split_cloud_layers(variable, strings, safeCodes, mask)
+    numbers = pd.to_numeric(pd.Series(strings, dtype=object), errors='coerce').to_numpy(dtype=np.float64)
+    if np.all(~np.isnan(numbers) | missing):
+        values = np.where(mask, numbers[safeCodes] if len(strings) else np.nan, np.nan)
+        return [(variable, "REAL", values, mask, unit)]
+    return [(variable, "TEXT", strings[safeCodes] if len(strings) else column, mask, unit)]
+
+# Split a column of dictionaries into one variable per key (<variable>_<key>), each classified by split_column
+#
+def split_records(variable, column, unit=None):
+    keys = sorted({key for value in column if isinstance(value, dict) for key in value})
+    result = []
+    for key in keys:
+        subColumn = np.array([value.get(key) if isinstance(value, dict) else None for value in column], dtype=object)
+        subUnit = unit
+        if CLOUD_LAYER.match(variable):
+            subUnit = (unit or 'ft') if key == 'height_agl' else None
+        result += split_column(f"{variable}_{key}", subColumn, subUnit)
+    return result
+
+# Parse the distinct values of a cloud layer column into its sky condition (<variable>_sky_condition)
+# and its height in ft (<variable>_height_agl)
+#
+# @ Param strings - distinct values of the column
+# @ Param codes - index in strings of each value of the column
+# @ Param mask - values of the column that are not missing
+#
+def split_cloud_layers(variable, strings, codes, mask):
+    conditions = np.full(len(strings), None, dtype=object)
+    heights = np.full(len(strings), np.nan)
+    for i, value in enumerate(strings):
+        match = CLOUD_GROUP.match(value)
+        if match is None:
+            continue
+        conditions[i] = match.group(1).upper()
+        if match.group(2) is not None:
+            heights[i] = float(match.group(2)) * 100
+        elif match.group(3) is not None:
+            heights[i] = float(match.group(3))
+    if len(strings) and any(condition is None for condition in conditions[np.unique(codes[mask])]):
+        logger.debug(f"split_cloud_layers - {variable} has values that are not cloud groups")
+    conditions, heights = conditions[codes], heights[codes]
+    return [(f"{variable}_sky_condition", "TEXT", conditions, mask & pd.notna(conditions), None),
+            (f"{variable}_height_agl", "REAL", heights, mask & ~np.isnan(heights), 'ft')]
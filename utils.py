@@ -1,6 +1,274 @@
-import synoptic.services as ss
+import json
 import logging
-import requests
+import numpy as np
+import pandas as pd
+import re
+from .metrics import NULL_METRICS
+
+logger = logging.getLogger(__name__)
+
+# Base URL of the Synoptic API
+SYNOPTIC_URL = 'https://api.synopticdata.com/v2/'
+# Synoptic response codes of a successful request and of a request without data
+RESPONSE_OK = 1
+RESPONSE_NO_DATA = 2
+# Suffix of the sensor sets in the Synoptic observations (air_temp_set_1, dew_point_temperature_set_1d, ...)
+SET_SUFFIX = re.compile(r'_set_\d+d?$')
+FIRST_SET_SUFFIX = re.compile(r'_set_1d?$')
+# Token parameter of the request URLs quoted by the HTTP errors
+TOKEN_PARAM = re.compile(r'(token=)[^&\s\'"]*')
+
+# Module answering the Synoptic requests instead of the HTTP client when set with set_services
+services = None
+# Shared HTTP client of the Synoptic requests
+client = None
+
+# Synoptic answered the request with an error (invalid token, unknown parameters, ...). Requesting it again would not help
+class SynopticAPIError(Exception):
+    retryable = False
+
+# Replace the module answering the Synoptic requests, e.g. with a synthetic generator for offline benchmarks
+# or with synoptic.services to request the data through SynopticPy
+#
+# @ Param module - object with a stations_timeseries function like synoptic.services, and optionally
+#   get_stations(token) and get_networks(token) functions returning the metadata payloads. None goes back to the HTTP client
+#
+def set_services(module):
+    global services
+    services = module
+
+# Replace the shared HTTP client, e.g. with one pointing to a local server
+#
+def set_client(newClient):
+    global client
+    client = newClient
+
+# Returns the shared HTTP client, creating it the first time
+#
+def get_client():
+    global client
+    if client is None:
+        client = SynopticClient()
+    return client
+
+# Import aiohttp, which is only needed for the asyncio backend
+#
+def import_aiohttp():
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError("aiohttp is required for the asyncio backend. Install it with: conda install -c conda-forge aiohttp")
+    return aiohttp
+
+# Build the parameters of a Synoptic timeseries request
+#
+# @ Param params - query parameters (see SynopticDB.init_params)
+# @ Param startUtc - start of the time window (YYYYmmddHHMM)
+# @ Param endUtc - end of the time window (YYYYmmddHHMM)
+# @ Param token - Synoptic API token
+#
+# @ returns a dictionary of request parameters, lists are sent comma separated
+#
+def timeseries_params(params, startUtc, endUtc, token):
+    request = {'token': token, 'start': startUtc, 'end': endUtc, 'country': 'us', 'obtimezone': 'UTC'}
+    for key, name in [('stationIDs', 'stid'), ('networks', 'network'), ('states', 'state'), ('vars', 'vars')]:
+        values = ensure_list(params.get(key))
+        if values:
+            request[name] = ','.join(str(value) for value in values)
+    bbox = [params.get(key) for key in ['minLongitude', 'minLatitude', 'maxLongitude', 'maxLatitude']]
+    if all(value is not None for value in bbox):
+        request['bbox'] = ','.join(str(value) for value in bbox)
+    return request
+
+# Text of a failed request without the API token. The errors of requests and aiohttp quote the URL of the request,
+# with the token in its query string
+#
+def redact_token(e):
+    return TOKEN_PARAM.sub(r'\1***', str(e))
+
+# Check the summary of a Synoptic response
+#
+# @ returns False if the request found no data
+#
+def check_payload(payload):
+    summary = payload.get('SUMMARY') or {}
+    code = summary.get('RESPONSE_CODE', RESPONSE_OK)
+    if code == RESPONSE_NO_DATA:
+        return False
+    if code != RESPONSE_OK:
+        raise SynopticAPIError(f"Synoptic request failed with code {code}: {summary.get('RESPONSE_MESSAGE')}")
+    return True
+
+# Transform a Synoptic timeseries response into station dataframes like SynopticPy does
+#
+# @ Param payload - decoded JSON response of the stations/timeseries service
+#
+# @ returns a list of dataframes indexed by UTC datetime, with the station metadata and the UNITS of the variables as attributes
+#
+def timeseries_frames(payload):
+    units = payload.get('UNITS') or {}
+    dfs = []
+    for station in payload.get('STATION') or []:
+        observations = station.get('OBSERVATIONS') or {}
+        datetimes = observations.get('date_time')
+        if not datetimes:
+            continue
+        columns = {}
+        for name, values in observations.items():
+            if name == 'date_time':
+                continue
+            # Drop the suffix of the first sensor set (the derived one if there is no measured one)
+            variable = FIRST_SET_SUFFIX.sub('', name)
+            if variable == name or variable in columns or f'{variable}_set_1' in observations and name.endswith('d'):
+                variable = name
+            try:
+                columns[variable] = pd.to_numeric(np.asarray(values, dtype=object), errors='raise').astype(np.float64)
+            except (TypeError, ValueError):
+                columns[variable] = np.asarray(values, dtype=object)
+        df = pd.DataFrame(columns, index=pd.DatetimeIndex(pd.to_datetime(datetimes, utc=True), name='date_time'))
+        df.attrs = {key: value for key, value in station.items() if key not in ('OBSERVATIONS', 'SENSOR_VARIABLES')}
+        for key in ['LATITUDE', 'LONGITUDE', 'ELEVATION']:
+            try:
+                df.attrs[key.lower()] = float(station.get(key))
+            except (TypeError, ValueError):
+                pass
+        df.attrs['UNITS'] = {variable: units.get(SET_SUFFIX.sub('', variable), units.get(variable)) for variable in columns}
+        dfs.append(df)
+    return dfs
+
+# HTTP client of the Synoptic API. One session keeps persistent connections open and reuses them
+# for all the requests, with gzip compressed responses and timeouts. It is thread safe, so the harvester threads share it.
+#
+class SynopticClient(object):
+    # Constructor for SynopticClient class
+    #
+    # @ Param baseUrl - base URL of the Synoptic API, e.g. a local server for tests
+    # @ Param connections - number of persistent connections kept open
+    # @ Param timeout - seconds to wait to connect and to wait for data, as a number or a (connect, read) tuple
+    #
+    def __init__(self, baseUrl=SYNOPTIC_URL, connections=8, timeout=(10, 120)):
+        self.baseUrl = baseUrl.rstrip('/') + '/'
+        self.timeout = timeout
+        self.connections = 0
+        # requests is only imported by the databases requesting Synoptic
+        import requests
+        self.session = requests.Session()
+        self.session.headers.update({'Accept': 'application/json', 'Accept-Encoding': 'gzip, deflate'})
+        self.reserve(connections)
+
+    # Keep at least a number of persistent connections open, e.g. one per harvester thread
+    #
+    def reserve(self, connections):
+        if connections <= self.connections:
+            return
+        self.connections = connections
+        from requests.adapters import HTTPAdapter
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    # Request a Synoptic service
+    #
+    # @ Param service - service path, e.g. stations/timeseries
+    # @ Param params - dictionary of request parameters
+    # @ Param metrics - Metrics object counting the bytes received
+    #
+    # @ returns the decoded JSON response
+    #
+    def get(self, service, params, metrics=NULL_METRICS):
+        return json.loads(self.get_raw(service, params, metrics))
+
+    # Request a Synoptic service without decoding the response
+    #
+    # @ returns the bytes of the response, decompressed
+    #
+    def get_raw(self, service, params, metrics=NULL_METRICS):
+        response = self.session.get(self.baseUrl + service, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        body = response.content
+        # Bytes read from the connection, before decompression
+        metrics.incr('bytes_fetched', response.raw.tell() or len(body))
+        return body
+
+    # Request the observations of a time window
+    #
+    # @ Param spool - Spool saving the raw response, None to not save it
+    #
+    # @ returns the list of station dataframes
+    #
+    def timeseries(self, token, params, startUtc, endUtc, metrics=NULL_METRICS, spool=None):
+        body = self.get_raw('stations/timeseries', timeseries_params(params, startUtc, endUtc, token), metrics)
+        payload = json.loads(body)
+        # Responses without data are saved too, replaying them records the window as covered
+        hasData = check_payload(payload)
+        if spool is not None:
+            spool.save(params, startUtc, endUtc, body)
+        return timeseries_frames(payload) if hasData else []
+
+    def close(self):
+        self.session.close()
+
+# Asyncio version of SynopticClient, using aiohttp. Many requests can be awaited at once over a few persistent connections.
+# The session is created by the first request, in the event loop running it.
+#
+class AsyncSynopticClient(object):
+    # Constructor for AsyncSynopticClient class
+    #
+    # @ Param baseUrl - base URL of the Synoptic API, e.g. a local server for tests
+    # @ Param connections - maximum number of connections open at once
+    # @ Param timeout - seconds to wait to connect and to wait for data, as a number or a (connect, read) tuple
+    #
+    def __init__(self, baseUrl=SYNOPTIC_URL, connections=8, timeout=(10, 120)):
+        self.aiohttp = import_aiohttp()
+        self.baseUrl = baseUrl.rstrip('/') + '/'
+        self.connections = connections
+        connectTimeout, readTimeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        self.timeout = self.aiohttp.ClientTimeout(sock_connect=connectTimeout, sock_read=readTimeout)
+        self.session = None
+
+    # Request a Synoptic service
+    #
+    # @ returns the decoded JSON response
+    #
+    async def get(self, service, params, metrics=NULL_METRICS):
+        return json.loads(await self.get_raw(service, params, metrics))
+
+    # Request a Synoptic service without decoding the response
+    #
+    # @ returns the bytes of the response, decompressed
+    #
+    async def get_raw(self, service, params, metrics=NULL_METRICS):
+        if self.session is None:
+            self.session = self.aiohttp.ClientSession(connector=self.aiohttp.TCPConnector(limit=self.connections),
+                                                      timeout=self.timeout, headers={'Accept': 'application/json', 'Accept-Encoding': 'gzip, deflate'})
+        async with self.session.get(self.baseUrl + service, params=params) as response:
+            response.raise_for_status()
+            body = await response.read()
+            # Bytes sent by the server, before decompression
+            metrics.incr('bytes_fetched', response.content_length or len(body))
+            return body
+
+    # Request the observations of a time window
+    #
+    # @ Param spool - Spool saving the raw response, None to not save it
+    #
+    # @ returns the list of station dataframes
+    #
+    async def timeseries(self, token, params, startUtc, endUtc, metrics=NULL_METRICS, spool=None):
+        body = await self.get_raw('stations/timeseries', timeseries_params(params, startUtc, endUtc, token), metrics)
+        payload = json.loads(body)
+        hasData = check_payload(payload)
+        # Save the response and build the dataframes out of the event loop (asyncio is already imported by the loop)
+        import asyncio
+        loop = asyncio.get_running_loop()
+        if spool is not None:
+            await loop.run_in_executor(None, spool.save, params, startUtc, endUtc, body)
+        return await loop.run_in_executor(None, timeseries_frames, payload) if hasData else []
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
 
 # Transform any input into a list version of it
 #
@@ -15,69 +283,105 @@ def ensure_list(input_data):
         else:
             return []
 
-# Get the network names and IDs from MesoWest
+# Request a metadata service, saving the response in the spool
 #
-def get_networks(token):
-    url = f'https://api.synopticdata.com/v2/networks?&token={token}'
+# @ Param kind - 'stations' or 'networks', also the function of the replacement services
+# @ Param key - key of the payload holding the metadata, responses without it are not spooled
+#
+# @ returns the decoded JSON response, None if the request failed
+#
+def get_metadata(kind, service, params, key, spool=None):
     try:
-        # Send an HTTP GET request to the URL
-        response = requests.get(url)
-
-        # Check if the request was successful (status code 200)
-        if response.status_code == 200:
-            # Get the content of the response (the data)
-            rawStationData = response
-            return rawStationData.json()
+        if hasattr(services, f'get_{kind}'):
+            payload = getattr(services, f'get_{kind}')(params['token'])
+            body = json.dumps(payload).encode() if spool is not None else None
+        else:
+            body = get_client().get_raw(service, params)
+            payload = json.loads(body)
     except Exception as e:
-        logging.warning(e)
+        logger.warning(f"get_metadata - {kind} request failed: {redact_token(e)}")
+        return None
+    if spool is not None and isinstance(payload, dict) and payload.get(key):
+        spool.save_metadata(kind, body)
+    return payload
+
+# Get the network names and IDs from MesoWest
+#
+# @ Param spool - Spool saving the response, None to not save it
+#
+def get_networks(token, spool=None):
+    return get_metadata('networks', 'networks', {'token': token}, 'MNET', spool)
 
 # Retrieves all of MesoWest stations information for the United States
 #
-def get_stations(token):
-    url=f'https://api.synopticdata.com/v2/stations/metadata?&token={token}&country=us'
-    try:
-        # Send an HTTP GET request to the URL
-        response = requests.get(url)
-        # Check if the request was successful (status code 200)
-        if response.status_code == 200:
-            # Get the content of the response (the data)
-            rawStationData = response
-            return rawStationData.json()
-    except Exception as e:
-        logging.warning(e)
-        
+# @ Param spool - Spool saving the response, None to not save it
+#
+def get_stations(token, spool=None):
+    return get_metadata('stations', 'stations/metadata', {'token': token, 'country': 'us'}, 'STATION', spool)
+
 # Request Synoptic data using timeseries
 #
-def get_timeseries(db, startUtc, endUtc, max_retries=5):
-    stids = db.params.get('stationIDs')
-    states = db.params.get('states')
-    minLat = db.params.get('minLatitude')
-    maxLat = db.params.get('maxLatitude')
-    minLon = db.params.get('minLongitude')
-    maxLon = db.params.get('maxLongitude')
+# @ Param params - query parameters (see SynopticDB.init_params)
+# @ Param startUtc - start of the time window (YYYYmmddHHMM)
+# @ Param endUtc - end of the time window (YYYYmmddHHMM)
+# @ Param token - Synoptic API token
+# @ Param metrics - Metrics object counting the bytes received
+# @ Param spool - Spool saving the raw responses of the HTTP client, None to not save them
+#
+# @ returns the list of station dataframes from Synoptic
+#
+def fetch_timeseries(params, startUtc, endUtc, token=None, metrics=NULL_METRICS, spool=None):
+    if services is None:
+        return get_client().timeseries(token, params, startUtc, endUtc, metrics, spool)
+    stids = params.get('stationIDs')
+    minLat = params.get('minLatitude')
+    maxLat = params.get('maxLatitude')
+    minLon = params.get('minLongitude')
+    maxLon = params.get('maxLongitude')
     bbox = [minLon, minLat, maxLon, maxLat]
-    states = db.params.get('states')
-    networks = db.params.get('networks')
-    tableNames = db.params.get('vars')
-    try:
-        # Request data to Synoptic
-        df = ss.stations_timeseries(
-            start=startUtc, 
-            end=endUtc,
-            network=networks,
-            stid = stids,
-            country="US",
-            state=states,
-            bbox=bbox,
-            vars=tableNames,
-            verbose=False
-        )
-        # Insert the queried data to the database
-        db.insert_data(df)
-    except:
-        max_retries -= 1
-        if max_retries > 0:
-            logging.warning('request_synoptic - SynopticDB failed, remaining tries {}'.format(max_retries))
-            get_timeseries(db, startUtc, endUtc, max_retries)
-        else:
-            logging.warning('request_synoptic - SynopticDB failed to get data')
\ No newline at end of file
+    states = params.get('states')
+    networks = params.get('networks')
+    tableNames = params.get('vars')
+    # Request data to the replacement services
+    return services.stations_timeseries(
+        start=startUtc, 
+        end=endUtc,
+        network=networks,
+        stid = stids,
+        country="US",
+        state=states,
+        bbox=bbox,
+        vars=tableNames,
+        verbose=False
+    )
+
+# Request Synoptic data using timeseries and insert it into the database, with the query parameters of the database.
+# Kept for the scripts calling it, db.harvest and db.sync request and insert many windows at once
+#
+# @ Param db - SynopticDB receiving the data
+# @ Param startUtc - start of the time window (YYYYmmddHHMM)
+# @ Param endUtc - end of the time window (YYYYmmddHHMM)
+# @ Param max_retries - number of tries of the request
+#
+# @ returns the number of rows inserted, None if the request failed
+#
+def get_timeseries(db, startUtc, endUtc, max_retries=5):
+    for attempt in range(1, max_retries+1):
+        try:
+            listOfDfs = fetch_timeseries(db.params, startUtc, endUtc, db.get_token(), db.metrics, db.spool)
+        except Exception as e:
+            logger.warning(f'get_timeseries - request failed: {redact_token(e)}, remaining tries {max_retries-attempt}')
+            continue
+        return db.insert_data(listOfDfs)
+    logger.warning('get_timeseries - SynopticDB failed to get data')
+    return None
+
+# Asyncio version of fetch_timeseries. The replacement services are called in a thread
+#
+# @ Param asyncClient - AsyncSynopticClient making the requests
+#
+async def fetch_timeseries_async(asyncClient, params, startUtc, endUtc, token=None, metrics=NULL_METRICS, spool=None):
+    if services is None:
+        return await asyncClient.timeseries(token, params, startUtc, endUtc, metrics, spool)
+    import asyncio
+    return await asyncio.get_running_loop().run_in_executor(None, fetch_timeseries, params, startUtc, endUtc, token, metrics)